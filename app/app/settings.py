@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     "django.contrib.contenttypes",
     "django.contrib.sessions",
     "django.contrib.messages",
+    "django.contrib.postgres",
     'daphne',
     'channels',
     'channels_redis',
@@ -129,6 +130,27 @@ DATABASES = {
     }
 }
 
+# In-process LRU tier in front of redis for recipe detail, every uwsgi worker has its own.
+# Off by default, set all of them (ex: 500 entries, 16MB, 30 seconds) to enable it.
+RECIPE_LOCAL_CACHE = {
+    "MAX_ENTRIES": int(os.environ.get("RECIPE_LOCAL_CACHE_ENTRIES", 0)),
+    "MAX_BYTES": int(os.environ.get("RECIPE_LOCAL_CACHE_BYTES", 0)),
+    "TIMEOUT": int(os.environ.get("RECIPE_LOCAL_CACHE_TIMEOUT", 0)),
+}
+
+# Codec of recipe list data in redis (detail is cached as ready to serve json and gzip payload): json, zlib-json, msgpack, zlib-msgpack, zstd-json, zstd-msgpack.
+# Values of every codec are read, switch it after all workers can read the new codec.
+RECIPE_CACHE_CODEC = os.environ.get("RECIPE_CACHE_CODEC", "json")
+
+# Warm-up of recipe detail cache, most viewed recipes first, loaded and written one chunk at a time
+# to keep memory of worker bounded. Expiry of every key is random between TIMEOUT_MIN and TIMEOUT_MAX.
+RECIPE_WARM_UP = {
+    "LIMIT": int(os.environ.get("RECIPE_WARM_UP_LIMIT", 100)),
+    "CHUNK_SIZE": int(os.environ.get("RECIPE_WARM_UP_CHUNK_SIZE", 50)),
+    "TIMEOUT_MIN": int(os.environ.get("RECIPE_WARM_UP_TIMEOUT_MIN", 1500)),
+    "TIMEOUT_MAX": int(os.environ.get("RECIPE_WARM_UP_TIMEOUT_MAX", 1800)),
+}
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -355,6 +377,26 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'recipe.tasks.consist_redis_and_sql_data',
         'schedule': crontab(minute='*/15'),  # every 15 minutes
     },
+    'flush-recipe-likes-to-sql':{
+        'task': 'recipe.tasks.flush_recipe_likes',
+        'schedule': crontab(minute='*'),  # every minute
+    },
+    'flush-search-views-to-sql':{
+        'task': 'recipe.tasks.flush_search_views',
+        'schedule': crontab(minute='*/5'),  # every 5 minutes
+    },
+    'rebuild-recipe-index':{
+        'task': 'recipe.tasks.rebuild_recipe_index',
+        'schedule': crontab(minute=0, hour=4),  # every day at 4 am
+    },
+    'rebuild-suggest-index':{
+        'task': 'recipe.tasks.rebuild_suggest_index',
+        'schedule': crontab(minute=30, hour=4),  # every day at 4:30 am
+    },
+    'rescale-trending':{
+        'task': 'recipe.tasks.rescale_trending',
+        'schedule': crontab(minute=10),  # every hour
+    },
 
 }
 CELERY_BEAT_SCHEDULE_FILENAME = '/home/celery/var/run/celerybeat-schedule'
@@ -0,0 +1,74 @@
+"""
+Compare the codecs of cached recipe list data
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Recipe
+from recipe.cache_codec import CODECS, decode
+from recipe.tasks import recipe_list_items
+
+
+class Command(BaseCommand):
+    """
+    Django command to measure bytes per entry and encode/decode time of codecs on real recipe list data,
+    the Recipe_list_item_ values written with RECIPE_CACHE_CODEC. Detail payloads are not encoded by codec.
+    """
+
+    help = "Benchmark codecs of RECIPE_CACHE_CODEC on list data of the most viewed recipes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=100,
+            help="Number of recipes encoded, most viewed first.",
+        )
+        parser.add_argument(
+            "--rounds",
+            type=int,
+            default=5,
+            help="Times every recipe is encoded and decoded.",
+        )
+        parser.add_argument(
+            "--codec",
+            nargs="+",
+            dest="codecs",
+            help="Only benchmark the given codecs.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        names = options["codecs"] or list(CODECS)
+        unknown = [name for name in names if name not in CODECS]
+        if unknown:
+            raise CommandError(f"Codecs not available: {', '.join(unknown)}. Available: {', '.join(CODECS)}")
+        ids = list(Recipe.objects.order_by('-views', 'id').values_list('id', flat=True)[:options["limit"]])
+        items = [dict(item) for item in recipe_list_items(ids)]
+        if not items:
+            raise CommandError("There is no recipe to benchmark.")
+        rounds = max(options["rounds"], 1)
+
+        json_size = sum(len(CODECS['json'].encode(item)) for item in items) / len(items)
+        self.stdout.write(f"{len(items)} recipes, {rounds} rounds")
+        self.stdout.write(f"{'codec':<14}{'bytes/entry':>12}{'vs json':>9}{'encode us':>11}{'decode us':>11}")
+        for name in names:
+            codec = CODECS[name]
+            begin = time.perf_counter()
+            for _ in range(rounds):
+                encoded = [codec.encode(item) for item in items]
+            encode_time = time.perf_counter() - begin
+            begin = time.perf_counter()
+            for _ in range(rounds):
+                decoded = [decode(raw) for raw in encoded]
+            decode_time = time.perf_counter() - begin
+            if decoded != items:
+                raise CommandError(f"Codec {name} does not decode to the same data.")
+
+            size = sum(len(raw) for raw in encoded) / len(items)
+            per_entry = 1_000_000 / (rounds * len(items))
+            self.stdout.write(
+                f"{name:<14}{size:>12.0f}{size / json_size:>9.2f}{encode_time * per_entry:>11.1f}{decode_time * per_entry:>11.1f}"
+            )
+        self.stdout.write(self.style.SUCCESS("Codec benchmark finished!!!"))
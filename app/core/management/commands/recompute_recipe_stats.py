@@ -0,0 +1,61 @@
+"""
+Recompute the stored comment stats of recipes
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery, Count, Sum, Avg, IntegerField, DecimalField
+from django.db.models.functions import Coalesce
+
+from core.models import Recipe, RecipeComment
+
+
+class Command(BaseCommand):
+    """Django command to backfill or repair comment_count, rating_sum and average_rating."""
+
+    help = "Recompute comment_count, rating_sum and average_rating of recipes from comments."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of recipes updated by one UPDATE statement.",
+        )
+        parser.add_argument(
+            "--recipe",
+            type=int,
+            nargs="+",
+            dest="recipe_ids",
+            help="Only recompute the given recipe ids.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        comments = RecipeComment.objects.filter(recipe=OuterRef("pk")).order_by().values("recipe")
+        stats = {
+            "comment_count": Coalesce(
+                Subquery(comments.annotate(value=Count("id")).values("value"), output_field=IntegerField()), 0
+            ),
+            "rating_sum": Coalesce(
+                Subquery(comments.annotate(value=Sum("rating")).values("value"), output_field=IntegerField()), 0
+            ),
+            "average_rating": Subquery(
+                comments.annotate(value=Avg("rating")).values("value"),
+                output_field=DecimalField(max_digits=3, decimal_places=2)
+            ),
+        }
+        recipes = Recipe.objects.order_by("id")
+        if options["recipe_ids"]:
+            recipes = recipes.filter(id__in=options["recipe_ids"])
+
+        batch_size = options["batch_size"]
+        last_id = 0
+        updated = 0
+        while True:
+            batch_ids = list(recipes.filter(id__gt=last_id).values_list("id", flat=True)[:batch_size])
+            if not batch_ids:
+                break
+            updated += Recipe.objects.filter(id__in=batch_ids).update(**stats)
+            last_id = batch_ids[-1]
+            self.stdout.write(f"Recomputed {updated} recipes.....")
+
+        self.stdout.write(self.style.SUCCESS(f"Recipe stats recomputed for {updated} recipes!!!"))
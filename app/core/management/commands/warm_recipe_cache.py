@@ -0,0 +1,49 @@
+"""
+Warm up the redis detail cache of the most viewed recipes
+"""
+from django.core.management.base import BaseCommand
+
+from recipe.tasks import warm_up_recipe_cache
+
+
+class Command(BaseCommand):
+    """Django command to fill the recipe detail cache on deploy, settings default to RECIPE_WARM_UP."""
+
+    help = "Cache detail of the most viewed recipes in redis, chunk by chunk."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            help="Number of recipes to cache, most viewed first.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            help="Number of recipes loaded and written in one chunk.",
+        )
+        parser.add_argument(
+            "--timeout-min",
+            type=int,
+            help="Min seconds before a cached recipe expire.",
+        )
+        parser.add_argument(
+            "--timeout-max",
+            type=int,
+            help="Max seconds before a cached recipe expire.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        stats = warm_up_recipe_cache(
+            limit=options["limit"],
+            chunk_size=options["chunk_size"],
+            timeout_min=options["timeout_min"],
+            timeout_max=options["timeout_max"],
+            on_chunk=lambda stats: self.stdout.write(f"Cached {stats['recipes']} recipes.....")
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Recipe cache warmed up with {stats['recipes']} recipes in {stats['chunks']} chunks, "
+            f"{stats['bytes']} bytes, {stats['serialize_seconds']:.2f}s query and serialize, "
+            f"{stats['write_seconds']:.2f}s redis!!!"
+        ))
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:14
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+POPULATE_SEARCH_VECTOR = """
+UPDATE core_recipe AS r SET search_vector =
+    setweight(to_tsvector('simple', coalesce(r.title, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce((
+        SELECT string_agg(t.name, ' ') FROM core_tag t
+        JOIN core_recipe_tags rt ON rt.tag_id = t.id WHERE rt.recipe_id = r.id
+    ), '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce((
+        SELECT string_agg(i.name, ' ') FROM core_ingredient i
+        JOIN core_recipe_ingredients ri ON ri.ingredient_id = i.id WHERE ri.recipe_id = r.id
+    ), '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(r.description, '')), 'C');
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_notification_title'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='recipe_search_vector_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['title'], name='recipe_title_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.RunSQL(POPULATE_SEARCH_VECTOR, reverse_sql=migrations.RunSQL.noop),
+    ]
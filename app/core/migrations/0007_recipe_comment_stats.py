@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+POPULATE_COMMENT_STATS = """
+UPDATE core_recipe AS r SET
+    comment_count = s.comment_count,
+    rating_sum = s.rating_sum,
+    average_rating = s.average_rating
+FROM (
+    SELECT recipe_id, count(*) AS comment_count, sum(rating) AS rating_sum, avg(rating) AS average_rating
+    FROM core_recipecomment GROUP BY recipe_id
+) AS s
+WHERE s.recipe_id = r.id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_recipe_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='average_rating',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(POPULATE_COMMENT_STATS, reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -3,6 +3,8 @@ Database models.
 """
 from django.conf import settings
 from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
@@ -92,6 +94,24 @@ class Recipe(models.Model):
     likes = models.IntegerField(default=0)
     save_count = models.IntegerField(default=0)
     views = models.IntegerField(default=0)
+    # Comment stats, changed with F() by every comment write, recompute_recipe_stats repair them.
+    comment_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    average_rating = models.DecimalField(max_digits=3, decimal_places=2, null=True, blank=True)
+    # Weighted tsvector over title, description, tag and ingredient names, kept by recipe.search.
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='recipe_search_vector_idx'),
+            GinIndex(fields=['title'], name='recipe_title_trgm_idx', opclasses=['gin_trgm_ops']),
+            # Keyset pagination indexes, (value, id) is the cursor.
+            models.Index(fields=['create_time', 'id'], name='recipe_create_time_id_idx'),
+            models.Index(fields=['views', 'id'], name='recipe_views_id_idx'),
+            models.Index(fields=['likes', 'id'], name='recipe_likes_id_idx'),
+            models.Index(fields=['save_count', 'id'], name='recipe_save_count_id_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
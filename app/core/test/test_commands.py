@@ -2,11 +2,18 @@
 Test for wait for db commands
 """
 
+from io import StringIO
 from unittest.mock import patch
 from psycopg2 import OperationalError as Psycopg2Error
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.utils import OperationalError
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, TestCase
+from django.contrib.auth import get_user_model
+
+from core.models import Recipe, RecipeComment
+from recipe.redis_set import RedisHandler
+from recipe.tasks import redis_client1
 
 
 @patch("core.management.commands.wait_for_db.Command.check")
@@ -32,3 +39,73 @@ class CommandTests(SimpleTestCase):
 
         self.assertEqual(patched_check.call_count, 6)
         patched_check.assert_called_with(databases=["default"])
+
+
+class RecomputeRecipeStatsTests(TestCase):
+    """Test recompute recipe stats command."""
+
+    def test_recompute_recipe_stats(self):
+        """Test stale comment stats are repaired from comments."""
+        user = get_user_model().objects.create(email="test1@example.com", username="test1")
+        recipe = Recipe.objects.create(user=user, title="stats", cost_time="10", description="stats")
+        empty_recipe = Recipe.objects.create(
+            user=user, title="empty", cost_time="10", description="empty", comment_count=3, rating_sum=9
+        )
+        RecipeComment.objects.create(user=user, recipe=recipe, comment="good", rating=5)
+        RecipeComment.objects.create(user=user, recipe=recipe, comment="ok", rating=2)
+
+        call_command("recompute_recipe_stats", "--batch-size", "1")
+
+        recipe.refresh_from_db()
+        empty_recipe.refresh_from_db()
+        self.assertEqual(recipe.comment_count, 2)
+        self.assertEqual(recipe.rating_sum, 7)
+        self.assertEqual(str(recipe.average_rating), "3.50")
+        self.assertEqual(empty_recipe.comment_count, 0)
+        self.assertEqual(empty_recipe.rating_sum, 0)
+        self.assertIsNone(empty_recipe.average_rating)
+
+
+class WarmRecipeCacheTests(TestCase):
+    """Test warm recipe cache command."""
+
+    def test_warm_recipe_cache(self):
+        """Test the most viewed recipes are cached chunk by chunk with expiry in range."""
+        user = get_user_model().objects.create(email="test1@example.com", username="test1")
+        recipes = [
+            Recipe.objects.create(user=user, title=f"warm {views}", cost_time="10", description="warm", views=views)
+            for views in (5, 30, 10)
+        ]
+        handler = RedisHandler(redis_client1)
+        for recipe in recipes:
+            handler.delete_recipe_in_cache(recipe.id)
+            self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        out = StringIO()
+
+        call_command("warm_recipe_cache", "--limit", "2", "--chunk-size", "1", "--timeout-min", "100", "--timeout-max", "200", stdout=out)
+
+        self.assertEqual(handler.get_recipe(recipes[1].id)["title"], "warm 30")
+        self.assertEqual(handler.get_recipe(recipes[2].id)["title"], "warm 10")
+        self.assertIsNone(handler.get_recipe(recipes[0].id))
+        self.assertTrue(100 <= redis_client1.ttl(f"Recipe_payload_{recipes[1].id}") <= 200)
+        self.assertIsNotNone(handler.get_payload(recipes[2].id))
+        self.assertIn("Cached 1 recipes", out.getvalue())
+        self.assertIn("with 2 recipes in 2 chunks", out.getvalue())
+
+
+class BenchmarkRecipeCodecsTests(TestCase):
+    """Test benchmark recipe codecs command."""
+
+    def test_benchmark_recipe_codecs(self):
+        """Test every codec is measured on recipe list data."""
+        user = get_user_model().objects.create(email="test1@example.com", username="test1")
+        Recipe.objects.create(user=user, title="bench", cost_time="10", description="bench " * 40)
+        out = StringIO()
+
+        call_command("benchmark_recipe_codecs", "--rounds", "1", stdout=out)
+
+        self.assertIn("1 recipes, 1 rounds", out.getvalue())
+        self.assertIn("zlib-json", out.getvalue())
+        self.assertIn("Codec benchmark finished", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("benchmark_recipe_codecs", "--codec", "unknown", stdout=out)
@@ -0,0 +1,157 @@
+"""Codecs of recipe list data cached in redis!"""
+
+
+import json
+import logging
+import zlib
+from abc import ABC, abstractmethod
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Plain json is written without tag for old readers, it always start with "{" or "[".
+JSON_STARTS = (b'{', b'[')
+
+
+class Codec(ABC):
+    """
+    Encode cached data to bytes and back.
+    Every encoded value but plain json start with the tag byte of its codec,
+    so values of old and new codec live together while codec is changed.
+    Errors are the exceptions loads raise on a corrupt value.
+    """
+
+    name = None
+    tag = None
+    errors = (ValueError,)
+
+    @abstractmethod
+    def dumps(self, data) -> bytes:
+        """Data to bytes, without tag."""
+
+    @abstractmethod
+    def loads(self, raw: bytes):
+        """Bytes without tag to data."""
+
+    def encode(self, data) -> bytes:
+        return self.tag + self.dumps(data)
+
+
+class JsonCodec(Codec):
+    """Compact utf-8 json, the format before codecs."""
+
+    name = 'json'
+    tag = b''
+
+    def dumps(self, data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, raw):
+        return json.loads(raw.decode('utf-8'))
+
+
+class MsgpackCodec(Codec):
+    """Msgpack, smaller and faster than json, need msgpack installed."""
+
+    name = 'msgpack'
+    tag = b'\x01'
+    errors = (ValueError, msgpack.exceptions.UnpackException) if msgpack is not None else (ValueError,)
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False)
+
+
+class ZlibCodec(Codec):
+    """Output of inner codec compressed by zlib, field names and S3 paths repeat a lot."""
+
+    def __init__(self, inner, tag):
+        self.inner = inner
+        self.name = f'zlib-{inner.name}'
+        self.tag = tag
+        self.errors = (zlib.error, *inner.errors)
+
+    def dumps(self, data):
+        return zlib.compress(self.inner.dumps(data), ZLIB_LEVEL)
+
+    def loads(self, raw):
+        return self.inner.loads(zlib.decompress(raw))
+
+
+class ZstdCodec(Codec):
+    """Output of inner codec compressed by zstd, need zstandard installed."""
+
+    def __init__(self, inner, tag):
+        self.inner = inner
+        self.name = f'zstd-{inner.name}'
+        self.tag = tag
+        self.errors = (zstandard.ZstdError, *inner.errors)
+
+    def dumps(self, data):
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(self.inner.dumps(data))
+
+    def loads(self, raw):
+        return self.inner.loads(zstandard.ZstdDecompressor().decompress(raw))
+
+
+CODECS = {}
+TAGS = {}
+
+
+def register_codec(codec):
+    """Make codec usable by name for write and by tag for read."""
+    if codec.tag and codec.tag[:1] in JSON_STARTS or len(codec.tag) > 1:
+        raise ValueError(f"Tag of codec {codec.name} must be one byte other than json start.")
+    if codec.tag in TAGS and TAGS[codec.tag].name != codec.name:
+        raise ValueError(f"Tag of codec {codec.name} is used by {TAGS[codec.tag].name}.")
+    CODECS[codec.name] = codec
+    TAGS[codec.tag] = codec
+
+
+register_codec(JsonCodec())
+register_codec(ZlibCodec(CODECS['json'], b'\x02'))
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+    register_codec(ZlibCodec(CODECS['msgpack'], b'\x03'))
+if zstandard is not None:
+    register_codec(ZstdCodec(CODECS['json'], b'\x04'))
+    if msgpack is not None:
+        register_codec(ZstdCodec(CODECS['msgpack'], b'\x05'))
+
+
+def get_codec(name):
+    """Codec of name, json when it is unknown or its library is not installed."""
+    codec = CODECS.get(name)
+    if codec is None:
+        logger.warning(f"Codec {name} is not available, use json.")
+        return CODECS['json']
+    return codec
+
+
+def decode(raw: bytes):
+    """Decode value written by any codec, raise ValueError when its codec is not available or value is corrupt."""
+    tag = raw[:1]
+    if tag in JSON_STARTS:
+        codec, body = CODECS['json'], raw
+    else:
+        codec, body = TAGS.get(tag), raw[1:]
+    if codec is None:
+        raise ValueError(f"No codec for tag {tag!r}.")
+    try:
+        return codec.loads(body)
+    except codec.errors as e:
+        raise ValueError(f"Corrupt value of codec {codec.name}: {e}") from e
@@ -3,7 +3,371 @@
 
 import random
 import json
+import hashlib
+import math
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
 from core.models import Recipe
+from .cache_codec import get_codec, decode
+
+# Filters of list use icontains, any name can match a substring of a changed name,
+# so every recipe write bump one global version (field "all") of all cached list pages.
+LIST_CACHE_TIMEOUT = 120
+LIST_VERSION_HASH = 'Recipe_list_version'
+# Result of ZINTERSTORE/ZUNIONSTORE is only kept for paging the same filter.
+INDEX_MATCH_TIMEOUT = 30
+# Ingredients of recipe as sorted uint32 ingredient ids, field is recipe id.
+# Size follow the number of ingredients of recipe, not the biggest ingredient id.
+INGREDIENT_IDS_HASH = 'Recipe_ingredient_ids'
+# Bitsets of the old format, deleted by rebuild.
+INGREDIENT_BITS_HASH = 'Recipe_ingredient_bits'
+# ETag versions: field is recipe id, bumped on every write of recipe except views.
+RECIPE_VERSION_HASH = 'Recipe_etag_version'
+
+# Detail payload: Recipe_payload_{id} hash of the rendered response bytes without counters,
+# the bytes end right before the counters, so counters are spliced in without decode.
+# Gzip variant is the raw deflate of the same bytes ended by a sync flush, with crc and size for the trailer.
+PAYLOAD_COUNTERS = ('likes', 'save_count', 'views')
+PAYLOAD_GZIP_LEVEL = 6
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+# Single flight of detail rebuild: one request hold the lock and rebuild, the others poll for payload.
+DETAIL_LOCK_TIMEOUT = 5
+DETAIL_LOCK_WAIT = 2
+DETAIL_LOCK_POLL = 0.05
+# Probabilistic early refresh (XFetch), refresh happen earlier for the payloads slow to rebuild.
+XFETCH_BETA = 1.0
+
+# Negative cache of recipe ids not found in SQL, Recipe_missing_{id}.
+MISSING_TIMEOUT = 60
+
+# Channel of recipe ids changed, every worker drop them from its local cache.
+LOCAL_INVALIDATE_CHANNEL = 'Recipe_local_invalidate'
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Forward index for facets: {kind}_names hash, field is recipe id and value is json list of names.
+FACET_LIMIT = 20
+FACET_CHUNK = 1000
+# Facets of all recipes read the whole forward index, they are not versioned (any write bump the list version)
+# and live longer, a few minutes stale counts of the full list are fine.
+FACET_ALL_KEY = 'Recipe_facets_all'
+FACET_ALL_TIMEOUT = 600
+
+# Short prefixes match too many names to rank on read, {kind}_suggest_top_{prefix} keep the
+# SUGGEST_TOP_SIZE most popular names of every prefix up to SUGGEST_PREFIX_LENGTH characters.
+# Longer prefixes rank all their names from lexicographic index.
+SUGGEST_PREFIX_LENGTH = 3
+SUGGEST_TOP_SIZE = 100
+
+# Set (or add NX / increase XX) popularity of names and keep top sets of their prefixes in step.
+# ARGV: mode, top size, then name, value, number of its prefix keys; prefix keys follow KEYS[1] in order.
+UPDATE_POPULARITY_SCRIPT = """
+local mode, size, k = ARGV[1], tonumber(ARGV[2]), 2
+for i = 3, #ARGV, 3 do
+    local name, value, n = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2])
+    local score = false
+    if mode == 'incr' then
+        if redis.call('ZSCORE', KEYS[1], name) then
+            score = redis.call('ZINCRBY', KEYS[1], value, name)
+        end
+    else
+        if mode == 'nx' then
+            redis.call('ZADD', KEYS[1], 'NX', value, name)
+        else
+            redis.call('ZADD', KEYS[1], value, name)
+        end
+        score = redis.call('ZSCORE', KEYS[1], name)
+    end
+    if score then
+        for j = k, k + n - 1 do
+            redis.call('ZADD', KEYS[j], score, name)
+            redis.call('ZREMRANGEBYRANK', KEYS[j], 0, -(size + 1))
+        end
+    end
+    k = k + n
+end
+"""
+
+# Searched names of one request buffered for views, longer names can not be a tag or ingredient name.
+SEARCH_VIEWS_MAX_NAMES = 20
+SEARCH_NAME_MAX_LENGTH = 50
+
+# Buffer views only for names in {kind}_popularity, so names sent by client can not grow the hash.
+INCREASE_SEARCH_VIEWS_SCRIPT = """
+local added = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('ZSCORE', KEYS[2], ARGV[i]) then
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+        added = added + 1
+    end
+end
+return added
+"""
+
+# Trending is forward decay: event add weight * e^((now - epoch) / tau) to recipe,
+# so an event is worth half of the same event one half life later.
+# Rescale task move epoch to now before the scores grow too big.
+TRENDING_KEY = 'Recipe_trending'
+TRENDING_EPOCH_KEY = 'Recipe_trending_epoch'
+TRENDING_WEIGHTS = {'views': 1, 'likes': 3, 'save_count': 5}
+TRENDING_HALF_LIFE = 24 * 60 * 60
+TRENDING_TAU = TRENDING_HALF_LIFE / math.log(2)
+TRENDING_SIZE = 1000
+TRENDING_MIN_SCORE = 0.01
+
+# Home feed: Feed_{user_id} and Author_{user_id} are sorted sets of recipe ids scored by create time.
+# Recipes of celebrity (too many followers) are not pushed, feed read them from Author_{user_id}.
+FEED_SIZE = 500
+FEED_CELEBRITY_FOLLOWERS = 1000
+FEED_CELEBRITY_SET = 'Feed_celebrities'
+
+BUMP_TRENDING_SCRIPT = """
+local epoch = redis.call('GET', KEYS[2])
+if not epoch then
+    epoch = ARGV[2]
+    redis.call('SET', KEYS[2], epoch)
+end
+local score = tonumber(ARGV[1]) * math.exp((tonumber(ARGV[2]) - tonumber(epoch)) / tonumber(ARGV[3]))
+return redis.call('ZINCRBY', KEYS[1], string.format('%.17g', score), ARGV[4])
+"""
+
+# Write payload hash with the ETag version of its data, in the same hash so a stale payload keep its old ETag.
+# Version is ARGV[3] when caller read it before loading data, else the version now.
+SET_PAYLOAD_SCRIPT = """
+local version = ARGV[3]
+if version == '' then
+    version = redis.call('HGET', KEYS[2], ARGV[1]) or 0
+end
+redis.call('HSET', KEYS[1], 'version', version, unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# One round trip of a detail view: count the view (and its trending event) if recipe has counters,
+# then read payload, live counters and ETag version.
+VIEW_RECIPE_SCRIPT = """
+if redis.call('EXISTS', KEYS[8]) == 1 then
+    return {false, false, false, false, false, false, false, false, false, false, false, 1}
+end
+local views = false
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1 then
+    views = redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+    local epoch = redis.call('GET', KEYS[7])
+    if not epoch then
+        epoch = ARGV[3]
+        redis.call('SET', KEYS[7], epoch)
+    end
+    local score = tonumber(ARGV[5]) * math.exp((tonumber(ARGV[3]) - tonumber(epoch)) / tonumber(ARGV[4]))
+    redis.call('ZINCRBY', KEYS[6], string.format('%.17g', score), ARGV[1])
+end
+-- Empty field when payload is in local cache of worker.
+local payload = {false, false, false, false, false, false, false}
+if ARGV[2] ~= '' then
+    payload = redis.call('HMGET', KEYS[1], ARGV[2], 'crc', 'size', 'counters', 'expiry', 'delta', 'version')
+end
+return {
+    payload[1], payload[2], payload[3], payload[4], payload[5], payload[6], payload[7], views,
+    redis.call('HGET', KEYS[3], ARGV[1]), redis.call('HGET', KEYS[4], ARGV[1]), redis.call('HGET', KEYS[5], ARGV[1]), 0
+}
+"""
+
+# Like/save counter of recipe with its trending event and ETag version, only if recipe has counter.
+INCREASE_COUNTER_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local value = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if tonumber(ARGV[3]) ~= 0 then
+    local epoch = redis.call('GET', KEYS[3])
+    if not epoch then
+        epoch = ARGV[4]
+        redis.call('SET', KEYS[3], epoch)
+    end
+    local score = tonumber(ARGV[3]) * math.exp((tonumber(ARGV[4]) - tonumber(epoch)) / tonumber(ARGV[5]))
+    redis.call('ZINCRBY', KEYS[2], string.format('%.17g', score), ARGV[1])
+end
+if ARGV[6] == '1' then
+    redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+end
+return value
+"""
+
+# Likes: Recipe_liked_{id} set of user ids who like recipe, with LIKE_SENTINEL so an empty set still exists.
+# Toggles wait in LIKE_PENDING_HASH ({recipe_id}:{user_id} -> 1 like / 0 unlike, last toggle wins) for bulk write to SQL.
+LIKE_SENTINEL = 0
+LIKE_PENDING_HASH = 'Like_pending'
+# Like set of a recipe nobody toggle for a day is dropped, every toggle push the expiry back.
+LIKE_SET_TIMEOUT = 24 * 60 * 60
+LIKE_LOAD_CHUNK = 1000
+
+# Apply toggles of recipe still waiting in pending hash over the like set just loaded from SQL,
+# SQL does not have them yet. Pending value is the state of the last toggle, so applying it again is harmless.
+APPLY_PENDING_LIKES_SCRIPT = """
+local prefix = ARGV[1] .. ':'
+local cursor = '0'
+repeat
+    local page = redis.call('HSCAN', KEYS[2], cursor, 'MATCH', prefix .. '*', 'COUNT', 1000)
+    cursor = page[1]
+    for i = 1, #page[2], 2 do
+        local user_id = string.sub(page[2][i], #prefix + 1)
+        if page[2][i + 1] == '1' then
+            redis.call('SADD', KEYS[1], user_id)
+        else
+            redis.call('SREM', KEYS[1], user_id)
+        end
+    end
+until cursor == '0'
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return redis.call('SCARD', KEYS[1]) - 1
+"""
+
+# Flip like of user in one round trip, with likes counter, trending event and ETag version.
+# Return false when like set or counter is not loaded from SQL yet.
+TOGGLE_LIKE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('HEXISTS', KEYS[2], ARGV[1]) == 0 then
+    return false
+end
+local delta = 1
+if redis.call('SISMEMBER', KEYS[1], ARGV[2]) == 1 then
+    redis.call('SREM', KEYS[1], ARGV[2])
+    delta = -1
+else
+    redis.call('SADD', KEYS[1], ARGV[2])
+end
+local likes = redis.call('HINCRBY', KEYS[2], ARGV[1], delta)
+redis.call('HSET', KEYS[3], ARGV[1] .. ':' .. ARGV[2], delta == 1 and 1 or 0)
+local epoch = redis.call('GET', KEYS[5])
+if not epoch then
+    epoch = ARGV[4]
+    redis.call('SET', KEYS[5], epoch)
+end
+local score = tonumber(ARGV[3]) * delta * math.exp((tonumber(ARGV[4]) - tonumber(epoch)) / tonumber(ARGV[5]))
+redis.call('ZINCRBY', KEYS[4], string.format('%.17g', score), ARGV[1])
+redis.call('HINCRBY', KEYS[6], ARGV[1], 1)
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return {delta, likes}
+"""
+
+RESCALE_TRENDING_SCRIPT = """
+local epoch = redis.call('GET', KEYS[2])
+if epoch then
+    local factor = math.exp((tonumber(epoch) - tonumber(ARGV[1])) / tonumber(ARGV[2]))
+    redis.call('ZUNIONSTORE', KEYS[1], 1, KEYS[1], 'WEIGHTS', string.format('%.17g', factor))
+end
+redis.call('SET', KEYS[2], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[4])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(tonumber(ARGV[3]) + 1))
+return redis.call('ZCARD', KEYS[1])
+"""
+
+
+class LocalCache:
+    """
+    Bounded LRU with TTL in memory of worker, in front of redis for the hottest recipes.
+    Size is capped in entries and bytes. Entries of changed recipes are dropped by message
+    from any worker over pub/sub, TTL cap the staleness when a message is lost.
+    Key is tuple of (kind, recipe id, ...).
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, timeout=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.listener_pid = None
+
+    @classmethod
+    def from_settings(cls):
+        """Local cache from RECIPE_LOCAL_CACHE setting, disabled when setting is missing."""
+        options = getattr(settings, 'RECIPE_LOCAL_CACHE', {})
+        return cls(options.get('MAX_ENTRIES', 0), options.get('MAX_BYTES', 0), options.get('TIMEOUT', 0))
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0 and self.timeout > 0
+
+    def get(self, key):
+        """Value of key, None if missing or expired."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expire_at, _, value = entry
+            if expire_at <= time.monotonic():
+                self._pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size: int):
+        """Add value of size bytes, the least recently used are dropped over the caps."""
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (time.monotonic() + self.timeout, size, value)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def invalidate(self, recipe_ids):
+        """Drop every entry of recipes."""
+        recipe_ids = {int(recipe_id) for recipe_id in recipe_ids}
+        with self.lock:
+            for key in [key for key in self.entries if key[1] in recipe_ids]:
+                self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def listen(self, redis_client):
+        """
+        Subscribe invalidation channel in a daemon thread, once for every process.
+        Worker is forked from master, so entries before fork are dropped.
+        """
+        if not self.enabled or self.listener_pid == os.getpid():
+            return
+        with self.lock:
+            if self.listener_pid == os.getpid():
+                return
+            self.entries.clear()
+            self.size = 0
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{LOCAL_INVALIDATE_CHANNEL: self._on_message})
+                pubsub.run_in_thread(sleep_time=1, daemon=True)
+                self.listener_pid = os.getpid()
+            except Exception as e:
+                print(e)
+
+    def _on_message(self, message):
+        self.invalidate(json.loads(message['data']))
+
+
+local_cache = LocalCache.from_settings()
 
 
 class RedisHandler:
@@ -17,42 +381,367 @@ class RedisHandler:
     recipe_view_set_handler.set_hkey(recipe_id=1,initinal_value=0)
     """
 
-    def __init__(self, redis_client):
+    def __init__(self, redis_client, codec=None):
         """
         Initialize the RedisHandler
 
         :param redis_client: The redis connection pool must. Shoud establish at first.
+        :param codec: Name of codec for cached list data, RECIPE_CACHE_CODEC of settings by default.
+        Data of any codec is read.
         """
         self.redis_client = redis_client
+        self.codec = get_codec(codec or getattr(settings, 'RECIPE_CACHE_CODEC', 'json'))
+        self.local_cache = local_cache
+        # Inside batch, redis_client is the pipeline of batch.
+        self.batching = False
+        self.results = None
+
+    # Script objects of lua sources, registered once and shared by every handler and batch.
+    scripts = {}
 
-    def set_recipe(self,recipe_id: int, data):
+    @contextmanager
+    def batch(self, transaction=False):
+        """
+        Queue the commands of handler methods into one pipeline, executed in one round trip at the end of block.
+        Methods return nothing useful inside block, results of all commands are in results of batch after it.
+        Nothing is sent when block raise. Batch inside batch join the outer one.
+        ex:
+        with recipe_handler.batch() as batch:
+            batch.set_hkey(hkey_name='views', recipe_id=1)
+            batch.del_hkey('likes', 2)
+        batch.results
+
+        :param transaction: Wrap the commands in MULTI/EXEC.
+        """
+        if self.batching:
+            yield self
+            return
+        batch = RedisHandler(self.redis_client.pipeline(transaction=transaction), codec=self.codec.name)
+        batch.batching = True
+        yield batch
+        batch.results = batch.redis_client.execute()
+
+    def _pipeline(self):
+        """Pipeline for the methods with many commands, the pipeline of batch when batching."""
+        return self.redis_client if self.batching else self.redis_client.pipeline(transaction=False)
+
+    def _execute(self, pipe):
+        """Execute pipeline from _pipeline, batch execute its own at the end of block."""
+        return None if self.batching else pipe.execute()
+
+    def _run_script(self, source: str, keys, args):
+        """Run lua script on redis_client, queued in the pipeline of batch when batching."""
+        script = RedisHandler.scripts.get(source)
+        if script is None:
+            script = RedisHandler.scripts[source] = self.redis_client.register_script(source)
+        return script(keys=keys, args=args, client=self.redis_client)
+
+    def set_recipe(self,recipe_id: int, data, delta=0, version=None):
         """
         Cache recipe in redis.
 
         :param recipe_id: The ID of the recipe. Must be an integer.
         :param data: The data to be stored. Must be a dict.
+        :param delta: Seconds spent to build data, for early refresh.
+        :param version: ETag version read before data is loaded, the version at write if None.
         Time of timeout is random set from 25 min to 30 min.
+        Detail is kept only as payload hash, retrieve serve its bytes and batch decode its json.
         """
-        json_data = json.dumps(data)
         timeout = random.randint(1500, 1800)
-        self.redis_client.set(f'Recipe_detail_{recipe_id}',json_data, ex=timeout)
+        self.write_payload(recipe_id, self.payload_mapping(data, timeout, delta), timeout, version)
+        self.invalidate_local(recipe_id)
+
+    def write_payload(self, recipe_id: int, mapping: dict, timeout: int, version=None):
+        """Write payload hash with its ETag version in one script, queued in pipeline of batch when batching."""
+        self._run_script(
+            SET_PAYLOAD_SCRIPT,
+            keys=[f'Recipe_payload_{recipe_id}', RECIPE_VERSION_HASH],
+            args=[recipe_id, timeout, '' if version is None else version, *[item for pair in mapping.items() for item in pair]],
+        )
+
+    def invalidate_local(self, *recipe_ids):
+        """Drop recipes from local cache of this worker now, and of the other workers by pub/sub."""
+        if not self.local_cache.enabled or not recipe_ids:
+            return
+        self.local_cache.invalidate(recipe_ids)
+        self.redis_client.publish(LOCAL_INVALIDATE_CHANNEL, json.dumps([int(recipe_id) for recipe_id in recipe_ids]))
 
     def get_recipe(self, recipe_id):
         """
-        Get recipe in redis.
+        Get recipe in redis, from its payload with the counters cached with it. No view is counted.
 
         :param recipe_id: The ID of the recipe. Must be an integer.
         :return: The data associated with the recipe, if exists.
         """
-        data = self.redis_client.get(f'Recipe_detail_{recipe_id}')
-
-        if data:
+        payload = self.get_payload(recipe_id)
+        if payload:
             try:
-                return json.loads(data.decode('utf-8'))
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON for Recipe_{recipe_id}: {e}")
+                return self.payload_data(payload)
+            except ValueError as e:
+                print(f"Error decoding Recipe_{recipe_id}: {e}")
                 return None
 
+    @staticmethod
+    def build_payload(data):
+        """
+        Render recipe detail to the bytes of response, the counters are left out for splice.
+        Same output as JSONRenderer of DRF: compact and utf-8.
+
+        :return: Mapping of payload hash.
+        """
+        static = {key: value for key, value in data.items() if key not in PAYLOAD_COUNTERS}
+        # Drop the closing "}}", counters and the closing are added on serve.
+        body = json.dumps({'recipe': static}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')[:-2]
+        compressor = zlib.compressobj(PAYLOAD_GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return {
+            'json': body,
+            'gzip': compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH),
+            'crc': zlib.crc32(body),
+            'size': len(body),
+            'counters': json.dumps({name: data.get(name, 0) for name in PAYLOAD_COUNTERS}),
+        }
+
+    def payload_mapping(self, data, timeout, delta=0):
+        """Payload hash with expiry and rebuild time for early refresh."""
+        return {**self.build_payload(data), 'expiry': time.time() + timeout, 'delta': delta}
+
+    @staticmethod
+    def payload_data(payload, counters=None):
+        """Recipe detail dict from json payload, with live counters over the cached ones."""
+        data = json.loads(payload['body'] + b'}}')['recipe']
+        data.update(RedisHandler.live_counters(payload['counters'], counters or {}))
+        return data
+
+    @staticmethod
+    def _payload(body, crc, size, counters, expiry, delta, version=None):
+        """Payload dict from fields of payload hash, None if not cached. Version is None for payload before versions."""
+        if body is None:
+            return None
+        return {
+            'body': body, 'crc': int(crc), 'size': int(size), 'counters': json.loads(counters),
+            'expiry': float(expiry or 0), 'delta': float(delta or 0),
+            'version': None if version is None else int(version),
+        }
+
+    def get_payload(self, recipe_id: int, gzip=False):
+        """
+        Get cached detail payload of recipe, no view is counted.
+
+        :return: Payload dict, None if not cached.
+        """
+        return self._payload(*self.redis_client.hmget(
+            f'Recipe_payload_{recipe_id}', 'gzip' if gzip else 'json', 'crc', 'size', 'counters', 'expiry', 'delta', 'version'
+        ))
+
+    @staticmethod
+    def should_refresh_early(payload, beta=XFETCH_BETA):
+        """
+        XFetch: refresh before expiry with a chance grow when expiry is near and rebuild is slow,
+        so a hot payload is rebuilt by one request before it expire for all.
+        """
+        if not payload['expiry']:
+            return False
+        return time.time() - payload['delta'] * beta * math.log(1.0 - random.random()) >= payload['expiry']
+
+    def acquire_lock(self, name: str, timeout=DETAIL_LOCK_TIMEOUT):
+        """
+        Short lock with SET NX, expire by itself when holder die.
+
+        :return: Token for release_lock, None if lock is hold by other.
+        """
+        token = hashlib.sha1(f"{time.time()}{random.random()}".encode('utf-8')).hexdigest()
+        if self.redis_client.set(f"Lock_{name}", token, nx=True, ex=timeout):
+            return token
+        return None
+
+    def release_lock(self, name: str, token):
+        """Release lock only if it is still hold by token."""
+        self._run_script(RELEASE_LOCK_SCRIPT, keys=[f"Lock_{name}"], args=[token])
+
+    def wait_for_payload(self, recipe_id: int, lock: str, gzip=False, wait=DETAIL_LOCK_WAIT):
+        """
+        Poll payload rebuilt by the lock holder.
+        Stop when payload is cached, or lock is released or expired without payload.
+
+        :param lock: Name of lock hold by the rebuilding request.
+        :return: Payload dict, None if it is not rebuilt.
+        """
+        deadline = time.time() + wait
+        while time.time() < deadline:
+            time.sleep(DETAIL_LOCK_POLL)
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.hmget(f'Recipe_payload_{recipe_id}', 'gzip' if gzip else 'json', 'crc', 'size', 'counters', 'expiry', 'delta', 'version')
+            pipe.exists(f"Lock_{lock}")
+            values, locked = pipe.execute()
+            payload = self._payload(*values)
+            if payload is not None or not locked:
+                return payload
+        return None
+
+    def view_recipe(self, recipe_id: int, gzip=False):
+        """
+        Count a view of recipe and read what detail need, in one script call.
+        Static detail is never written by a view, recipe in negative cache is not counted.
+
+        :param gzip: Read the deflated payload instead of the plain one.
+        :return: Tuple of payload (None if not cached), live counters (None if not in hash), live ETag version
+            and whether recipe is known to not exist. ETag of payload use the version in payload.
+        """
+        self.local_cache.listen(self.redis_client)
+        local_key = ('payload', recipe_id, gzip)
+        local_payload = self.local_cache.get(local_key)
+        body, crc, size, counters, expiry, delta, payload_version, views, likes, save_count, version, missing = self._run_script(
+            VIEW_RECIPE_SCRIPT,
+            keys=[
+                f'Recipe_payload_{recipe_id}', 'Recipe_views', 'Recipe_likes', 'Recipe_save_count',
+                RECIPE_VERSION_HASH, TRENDING_KEY, TRENDING_EPOCH_KEY, f'Recipe_missing_{recipe_id}'
+            ],
+            args=[
+                recipe_id, '' if local_payload else 'gzip' if gzip else 'json',
+                time.time(), TRENDING_TAU, TRENDING_WEIGHTS['views']
+            ],
+        )
+        payload = local_payload or self._payload(body, crc, size, counters, expiry, delta, payload_version)
+        if payload is not None and local_payload is None:
+            self.local_cache.set(local_key, payload, len(payload['body']))
+        live = {'views': views, 'likes': likes, 'save_count': save_count}
+        counters = {name: None if value is None else int(value) for name, value in live.items()}
+        return payload, counters, int(version or 0), bool(missing)
+
+    def set_missing(self, *recipe_ids):
+        """Remember recipes not found in SQL for a short time, so repeated misses do not reach SQL."""
+        pipe = self._pipeline()
+        for recipe_id in recipe_ids:
+            pipe.set(f'Recipe_missing_{recipe_id}', 1, ex=MISSING_TIMEOUT)
+        self._execute(pipe)
+
+    def clear_missing(self, *recipe_ids):
+        """Forget recipes in negative cache, call it when recipe is created."""
+        if recipe_ids:
+            self.redis_client.delete(*[f'Recipe_missing_{recipe_id}' for recipe_id in recipe_ids])
+
+    def get_missing(self, recipe_ids):
+        """Recipes in negative cache, in one MGET."""
+        if not recipe_ids:
+            return set()
+        values = self.redis_client.mget([f'Recipe_missing_{recipe_id}' for recipe_id in recipe_ids])
+        return {recipe_id for recipe_id, value in zip(recipe_ids, values) if value}
+
+    @staticmethod
+    def _merge_counters(recipe_ids, counter_values):
+        """Counters dict of every recipe from HMGET results in PAYLOAD_COUNTERS order."""
+        counters = {recipe_id: {} for recipe_id in recipe_ids}
+        for name, values in zip(PAYLOAD_COUNTERS, counter_values):
+            for recipe_id, value in zip(recipe_ids, values):
+                if value is not None:
+                    counters[recipe_id][name] = int(value)
+        return counters
+
+    @staticmethod
+    def live_counters(cached, counters):
+        """Live counter value, or the cached one when recipe is not in counter hash."""
+        return {
+            name: counters[name] if counters.get(name) is not None else cached.get(name) or 0
+            for name in PAYLOAD_COUNTERS
+        }
+
+    @staticmethod
+    def splice_payload(payload, counters, gzip=False):
+        """
+        Splice live counters into cached payload, the cached bytes are never decoded.
+        For gzip only the few bytes of counters are deflated, crc is continued from the cached one.
+
+        :param counters: Dict of counter name and value, missing one use value cached with payload.
+        """
+        live = RedisHandler.live_counters(payload['counters'], counters)
+        tail = ("," + ",".join(f'"{name}":{int(live[name])}' for name in PAYLOAD_COUNTERS) + "}}").encode('utf-8')
+        if not gzip:
+            return payload['body'] + tail
+        compressor = zlib.compressobj(1, zlib.DEFLATED, -zlib.MAX_WBITS)
+        trailer = struct.pack('<II', zlib.crc32(tail, payload['crc']), (payload['size'] + len(tail)) & 0xffffffff)
+        return GZIP_HEADER + payload['body'] + compressor.compress(tail) + compressor.flush() + trailer
+
+    def bump_recipe_version(self, *recipe_ids):
+        """Change ETag of recipes, call it on every write of recipe, comment, like and save."""
+        pipe = self._pipeline()
+        for recipe_id in recipe_ids:
+            pipe.hincrby(RECIPE_VERSION_HASH, recipe_id, 1)
+        self._execute(pipe)
+
+    def get_recipe_versions(self, recipe_ids):
+        """ETag versions of recipes in one HMGET, 0 for never changed."""
+        if not recipe_ids:
+            return []
+        return [int(version or 0) for version in self.redis_client.hmget(RECIPE_VERSION_HASH, recipe_ids)]
+
+    def get_detail_versions(self, recipe_id: int):
+        """Version of the cached payload (None if not cached) and the live ETag version of recipe, in one pipeline."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hget(f'Recipe_payload_{recipe_id}', 'version')
+        pipe.hget(RECIPE_VERSION_HASH, recipe_id)
+        payload_version, version = pipe.execute()
+        return None if payload_version is None else int(payload_version), int(version or 0)
+
+    def bump_collection_version(self, kind: str):
+        """Change ETag of tag or ingredient list."""
+        self.redis_client.incr(f"{kind}_version")
+
+    def get_collection_version(self, kind: str):
+        """ETag version of tag or ingredient list."""
+        return int(self.redis_client.get(f"{kind}_version") or 0)
+
+    def get_recipes(self, recipe_ids):
+        """
+        Get cached detail of recipes with live counters, json of payloads and counter HMGETs in one pipeline.
+
+        :return: Dict of recipe id and data, missing recipe is not in dict.
+        """
+        return self.get_recipes_with_counters(recipe_ids)[0]
+
+    def get_recipes_with_counters(self, recipe_ids):
+        """
+        Same as get_recipes, with the live counters of every recipe for the ones loaded from SQL after.
+
+        :return: Tuple of dict of recipe id and data, and dict of recipe id and its counters in redis.
+        """
+        if not recipe_ids:
+            return {}, {}
+        pipe = self.redis_client.pipeline(transaction=False)
+        for recipe_id in recipe_ids:
+            pipe.hmget(f'Recipe_payload_{recipe_id}', 'json', 'counters')
+        for name in PAYLOAD_COUNTERS:
+            pipe.hmget(f'Recipe_{name}', recipe_ids)
+        results = pipe.execute()
+        counters = self._merge_counters(recipe_ids, results[len(recipe_ids):])
+        recipes = {}
+        for recipe_id, (body, cached) in zip(recipe_ids, results[:len(recipe_ids)]):
+            if body is not None:
+                try:
+                    recipes[recipe_id] = self.payload_data({'body': body, 'counters': json.loads(cached)}, counters[recipe_id])
+                except ValueError as e:
+                    print(f"Error decoding Recipe_{recipe_id}: {e}")
+        return recipes, counters
+
+    def set_recipes(self, items, timeout_min=1500, timeout_max=1800, versions=None):
+        """
+        Cache detail of recipes in one pipeline.
+        Time of timeout is random set from 25 min to 30 min by default, so keys do not expire together.
+
+        :param items: The detail data of recipes, must have id.
+        :param versions: Dict of recipe id and ETag version read before items are loaded, the version at write if missing.
+        :return: Bytes of payload written.
+        """
+        versions = versions or {}
+        written = 0
+        with self.batch() as batch:
+            for item in items:
+                timeout = random.randint(timeout_min, timeout_max)
+                mapping = self.payload_mapping(item, timeout)
+                batch.write_payload(item['id'], mapping, timeout, versions.get(item['id']))
+                written += len(mapping['json']) + len(mapping['gzip'])
+        self.invalidate_local(*[item['id'] for item in items])
+        return written
+
     def update_recipe_in_cache(self, recipe_id):
         """
         Update recipe data in cahce
@@ -62,6 +751,9 @@ class RedisHandler:
         serializer_recipe = serializers.RecipeSQLDetailSerializer(recipe)
         print(serializer_recipe.data)
         self.set_recipe(recipe_id=recipe_id, data=serializer_recipe.data)
+        # Comment count and rating in list data are changed.
+        self.redis_client.delete(f'Recipe_list_item_{recipe_id}')
+        self.bump_recipe_version(recipe_id)
 
     def delete_recipe_in_cache(self, recipe_id):
         """
@@ -69,7 +761,515 @@ class RedisHandler:
 
         :param recipe_id: The ID of the recipe. Must be an integer.
         """
-        self.redis_client.delete(f'Recipe_detail_{recipe_id}')
+        self.redis_client.delete(
+            f'Recipe_payload_{recipe_id}', f'Recipe_list_item_{recipe_id}', f'Recipe_liked_{recipe_id}'
+        )
+        self.invalidate_local(recipe_id)
+
+    def bump_list_version(self):
+        """
+        Invalidate all cached list pages and facets.
+        Call it on every recipe create, update and delete, and on every tag or ingredient change.
+        """
+        self.redis_client.hincrby(LIST_VERSION_HASH, 'all', 1)
+
+    def list_cache_key(self, filters: dict, page_params: dict, prefix='Recipe_list'):
+        """
+        Key of cached list page, the current list version is part of key.
+
+        :param filters: Dict of kind (tag, ingredient, user) and list of filter names.
+        :param page_params: Other params decide the page. ex: page, cursor, ordering, q.
+        :param prefix: Prefix of key, other data of same filter use its own prefix. ex: Recipe_facets
+        """
+        # icontains is case insensitive and filter names are ORed, so case and order do not change the page.
+        normalized = {kind: sorted({name.lower() for name in names}) for kind, names in filters.items() if names}
+        raw = json.dumps({
+            'filters': normalized,
+            'page': {k: v for k, v in page_params.items() if v is not None},
+            'version': int(self.redis_client.hget(LIST_VERSION_HASH, 'all') or 0),
+        }, sort_keys=True)
+        return f"{prefix}_{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+    def get_list_page(self, cache_key: str):
+        """
+        Get cached list page.
+
+        :return: Dict with ordered recipe ids and pagination meta, if exists.
+        """
+        data = self.redis_client.get(cache_key)
+        if data:
+            try:
+                return json.loads(data.decode('utf-8'))
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON for {cache_key}: {e}")
+                return None
+
+    def set_list_page(self, cache_key: str, ids, meta: dict):
+        """
+        Cache list page as ordered recipe ids, recipe data is kept by set_list_items.
+
+        :param ids: The ordered recipe ids of page.
+        :param meta: Pagination data except results. ex: count, next, previous.
+        """
+        self.redis_client.set(cache_key, json.dumps({'ids': list(ids), 'meta': meta}), ex=LIST_CACHE_TIMEOUT)
+
+    def get_facets(self, cache_key: str):
+        """Get cached facets of filter."""
+        data = self.redis_client.get(cache_key)
+        if data:
+            return json.loads(data.decode('utf-8'))
+
+    def set_facets(self, cache_key: str, facets: dict, timeout=LIST_CACHE_TIMEOUT):
+        """Cache facets of filter, invalidated by list versions like list page."""
+        self.redis_client.set(cache_key, json.dumps(facets), ex=timeout)
+
+    def set_facet_names(self, kind: str, recipe_id: int, names):
+        """
+        Keep the tag or ingredient names of recipe for facets.
+
+        :param kind: Tag or Ingredient. Must be an str.
+        :param names: All names of kind of recipe.
+        """
+        self.redis_client.hset(f"{kind}_names", recipe_id, json.dumps(sorted(set(names))))
+
+    def count_facets(self, recipe_ids):
+        """
+        Count recipes of every tag and ingredient in one pass over the forward index.
+
+        :param recipe_ids: The IDs of all recipes match the filter.
+        :return: Dict of tags and ingredients, each a list of name and count, the most first.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for kind in ("Tag", "Ingredient"):
+            for start in range(0, len(recipe_ids), FACET_CHUNK):
+                pipe.hmget(f"{kind}_names", recipe_ids[start:start + FACET_CHUNK])
+        results = iter(pipe.execute())
+        facets = {}
+        for kind, facet_name in (("Tag", "tags"), ("Ingredient", "ingredients")):
+            counter = Counter()
+            for start in range(0, len(recipe_ids), FACET_CHUNK):
+                for value in next(results):
+                    if value:
+                        counter.update(json.loads(value))
+            facets[facet_name] = [
+                {'name': name, 'count': count}
+                for name, count in sorted(counter.items(), key=lambda item: (-item[1], item[0]))[:FACET_LIMIT]
+            ]
+        return facets
+
+    def get_list_items(self, recipe_ids):
+        """
+        Get list data of recipes in one MGET.
+
+        :return: Dict of recipe id and data, missing recipe is not in dict.
+        """
+        if not recipe_ids:
+            return {}
+        values = self.redis_client.mget([f'Recipe_list_item_{recipe_id}' for recipe_id in recipe_ids])
+        items = {}
+        for recipe_id, value in zip(recipe_ids, values):
+            if value:
+                try:
+                    items[recipe_id] = decode(value)
+                except ValueError as e:
+                    print(f"Error decoding Recipe_list_item_{recipe_id}: {e}")
+        return items
+
+    def set_list_items(self, items):
+        """
+        Cache list data of recipes in one pipeline.
+        Time of timeout is random set from 25 min to 30 min.
+
+        :param items: The list data of recipes, must have id.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for item in items:
+            pipe.set(f"Recipe_list_item_{item['id']}", self.codec.encode(item), ex=random.randint(1500, 1800))
+        pipe.execute()
+
+    @staticmethod
+    def index_key(kind: str, name: str):
+        """Key of inverted index of tag or ingredient name, name is case insensitive like list filters."""
+        return f"{kind}_index_{name.lower()}"
+
+    def add_to_index(self, kind: str, names, recipe):
+        """
+        Add recipe to the inverted index of tags or ingredients.
+        Index is a sorted set of recipe ids for every name, scored by create time of recipe.
+
+        :param kind: Tag or Ingredient. Must be an str.
+        :param names: The names of tags or ingredients of recipe.
+        :param recipe: The recipe instance.
+        """
+        score = recipe.create_time.timestamp()
+        pipe = self.redis_client.pipeline(transaction=False)
+        for name in names:
+            pipe.zadd(self.index_key(kind, name), {recipe.id: score})
+        pipe.execute()
+
+    def remove_from_index(self, kind: str, names, recipe_id: int):
+        """
+        Remove recipe from the inverted index of tags or ingredients.
+
+        :param kind: Tag or Ingredient. Must be an str.
+        :param names: The names of tags or ingredients removed from recipe.
+        :param recipe_id: The ID of the recipe. Must be an integer.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for name in names:
+            pipe.zrem(self.index_key(kind, name), recipe_id)
+        pipe.execute()
+
+    def rebuild_index(self, kind: str, entries):
+        """
+        Replace the inverted index and the forward index for facets of tags or ingredients.
+
+        :param kind: Tag or Ingredient. Must be an str.
+        :param entries: Iterable of (name, recipe id, create time of recipe).
+        """
+        index, names = {}, {}
+        for name, recipe_id, create_time in entries:
+            index.setdefault(self.index_key(kind, name), {})[recipe_id] = create_time.timestamp()
+            names.setdefault(recipe_id, set()).add(name)
+        pipe = self.redis_client.pipeline(transaction=True)
+        for key in self.redis_client.scan_iter(f"{kind}_index_*"):
+            if key.decode('utf-8') not in index:
+                pipe.delete(key)
+        for key, members in index.items():
+            pipe.delete(key)
+            pipe.zadd(key, members)
+        pipe.delete(f"{kind}_names")
+        if names:
+            pipe.hset(f"{kind}_names", mapping={
+                recipe_id: json.dumps(sorted(recipe_names)) for recipe_id, recipe_names in names.items()
+            })
+        pipe.execute()
+
+    @staticmethod
+    def pack_ids(ingredient_ids):
+        """Sorted ingredient ids to little endian uint32 bytes to store in redis."""
+        ids = sorted(set(ingredient_ids))
+        return struct.pack(f'<{len(ids)}I', *ids)
+
+    def set_ingredient_ids(self, recipe_id: int, ingredient_ids):
+        """
+        Keep the ingredient ids of recipe for pantry matching.
+
+        :param recipe_id: The ID of the recipe. Must be an integer.
+        :param ingredient_ids: All ingredient ids of recipe.
+        """
+        self.redis_client.hset(INGREDIENT_IDS_HASH, recipe_id, self.pack_ids(ingredient_ids))
+
+    def set_many_ingredient_ids(self, ingredient_ids: dict):
+        """Keep the ingredient ids of many recipes in one HSET, dict of recipe id and ingredient ids."""
+        if ingredient_ids:
+            self.redis_client.hset(INGREDIENT_IDS_HASH, mapping={
+                recipe_id: self.pack_ids(ids) for recipe_id, ids in ingredient_ids.items()
+            })
+
+    def del_ingredient_ids(self, recipe_id: int):
+        """Delete the ingredient ids of deleted recipe."""
+        self.redis_client.hdel(INGREDIENT_IDS_HASH, recipe_id)
+
+    def get_ingredient_ids(self, recipe_ids):
+        """
+        Get ingredient ids of recipes in one HMGET.
+
+        :return: Dict of recipe id and frozenset of ingredient ids, recipe not in redis is not in dict.
+        """
+        if not recipe_ids:
+            return {}
+        values = self.redis_client.hmget(INGREDIENT_IDS_HASH, recipe_ids)
+        return {
+            int(recipe_id): frozenset(struct.unpack(f'<{len(value) // 4}I', value))
+            for recipe_id, value in zip(recipe_ids, values) if value is not None
+        }
+
+    def rebuild_ingredient_ids(self, entries, chunk_size=1000):
+        """
+        Replace the ingredient ids of all recipes.
+
+        :param entries: Iterable of (recipe id, ingredient id), recipe without ingredient get empty ids.
+        """
+        ids = {}
+        for recipe_id, ingredient_id in entries:
+            ids.setdefault(recipe_id, [])
+            if ingredient_id is not None:
+                ids[recipe_id].append(ingredient_id)
+        packed = [(recipe_id, self.pack_ids(value)) for recipe_id, value in ids.items()]
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(INGREDIENT_IDS_HASH, INGREDIENT_BITS_HASH)
+        for start in range(0, len(packed), chunk_size):
+            pipe.hset(INGREDIENT_IDS_HASH, mapping=dict(packed[start:start + chunk_size]))
+        pipe.execute()
+
+    def union_recipe_ids(self, keys):
+        """
+        Recipe ids in any of the index keys, without storing the result.
+        Return None when a key is not in redis, the caller read SQL instead.
+        """
+        if not keys:
+            return []
+        keys = sorted(set(keys))
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.exists(*keys)
+        pipe.zunion(keys)
+        exists, recipe_ids = pipe.execute()
+        if exists < len(keys):
+            return None
+        return [int(recipe_id) for recipe_id in recipe_ids]
+
+    def match_recipe_ids(self, keys, match: str, start: int, stop: int):
+        """
+        Filter recipes by set algebra over the inverted index, and get one page of them.
+
+        :param keys: The index keys from index_key. ex: ["Tag_index_dinner", "Ingredient_index_egg"]
+        :param match: all (ZINTERSTORE) or any (ZUNIONSTORE).
+        :param start: Start rank of page.
+        :param stop: Stop rank of page, inclusive.
+        :return: Total number of matched recipes and recipe ids of page ordered by create time,
+        None when a key is not in redis (name of no recipe, or evicted), the caller read SQL instead.
+        """
+        keys = sorted(set(keys))
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.exists(*keys)
+        if len(keys) == 1:
+            result_key = keys[0]
+        else:
+            result_key = f"Recipe_match_{match}_{hashlib.sha1(json.dumps(keys).encode('utf-8')).hexdigest()}"
+            if match == 'all':
+                pipe.zinterstore(result_key, keys, aggregate='MIN')
+            else:
+                pipe.zunionstore(result_key, keys, aggregate='MIN')
+            pipe.expire(result_key, INDEX_MATCH_TIMEOUT)
+        pipe.zcard(result_key)
+        pipe.zrange(result_key, start, stop)
+        results = pipe.execute()
+        if results[0] < len(keys):
+            return None
+        return results[-2], [int(recipe_id) for recipe_id in results[-1]]
+
+    @staticmethod
+    def suggest_member(name: str):
+        """Member of lexicographic index, lower case name for prefix match and the real name."""
+        return f"{name.lower()}\x00{name}"
+
+    @staticmethod
+    def suggest_prefixes(name: str):
+        """Prefixes of name which have a top set, lower case."""
+        name = name.lower()
+        return [name[:length] for length in range(1, min(len(name), SUGGEST_PREFIX_LENGTH) + 1)]
+
+    def update_popularity(self, kind: str, values: dict, mode='set'):
+        """
+        Write popularity of names with the top sets of their prefixes in one script.
+
+        :param values: Dict of name and popularity (increment value if mode is incr).
+        :param mode: set, nx (keep the old popularity) or incr (only names already in autocomplete).
+        """
+        if not values:
+            return
+        keys, args = [f"{kind}_popularity"], [mode, SUGGEST_TOP_SIZE]
+        for name, value in values.items():
+            prefixes = self.suggest_prefixes(name)
+            keys.extend(f"{kind}_suggest_top_{prefix}" for prefix in prefixes)
+            args.extend([name, value, len(prefixes)])
+        self._run_script(UPDATE_POPULARITY_SCRIPT, keys=keys, args=args)
+
+    def add_suggestion(self, kind: str, name: str, popularity=None):
+        """
+        Add tag or ingredient name to autocomplete.
+        Names are in sorted set {kind}_suggest with same score for ZRANGEBYLEX,
+        popularity (views + save_count) is in sorted set {kind}_popularity.
+
+        :param kind: Tag or Ingredient. Must be an str.
+        :param popularity: Popularity of name, keep the old one if None.
+        """
+        self.redis_client.zadd(f"{kind}_suggest", {self.suggest_member(name): 0})
+        if popularity is None:
+            self.update_popularity(kind, {name: 0}, mode='nx')
+        else:
+            self.update_popularity(kind, {name: popularity})
+
+    def remove_suggestion(self, kind: str, name: str):
+        """
+        Remove tag or ingredient name from autocomplete.
+        A name below the top sets does not move up to the free place until rebuild_suggestions.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zrem(f"{kind}_suggest", self.suggest_member(name))
+        pipe.zrem(f"{kind}_popularity", name)
+        for prefix in self.suggest_prefixes(name):
+            pipe.zrem(f"{kind}_suggest_top_{prefix}", name)
+        pipe.execute()
+
+    def increase_popularity(self, kind: str, increments: dict):
+        """
+        Increase popularity of names already in autocomplete.
+
+        :param increments: Dict of name and increment value.
+        """
+        self.update_popularity(kind, increments, mode='incr')
+
+    def rebuild_suggestions(self, kind: str, entries):
+        """
+        Replace the autocomplete index of tags or ingredients with its top sets.
+
+        :param entries: Iterable of (name, popularity).
+        """
+        members, popularity = {}, {}
+        for name, value in entries:
+            members[self.suggest_member(name)] = 0
+            popularity[name] = max(value, popularity.get(name, value))
+        tops = {}
+        for name, value in popularity.items():
+            for prefix in self.suggest_prefixes(name):
+                tops.setdefault(prefix, []).append((name, value))
+        old_keys = set(self.redis_client.scan_iter(match=f"{kind}_suggest_top_*", count=1000))
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(f"{kind}_suggest", f"{kind}_popularity", *old_keys)
+        if members:
+            pipe.zadd(f"{kind}_suggest", members)
+            pipe.zadd(f"{kind}_popularity", popularity)
+        for prefix, names in tops.items():
+            names.sort(key=lambda item: (-item[1], item[0]))
+            pipe.zadd(f"{kind}_suggest_top_{prefix}", dict(names[:SUGGEST_TOP_SIZE]))
+        pipe.execute()
+
+    def suggest(self, kind: str, prefix: str, limit: int):
+        """
+        Names start with prefix (case insensitive), the most popular first.
+
+        :return: List of (name, popularity).
+        """
+        prefix = prefix.lower()
+        if len(prefix) <= SUGGEST_PREFIX_LENGTH and limit <= SUGGEST_TOP_SIZE:
+            ranked = [
+                (name.decode('utf-8'), score)
+                for name, score in self.redis_client.zrange(f"{kind}_suggest_top_{prefix}", 0, -1, withscores=True)
+            ]
+        else:
+            raw = prefix.encode('utf-8')
+            members = self.redis_client.zrangebylex(f"{kind}_suggest", b"[" + raw, b"[" + raw + b"\xff")
+            if not members:
+                return []
+            names = [member.split(b"\x00", 1)[1].decode('utf-8') for member in members]
+            scores = self.redis_client.zmscore(f"{kind}_popularity", names)
+            ranked = zip(names, [score or 0 for score in scores])
+        ranked = sorted(ranked, key=lambda item: (-item[1], item[0]))
+        return [(name, int(score)) for name, score in ranked[:limit]]
+
+    def bump_trending(self, recipe_id: int, weight):
+        """
+        Add a decayed event to trending score of recipe, in one atomic script with the epoch.
+
+        :param recipe_id: The ID of the recipe. Must be an integer.
+        :param weight: Weight of event, negative for revoked like or save.
+        """
+        self._run_script(
+            BUMP_TRENDING_SCRIPT,
+            keys=[TRENDING_KEY, TRENDING_EPOCH_KEY],
+            args=[weight, time.time(), TRENDING_TAU, recipe_id]
+        )
+
+    def rescale_trending(self):
+        """
+        Move epoch to now and scale all scores to it, drop the decayed recipes and keep top TRENDING_SIZE.
+
+        :return: Number of recipes in trending.
+        """
+        return self._run_script(
+            RESCALE_TRENDING_SCRIPT,
+            keys=[TRENDING_KEY, TRENDING_EPOCH_KEY],
+            args=[time.time(), TRENDING_TAU, TRENDING_SIZE, TRENDING_MIN_SCORE]
+        )
+
+    def get_trending(self, start: int, stop: int):
+        """
+        One page of trending recipes, the hottest first.
+
+        :return: Total number of trending recipes and recipe ids of page.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zcard(TRENDING_KEY)
+        pipe.zrevrange(TRENDING_KEY, start, stop)
+        count, ids = pipe.execute()
+        return count, [int(recipe_id) for recipe_id in ids]
+
+    def push_to_feeds(self, user_ids, recipes: dict):
+        """
+        Push recipes to feeds of users, every feed keep the newest FEED_SIZE recipes.
+
+        :param user_ids: The IDs of followers.
+        :param recipes: Dict of recipe id and create timestamp.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zadd(f"Feed_{user_id}", recipes)
+            pipe.zremrangebyrank(f"Feed_{user_id}", 0, -(FEED_SIZE + 1))
+        pipe.execute()
+
+    def add_to_author_timeline(self, author_id: int, recipe_id: int, score):
+        """Keep the newest FEED_SIZE recipes of author, feed read it when author is celebrity."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zadd(f"Author_{author_id}", {recipe_id: score})
+        pipe.zremrangebyrank(f"Author_{author_id}", 0, -(FEED_SIZE + 1))
+        pipe.execute()
+
+    def remove_from_feed(self, user_id: int, recipe_ids):
+        """Remove recipes from feed of user. ex: unfollow the author."""
+        if recipe_ids:
+            self.redis_client.zrem(f"Feed_{user_id}", *recipe_ids)
+
+    def set_celebrity(self, author_id: int, is_celebrity: bool):
+        """Mark author as celebrity to switch to fan out on read."""
+        if is_celebrity:
+            self.redis_client.sadd(FEED_CELEBRITY_SET, author_id)
+        else:
+            self.redis_client.srem(FEED_CELEBRITY_SET, author_id)
+
+    def filter_celebrities(self, user_ids):
+        """The celebrities in user ids, in one SMISMEMBER."""
+        if not user_ids:
+            return []
+        flags = self.redis_client.smismember(FEED_CELEBRITY_SET, user_ids)
+        return [user_id for user_id, flag in zip(user_ids, flags) if flag]
+
+    def get_feed(self, user_id: int, celebrity_ids, cursor, count: int):
+        """
+        Newest recipes of feed after cursor, merged with timelines of followed celebrities.
+
+        :param cursor: (score, recipe id) of the last recipe of previous page, None for the newest.
+        Recipe id is None for old cursors with score only, read as exclusive max score.
+        :param count: Number of recipes.
+        :return: List of (recipe id, score), the newest first and bigger id first for same score.
+        """
+        keys = [f"Feed_{user_id}"] + [f"Author_{author_id}" for author_id in celebrity_ids]
+        max_value, ties = "+inf", [0] * len(keys)
+        if cursor is not None:
+            max_score, max_id = cursor
+            if max_id is None:
+                max_value = f"({max_score!r}"
+            else:
+                # Recipes of same score as cursor are read too, those after it are dropped below.
+                max_value = repr(max_score)
+                pipe = self.redis_client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.zcount(key, max_value, max_value)
+                ties = pipe.execute()
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key, tie in zip(keys, ties):
+            pipe.zrevrangebyscore(key, max_value, "-inf", start=0, num=count + tie, withscores=True)
+        merged = {}
+        for entries in pipe.execute():
+            for recipe_id, score in entries:
+                merged[int(recipe_id)] = score
+        if cursor is not None and cursor[1] is not None:
+            merged = {
+                recipe_id: score for recipe_id, score in merged.items()
+                if score < cursor[0] or recipe_id < cursor[1]
+            }
+        return sorted(merged.items(), key=lambda item: (-item[1], -item[0]))[:count]
 
     def set_hkey(self, hkey_name: str, recipe_id: int, initinal_value=0):
         """
@@ -77,12 +1277,14 @@ class RedisHandler:
 
         :param recipe_id: The ID of the recipe. Must be an integer.
         :param initinal_value: The initial value of the recipe staff. Must be an integer.
+        Value in redis is never overwritten, it is ahead of SQL until flushed.
         """
-
-        if self.redis_client.hget(f"Recipe_{hkey_name}",f"{recipe_id}"):
+        pipe = self._pipeline()
+        pipe.hsetnx(f"Recipe_{hkey_name}", f"{recipe_id}", initinal_value)
+        pipe.hsetnx(f"Prev_{hkey_name}",f"{recipe_id}", initinal_value)
+        results = self._execute(pipe)
+        if results is not None and not results[0]:
             return KeyError({"error":"This recipe id is used before, please check again!"})
-        self.redis_client.hset(f"Recipe_{hkey_name}", f"{recipe_id}", initinal_value)
-        self.redis_client.hset(f"Prev_{hkey_name}",f"{recipe_id}", initinal_value)
         return True
 
     def get_hset(self, hkey_name: str):
@@ -100,9 +1302,9 @@ class RedisHandler:
         Specilized for get hash
         """
         try:
-            return self.redis_client.hgetall(f'Recipe_{hkey_name}')
+            return self.redis_client.hgetall(f'Prev_{hkey_name}')
         except json.JSONDecodeError as e:
-                print(f"Error decoding JSON for Recipe_{hkey_name}: {e}")
+                print(f"Error decoding JSON for Prev_{hkey_name}: {e}")
                 return None
 
     def get_hkey(self, hkey_name: str, recipe_id: int):
@@ -147,24 +1349,120 @@ class RedisHandler:
         :param hkey_name: The hkey of the recipe. Must be an str.
         :param recipe_id: The ID of the recipe. Must be an integer.
         :param value: The value need to be updated. Must be an str.
+        Live value in redis is kept, value is only set for recipe not in hash.
+        """
+        self.set_hkey(hkey_name=hkey_name, recipe_id=recipe_id, initinal_value=value)
+
+    def increase_search_views(self, hkey_name: str, names):
+        """
+        Buffer the views of searched tags or ingredients in hash, flush_search_views write them to SQL.
+        Only names of existing tags or ingredients (in autocomplete) are buffered, in one script call.
+
+        :param hkey_name: Tag or Ingredient. Must be an str.
+        :param names: The searched names, or a dict of name and increment value.
         """
-        value = self.get_hkey(hkey_name, recipe_id)
-        if value is not None:
-            self.redis_client.hset(f"Recipe_{hkey_name}",f"{recipe_id}",f"{value}")
+        if isinstance(names, dict):
+            increments = names
         else:
-            self.set_hkey(hkey_name=hkey_name, recipe_id=recipe_id, value=value)
+            increments = {
+                name: 1 for name in list(names)[:SEARCH_VIEWS_MAX_NAMES] if name and len(name) <= SEARCH_NAME_MAX_LENGTH
+            }
+        if not increments:
+            return
+        args = [item for name, value in increments.items() for item in (name, value)]
+        self._run_script(INCREASE_SEARCH_VIEWS_SCRIPT, keys=[f"{hkey_name}_views", f"{hkey_name}_popularity"], args=args)
+
+    def pop_hset(self, hash_name: str):
+        """
+        Get the full hash and delete it in one MULTI/EXEC, increments after it start a new hash.
+
+        :param hash_name: The full name of hash.
+        """
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.hgetall(hash_name)
+        pipe.delete(hash_name)
+        data, _ = pipe.execute()
+        return data
+
+    def load_likes(self, recipe_id: int, likes: int, user_ids):
+        """
+        Load like set and likes counter of recipe from SQL, counter is never overwritten.
+        Toggles not flushed to SQL yet are applied over it, the set expire after LIKE_SET_TIMEOUT.
+
+        :param likes: The likes of recipe in SQL.
+        :param user_ids: The ids of users like the recipe in SQL.
+        """
+        user_ids = [LIKE_SENTINEL, *user_ids]
+        with self.batch() as batch:
+            for start in range(0, len(user_ids), LIKE_LOAD_CHUNK):
+                batch.redis_client.sadd(f'Recipe_liked_{recipe_id}', *user_ids[start:start + LIKE_LOAD_CHUNK])
+            batch._run_script(
+                APPLY_PENDING_LIKES_SCRIPT,
+                keys=[f'Recipe_liked_{recipe_id}', LIKE_PENDING_HASH],
+                args=[recipe_id, LIKE_SET_TIMEOUT],
+            )
+            batch.set_hkey(hkey_name="likes", recipe_id=recipe_id, initinal_value=likes)
+
+    def toggle_like(self, recipe_id: int, user_id: int):
+        """
+        Like or revoke like of user in one script call, the change wait in pending hash for SQL.
+        Return (liked, likes) or None when like set of recipe is not loaded.
+        """
+        result = self._run_script(
+            TOGGLE_LIKE_SCRIPT,
+            keys=[
+                f'Recipe_liked_{recipe_id}', 'Recipe_likes', LIKE_PENDING_HASH,
+                TRENDING_KEY, TRENDING_EPOCH_KEY, RECIPE_VERSION_HASH
+            ],
+            args=[recipe_id, user_id, TRENDING_WEIGHTS['likes'], time.time(), TRENDING_TAU, LIKE_SET_TIMEOUT],
+        )
+        if result is None:
+            return None
+        delta, likes = result
+        return delta == 1, likes
+
+    def get_liked(self, recipe_ids, user_id: int):
+        """
+        Like state of user on recipes in one pipeline of SMISMEMBER.
+        Recipes whose like set is not loaded are left out, their state is in SQL.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for recipe_id in recipe_ids:
+            pipe.smismember(f'Recipe_liked_{recipe_id}', [LIKE_SENTINEL, user_id])
+        return {
+            recipe_id: bool(liked)
+            for recipe_id, (loaded, liked) in zip(recipe_ids, pipe.execute()) if loaded
+        }
+
+    def restore_pending_likes(self, changes):
+        """
+        Put back pending likes failed to write, toggles happened after pop are kept.
+
+        :param changes: The popped pending hash.
+        """
+        pipe = self._pipeline()
+        for field, value in changes.items():
+            pipe.hsetnx(LIKE_PENDING_HASH, field, value)
+        self._execute(pipe)
 
     def increase_recipe_view(self, hkey_name: str, recipe_id: int, increment_value=1):
         """
-        Increase value for hkey value
+        Increase value for hkey value, with its trending event and ETag version in one script call.
         :param recipe_id: The ID of the recipe. Must be an integer.
         :param increment_value: The increase value of the recipe staff. Must be an integer.
         """
-        value = self.get_hkey(hkey_name, f"{recipe_id}")
-        if value is not None:
-            self.redis_client.hincrby(f'Recipe_{hkey_name}', f"{recipe_id}", increment_value)
-        else:
+        value = self._run_script(
+            INCREASE_COUNTER_SCRIPT,
+            keys=[f'Recipe_{hkey_name}', TRENDING_KEY, TRENDING_EPOCH_KEY, RECIPE_VERSION_HASH],
+            # Views change on every read, they are not part of ETag.
+            args=[
+                recipe_id, increment_value, TRENDING_WEIGHTS.get(hkey_name, 0) * increment_value,
+                time.time(), TRENDING_TAU, 0 if hkey_name == "views" else 1
+            ],
+        )
+        if value is None:
             raise ValueError({"error": f"{recipe_id} is not found in {hkey_name}"})
+        return value
 
 
 
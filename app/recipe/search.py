@@ -0,0 +1,53 @@
+"""Full text search for recipe!"""
+
+
+from django.contrib.postgres.search import (
+                                            SearchQuery,
+                                            SearchRank,
+                                            SearchVector,
+                                            TrigramSimilarity
+                                            )
+from django.db.models import F, Q, Value, TextField
+
+from core.models import Recipe
+
+# Recipes are written in more than one language, so skip language specific stemming.
+SEARCH_CONFIG = 'simple'
+
+
+def build_search_vector(recipe):
+    """
+    Build the weighted search vector of recipe.
+    Title > tag and ingredient names > description.
+
+    :param recipe: The recipe instance. Tags and ingredients must be saved before.
+    """
+    tag_names = " ".join(recipe.tags.values_list('name', flat=True))
+    ingredient_names = " ".join(recipe.ingredients.values_list('name', flat=True))
+    return (
+        SearchVector(Value(recipe.title, output_field=TextField()), weight='A', config=SEARCH_CONFIG)
+        + SearchVector(Value(tag_names, output_field=TextField()), weight='B', config=SEARCH_CONFIG)
+        + SearchVector(Value(ingredient_names, output_field=TextField()), weight='B', config=SEARCH_CONFIG)
+        + SearchVector(Value(recipe.description, output_field=TextField()), weight='C', config=SEARCH_CONFIG)
+    )
+
+
+def update_search_vector(recipe):
+    """Refresh the stored search vector of recipe, call it after every write of recipe."""
+    Recipe.objects.filter(id=recipe.id).update(search_vector=build_search_vector(recipe))
+
+
+def search_recipes(queryset, text):
+    """
+    Filter queryset by full text search and order by rank.
+    Only columns of recipe are used, so there is no join and no need of distinct.
+
+    :param queryset: The recipe queryset.
+    :param text: The search text from user, support websearch syntax ("a b" -c or d).
+    """
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+    return queryset.annotate(
+        rank=SearchRank(F('search_vector'), query) + TrigramSimilarity('title', text)
+    ).filter(
+        Q(search_vector=query) | Q(title__trigram_similar=text)
+    ).order_by('-rank', '-id')
@@ -3,7 +3,7 @@ from decimal import Decimal
 from storages.backends.s3boto3 import S3Boto3Storage
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from django.db.models import Avg
+from django.db.models import Avg, OuterRef, Subquery, Prefetch
 from core.models import (
                         Recipe,
                         RecipePhoto,
@@ -13,7 +13,8 @@ from core.models import (
                         RecipeComment,
                         Notification
                         )
-from .utils import CustomSlugRelatedField
+from .utils import CustomSlugRelatedField, DynamicFieldsMixin
+from .search import update_search_vector
 
 s3_storage = S3Boto3Storage()
 class UserMinimalSerializer(serializers.ModelSerializer):
@@ -60,7 +61,7 @@ class RecipePhotoSerialzier(serializers.ModelSerializer):
         read_only_fields = ['id','recipe_id','upload_date']
 
 
-class RecipeSerialzier(serializers.ModelSerializer):
+class RecipeSerialzier(DynamicFieldsMixin, serializers.ModelSerializer):
     """Serialzier for recipe!!"""
     tags = CustomSlugRelatedField(
         many=True,
@@ -76,27 +77,43 @@ class RecipeSerialzier(serializers.ModelSerializer):
     steps = RecipeStepSerialzier(many=True, required=False)
     user = UserMinimalSerializer(read_only=True)
     comment_count = serializers.IntegerField(read_only=True)
-    average_rating = serializers.DecimalField(max_digits=3, decimal_places=2,required=False)
+    average_rating = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
     class Meta:
         model = Recipe
         fields = ['id','user', 'title', 'cost_time', 'description', 'ingredients', 'tags', 'photos', 'steps', 'comment_count', 'average_rating']
         read_only_fields = ['id','comment_count', 'average_rating']
+        # Not serialized by default, ask with ?expand=
+        expandable_fields = {
+            'likes': lambda: serializers.IntegerField(read_only=True),
+            'main_photo': lambda: serializers.SerializerMethodField(),
+        }
+
+    def get_main_photo(self, obj):
+        """The photo of main category, or the first photo."""
+        photos = list(obj.photos.all())
+        photo = next((photo for photo in photos if photo.category == 'main'), photos[0] if photos else None)
+        return RecipePhotoSerialzier(photo).data if photo else None
 
     def _get_or_create_tags(self, tags, recipe):
         """Handle getting or tags as needed."""
+        tag_objs = []
         for tag in tags:
             tag_obj,created = Tag.objects.get_or_create(
                 name=tag
             )
-            recipe.tags.add(tag_obj)
+            tag_objs.append(tag_obj)
+        # One m2m_changed signal keep the redis index of all tags.
+        recipe.tags.add(*tag_objs)
 
     def _get_or_create_ingredients(self, ingredients, recipe):
         """Handle getting or creating ingredients as needed."""
+        ingredient_objs = []
         for ingredient in ingredients:
             ingredient_obj, created = Ingredient.objects.get_or_create(
                 name=ingredient
             )
-            recipe.ingredients.add(ingredient_obj)
+            ingredient_objs.append(ingredient_obj)
+        recipe.ingredients.add(*ingredient_objs)
 
     def _get_or_create_photos(self, photos, recipe):
         """Handle getting or creating photos as needed."""
@@ -126,6 +143,7 @@ class RecipeSerialzier(serializers.ModelSerializer):
         self._get_or_create_ingredients(req_ingredients, recipe)
         self._get_or_create_photos(photos, recipe)
         self._get_or_create_steps(steps, recipe)
+        update_search_vector(recipe)
         return recipe
 
     def update(self, instance, validated_data):
@@ -149,6 +167,7 @@ class RecipeSerialzier(serializers.ModelSerializer):
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
         instance.save()
+        update_search_vector(instance)
         return instance
 
 class RecipeMinialSerialzier(serializers.ModelSerializer):
@@ -190,11 +209,25 @@ class RecipeSQLDetailSerializer(RecipeSerialzier):
     class Meta(RecipeSerialzier.Meta):
         fields = RecipeSerialzier.Meta.fields + ['create_time','likes','save_count','views', 'top_five_comments']
         read_only_fields = RecipeSerialzier.Meta.read_only_fields + ['likes','save_count','views','top_five_comments']
+        # Detail is cached in full, only ?fields= is supported.
+        expandable_fields = {}
 
     def get_top_five_comments(self, obj):
-        comments = obj.recipe_comment.order_by('-created_time')[:5]
+        comments = getattr(obj, 'top_comments', None)
+        if comments is None:
+            comments = obj.recipe_comment.select_related('user', 'recipe').order_by('-created_time')[:5]
         return RecipeCommentSerializer(comments, many=True).data
 
+
+def top_five_comments_prefetch():
+    """Prefetch top five comments of many recipes in one query, used by get_top_five_comments."""
+    top_ids = RecipeComment.objects.filter(recipe=OuterRef('recipe')).order_by('-created_time').values('id')[:5]
+    return Prefetch(
+        'recipe_comment',
+        queryset=RecipeComment.objects.filter(id__in=Subquery(top_ids)).select_related('user', 'recipe').order_by('-created_time'),
+        to_attr='top_comments'
+    )
+
 class NotificationSerializer(serializers.ModelSerializer):
     """Serializer for notification"""
     class Meta:
@@ -213,6 +246,17 @@ class SaveActionSerializer(serializers.Serializer):
     tag = serializers.CharField(help_text="tag name", required=False)
     ingredient = serializers.CharField(help_text="ingredient name", required=False)
 
+class InteractionSerializer(serializers.Serializer):
+    """Serializer for like and save state of user on recipe"""
+    id = serializers.IntegerField(help_text="The ID of the recipe.")
+    liked = serializers.BooleanField(help_text="User like the recipe.")
+    saved = serializers.BooleanField(help_text="User saved the recipe.")
+
+class SuggestionSerializer(serializers.Serializer):
+    """Serializer for autocomplete of tag and ingredient"""
+    name = serializers.CharField(help_text="Name of tag or ingredient.")
+    popularity = serializers.IntegerField(help_text="views + save_count")
+
 class ResponseSerializer(serializers.Serializer):
     message = serializers.CharField(help_text="A success message.")
     error = serializers.CharField(help_text="A error message.")
@@ -1,15 +1,23 @@
 """
 Handle the signal problem with recipe!
 """
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
+from django.db import transaction
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
-from core.models import Recipe, UserFollowing
+from core.models import Recipe, Tag, Ingredient, UserFollowing
+from .redis_set import RedisHandler, TRENDING_KEY, FEED_SIZE, RECIPE_VERSION_HASH
+from .tasks import fan_out_recipe
+import django_redis
 import logging
 
 logger = logging.getLogger(__name__)
+redis_client1 = django_redis.get_redis_connection("default")
+
+# Counter only update does not change list membership or list data.
+COUNTER_FIELDS = {'views', 'likes', 'save_count', 'comment_count', 'rating_sum', 'average_rating', 'search_vector'}
 
 def get_user_following(user):
     """Get user following user list"""
@@ -40,3 +48,157 @@ def create_recipe(sender, instance, created, **kwargs):
     except Exception as e:
         logger.error(e)
         logger.info("Recipe not created!")
+
+
+@receiver(post_save, sender=Recipe)
+def fan_out_recipe_on_create(sender, instance, created, **kwargs):
+    """Push new recipe to feeds of followers by celery after commit."""
+    if not created:
+        return
+    recipe_id = instance.id
+
+    def fan_out():
+        # Without an outer transaction this run at once inside save, broker error must not fail the create.
+        try:
+            fan_out_recipe.delay(recipe_id)
+        except Exception as e:
+            logger.error(e)
+
+    try:
+        transaction.on_commit(fan_out)
+    except Exception as e:
+        logger.error(e)
+
+
+@receiver(post_save, sender=UserFollowing)
+def backfill_feed_on_follow(sender, instance, created, **kwargs):
+    """Push recent recipes of followed user to feed of follower."""
+    if not created:
+        return
+    try:
+        recipes = Recipe.objects.filter(user_id=instance.following_user_id_id).order_by('-create_time').values_list('id', 'create_time')[:FEED_SIZE]
+        if recipes:
+            RedisHandler(redis_client1).push_to_feeds(
+                [instance.user_id_id], {recipe_id: create_time.timestamp() for recipe_id, create_time in recipes}
+            )
+    except Exception as e:
+        logger.error(e)
+
+
+@receiver(post_delete, sender=UserFollowing)
+def clean_feed_on_unfollow(sender, instance, **kwargs):
+    """Remove recipes of unfollowed user from feed of follower."""
+    try:
+        recipe_ids = Recipe.objects.filter(user_id=instance.following_user_id_id).order_by('-create_time').values_list('id', flat=True)[:FEED_SIZE]
+        RedisHandler(redis_client1).remove_from_feed(instance.user_id_id, list(recipe_ids))
+    except Exception as e:
+        logger.error(e)
+
+
+@receiver(post_save, sender=Recipe)
+def invalidate_recipe_list_on_save(sender, instance, created, update_fields=None, **kwargs):
+    """Bump list versions of recipe owner and drop the cached list data of recipe, or its 404 when created."""
+    if update_fields and set(update_fields) <= COUNTER_FIELDS:
+        return
+    try:
+        recipe_redis_handler = RedisHandler(redis_client1)
+        recipe_redis_handler.bump_list_version()
+        recipe_redis_handler.bump_recipe_version(instance.id)
+        if created:
+            # A 404 cached between insert and commit is cleared again after commit.
+            recipe_id = instance.id
+            recipe_redis_handler.clear_missing(recipe_id)
+            transaction.on_commit(lambda: recipe_redis_handler.clear_missing(recipe_id))
+        else:
+            recipe_redis_handler.redis_client.delete(f'Recipe_list_item_{instance.id}')
+    except Exception as e:
+        logger.error(e)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def invalidate_recipe_list_on_relation(sender, instance, action, pk_set, **kwargs):
+    """
+    Keep the redis inverted index, facet names and ingredient ids of recipe when tags or ingredients
+    are added or removed from serializer, admin or ORM, and bump list version.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear') or not isinstance(instance, Recipe):
+        return
+    try:
+        is_tag = sender is Recipe.tags.through
+        kind = "Tag" if is_tag else "Ingredient"
+        relation = instance.tags if is_tag else instance.ingredients
+        model = Tag if is_tag else Ingredient
+        if action == 'pre_clear':
+            names = list(relation.values_list('name', flat=True))
+            current = []
+        else:
+            names = list(model.objects.filter(id__in=pk_set).values_list('name', flat=True))
+            current = list(relation.values_list('id', 'name'))
+        if not names:
+            return
+        recipe_redis_handler = RedisHandler(redis_client1)
+        if action == 'post_add':
+            recipe_redis_handler.add_to_index(kind, names, instance)
+        else:
+            recipe_redis_handler.remove_from_index(kind, names, instance.id)
+        recipe_redis_handler.set_facet_names(kind, instance.id, [name for _, name in current])
+        if not is_tag:
+            recipe_redis_handler.set_ingredient_ids(instance.id, [ingredient_id for ingredient_id, _ in current])
+        recipe_redis_handler.bump_list_version()
+        recipe_redis_handler.bump_recipe_version(instance.id)
+        recipe_redis_handler.redis_client.delete(f'Recipe_list_item_{instance.id}')
+    except Exception as e:
+        logger.error(e)
+
+
+@receiver(pre_delete, sender=Recipe)
+def invalidate_recipe_list_on_delete(sender, instance, **kwargs):
+    """Bump list version, drop the deleted recipe from index and cache."""
+    try:
+        recipe_redis_handler = RedisHandler(redis_client1)
+        tags = list(instance.tags.values_list('name', flat=True))
+        ingredients = list(instance.ingredients.values_list('name', flat=True))
+        recipe_redis_handler.bump_list_version()
+        recipe_redis_handler.remove_from_index("Tag", tags, instance.id)
+        recipe_redis_handler.remove_from_index("Ingredient", ingredients, instance.id)
+        recipe_redis_handler.del_ingredient_ids(instance.id)
+        recipe_redis_handler.redis_client.hdel("Tag_names", instance.id)
+        recipe_redis_handler.redis_client.hdel("Ingredient_names", instance.id)
+        recipe_redis_handler.redis_client.hdel(RECIPE_VERSION_HASH, instance.id)
+        recipe_redis_handler.redis_client.zrem(TRENDING_KEY, instance.id)
+        recipe_redis_handler.redis_client.zrem(f"Author_{instance.user_id}", instance.id)
+        recipe_redis_handler.delete_recipe_in_cache(instance.id)
+    except Exception as e:
+        logger.error(e)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+def add_attr_suggestion(sender, instance, update_fields=None, **kwargs):
+    """Add tag or ingredient name to autocomplete, and change ETag of list and cached recipe lists filtered by name."""
+    try:
+        popularity = None
+        if isinstance(instance.views, int) and isinstance(instance.save_count, int):
+            popularity = instance.views + instance.save_count
+        recipe_redis_handler = RedisHandler(redis_client1)
+        recipe_redis_handler.add_suggestion(sender.__name__, instance.name, popularity)
+        recipe_redis_handler.bump_collection_version(sender.__name__)
+        # Save count change do not change which recipes match the name.
+        if not update_fields or 'name' in update_fields:
+            recipe_redis_handler.bump_list_version()
+    except Exception as e:
+        logger.error(e)
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+def remove_attr_suggestion(sender, instance, **kwargs):
+    """Remove deleted tag or ingredient name from autocomplete, and change ETag of list and cached recipe lists."""
+    try:
+        recipe_redis_handler = RedisHandler(redis_client1)
+        recipe_redis_handler.remove_suggestion(sender.__name__, instance.name)
+        recipe_redis_handler.bump_collection_version(sender.__name__)
+        recipe_redis_handler.bump_list_version()
+    except Exception as e:
+        logger.error(e)
@@ -5,95 +5,291 @@ Celery task for recipe!
 
 from celery import shared_task
 from celery import Celery
-from django.db.models import Avg, Count
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value, IntegerField
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .serializers import RecipeSQLDetailSerializer
-from core.models import Recipe, Notification
-from .redis_set import RedisHandler
+from .serializers import RecipeSQLDetailSerializer, RecipeSerialzier, top_five_comments_prefetch
+from core.models import Recipe, Tag, Ingredient, Notification, UserFollowing, Like
+from .redis_set import RedisHandler, FEED_CELEBRITY_FOLLOWERS, LIKE_PENDING_HASH
 import django_redis
+import time
+from functools import reduce
+from operator import or_
 
 celery_app = Celery('app', backend='redis://cache:6379/1' ,broker='redis://cache:6379/1')
 redis_client1 = django_redis.get_redis_connection("default")
 
+def recipe_details(recipe_ids):
+    """Detail data of recipes as cached, in one query with prefetched relations."""
+    recipes = Recipe.objects.select_related('user').prefetch_related(
+        'tags', 'ingredients', 'photos', 'steps', top_five_comments_prefetch()
+    ).filter(id__in=recipe_ids).defer('search_vector')
+    return RecipeSQLDetailSerializer(recipes, many=True).data
+
+def recipe_list_items(recipe_ids):
+    """List data of recipes as cached by RECIPE_CACHE_CODEC, in one query with prefetched relations."""
+    recipes = Recipe.objects.select_related('user').prefetch_related(
+        'tags', 'ingredients', 'photos', 'steps'
+    ).filter(id__in=recipe_ids).defer('search_vector')
+    return RecipeSerialzier(recipes, many=True).data
+
+def warm_up_recipe_cache(limit=None, chunk_size=None, timeout_min=None, timeout_max=None, on_chunk=None):
+    """
+    Cache detail of the most viewed recipes, one chunk at a time: one prefetched query,
+    serialize, then one pipeline of SET EX with random expiry. Only one chunk is in memory.
+    Arguments default to RECIPE_WARM_UP of settings.
+
+    :param on_chunk: Called with the stats after every chunk, for progress.
+    :return: Stats of recipes, chunks, bytes and seconds spent on query and serialize, and on redis.
+    """
+    options = settings.RECIPE_WARM_UP
+    limit = options["LIMIT"] if limit is None else limit
+    chunk_size = chunk_size or options["CHUNK_SIZE"]
+    timeout_min = timeout_min or options["TIMEOUT_MIN"]
+    timeout_max = max(timeout_max or options["TIMEOUT_MAX"], timeout_min)
+    recipe_redis_handler = RedisHandler(redis_client1)
+    stats = {"recipes": 0, "chunks": 0, "bytes": 0, "serialize_seconds": 0.0, "write_seconds": 0.0}
+    ids = list(Recipe.objects.order_by('-views', 'id').values_list('id', flat=True)[:limit])
+    for start in range(0, len(ids), chunk_size):
+        chunk_ids = ids[start:start + chunk_size]
+        begin = time.perf_counter()
+        versions = dict(zip(chunk_ids, recipe_redis_handler.get_recipe_versions(chunk_ids)))
+        items = recipe_details(chunk_ids)
+        written = time.perf_counter()
+        stats["bytes"] += recipe_redis_handler.set_recipes(
+            items, timeout_min=timeout_min, timeout_max=timeout_max, versions=versions
+        )
+        stats["serialize_seconds"] += written - begin
+        stats["write_seconds"] += time.perf_counter() - written
+        stats["recipes"] += len(items)
+        stats["chunks"] += 1
+        if on_chunk:
+            on_chunk(stats)
+    return stats
+
 @shared_task
 def update_recipe_views_in_redis():
-    top_recipes = Recipe.objects.annotate(
-        average_rating=Avg('recipe_comment__rating'),
-        comment_count=Count('recipe_comment')
-    ).order_by('-views')[:100].prefetch_related('photos', 'steps', 'recipe_comment')
+    """Warm up detail cache of the most viewed recipes, see warm_up_recipe_cache."""
+    return warm_up_recipe_cache()
 
-    serializer_recipes = RecipeSQLDetailSerializer(top_recipes, many=True).data
+@shared_task
+def refresh_recipe_detail(recipe_id, token=None):
+    """
+    Rebuild cached detail of recipe before it expire, started by early refresh of retrieve.
+    Release the refresh lock of retrieve at the end.
+    """
     recipe_redis_handler = RedisHandler(redis_client1)
+    try:
+        start = time.perf_counter()
+        version = recipe_redis_handler.get_recipe_versions([recipe_id])[0]
+        recipe = Recipe.objects.select_related('user').prefetch_related(
+            'tags', 'ingredients', 'photos', 'steps', top_five_comments_prefetch()
+        ).filter(id=recipe_id).first()
+        if recipe:
+            data = RecipeSQLDetailSerializer(recipe).data
+            recipe_redis_handler.set_recipe(recipe_id=recipe_id, data=data, delta=time.perf_counter() - start, version=version)
+    except Exception as e:
+        print(e)
+    finally:
+        if token:
+            recipe_redis_handler.release_lock(f"Recipe_refresh_{recipe_id}", token)
 
-    for data in serializer_recipes:
-        recipe_redis_handler.set_recipe(recipe_id=data['id'], data=data)
-
-def update_recipe(hkey: str, recipe_hash , previous_hash):
-    """The function to distinguish which recipe id need to update."""
+def update_recipe(hkey: str, recipe_hash , previous_hash, client=redis_client1):
+    """
+    The function to distinguish which recipe id need to update.
+    Pass redis_client of a batch as client to queue the writes of prev hash.
+    """
     update_recipe = {}
     for k ,v in recipe_hash.items():
         previous_value = previous_hash.get(k)
         if previous_value is not None and v != previous_value:
             update_recipe[k] = v
-            redis_client1.hset(f"Prev_{hkey}",f"{k}", v)
+            client.hset(f"Prev_{hkey}",f"{k}", v)
         elif previous_value is None:
             update_recipe[k] = v
-            redis_client1.hset(f"Prev_{hkey}",f"{k}",v)
+            client.hset(f"Prev_{hkey}",f"{k}",v)
         elif previous_value is not None and v == previous_value:
             pass
     return update_recipe
 
 
+# Recipes of one pipeline when set up counters.
+COUNTER_CHUNK = 1000
+
 @shared_task
 def set_up_for_server_start():
     """Create hash and prev hash in the begain of server start."""
     recipe_redis_handler = RedisHandler(redis_client1)
     recipes = Recipe.objects.values("id", "views", "likes", "save_count")
     try:
-        for recipe in recipes:
-            recipe_redis_handler.set_hkey(hkey_name="views", recipe_id=int(recipe["id"]), initinal_value=recipe["views"])
-            recipe_redis_handler.set_hkey(hkey_name="likes", recipe_id=int(recipe["id"]), initinal_value=recipe["likes"])
-            recipe_redis_handler.set_hkey(hkey_name="save_count", recipe_id=int(recipe["id"]), initinal_value=recipe["save_count"])
+        recipes = list(recipes)
+        for start in range(0, len(recipes), COUNTER_CHUNK):
+            with recipe_redis_handler.batch() as batch:
+                for recipe in recipes[start:start + COUNTER_CHUNK]:
+                    batch.set_hkey(hkey_name="views", recipe_id=int(recipe["id"]), initinal_value=recipe["views"])
+                    batch.set_hkey(hkey_name="likes", recipe_id=int(recipe["id"]), initinal_value=recipe["likes"])
+                    batch.set_hkey(hkey_name="save_count", recipe_id=int(recipe["id"]), initinal_value=recipe["save_count"])
     except Exception as e:
         print(e)
+    rebuild_recipe_index()
+    rebuild_suggest_index()
 
 @shared_task
 def consist_redis_and_sql_data():
     recipe_redis_handler = RedisHandler(redis_client1)
-    recipe_views = recipe_redis_handler.get_hset("views")
-    recipe_likes = recipe_redis_handler.get_hset("likes")
-    recipe_save_counts = recipe_redis_handler.get_hset("save_count")
-
-    recipe_previos_views = recipe_redis_handler.get_prev_hset("views")
-    recipe_previos_likes = recipe_redis_handler.get_prev_hset("likes")
-    recipe_previos_save_counts = recipe_redis_handler.get_prev_hset("save_count")
-
-    views_update = update_recipe("views", recipe_views, recipe_previos_views)
-    likes_update = update_recipe("likes", recipe_likes, recipe_previos_likes)
-    save_counts_update = update_recipe("save_count", recipe_save_counts, recipe_previos_save_counts)
-    recipes_to_update =[]
-    update_ids = set(views_update)|set(likes_update)|set(save_counts_update)
-
-    for recipe_id in update_ids:
-        update_values = {}
-        if recipe_id in views_update:
-            update_values["views"] = views_update[recipe_id]
-        else:
-            update_values["views"] = recipe_previos_views[recipe_id]
-        if recipe_id in likes_update:
-            update_values["likes"] = likes_update[recipe_id]
-        else:
-            update_values["likes"] = recipe_previos_likes[recipe_id]
-        if recipe_id in save_counts_update:
-            update_values["save_count"] = save_counts_update[recipe_id]
-        else:
-            update_values["save_count"] = recipe_previos_save_counts[recipe_id]
+    with recipe_redis_handler.batch() as batch:
+        batch.get_hset("views")
+        batch.get_hset("likes")
+        batch.get_hset("save_count")
+
+        batch.get_prev_hset("views")
+        batch.get_prev_hset("likes")
+        batch.get_prev_hset("save_count")
+    (recipe_views, recipe_likes, recipe_save_counts,
+     recipe_previos_views, recipe_previos_likes, recipe_previos_save_counts) = batch.results
 
-        recipe = Recipe(id=recipe_id, **update_values)
-        recipes_to_update.append(recipe)
+    with recipe_redis_handler.batch() as batch:
+        views_update = update_recipe("views", recipe_views, recipe_previos_views, client=batch.redis_client)
+        likes_update = update_recipe("likes", recipe_likes, recipe_previos_likes, client=batch.redis_client)
+        save_counts_update = update_recipe("save_count", recipe_save_counts, recipe_previos_save_counts, client=batch.redis_client)
+    # One UPDATE for each counter, only recipes changed in that counter are written.
+    for field, updates in (("views", views_update), ("likes", likes_update), ("save_count", save_counts_update)):
+        recipes_to_update = [Recipe(id=int(recipe_id), **{field: int(value)}) for recipe_id, value in updates.items()]
+        if recipes_to_update:
+            Recipe.objects.bulk_update(recipes_to_update, [field], batch_size=COUNTER_CHUNK)
 
-    Recipe.objects.bulk_update(recipes_to_update, ['views', 'likes','save_count'])
+@shared_task
+def rebuild_recipe_index():
+    """Rebuild the redis inverted index of tags and ingredients, and the ingredient ids of recipes from SQL."""
+    recipe_redis_handler = RedisHandler(redis_client1)
+    try:
+        recipe_redis_handler.rebuild_ingredient_ids(
+            Recipe.objects.order_by().values_list('id', 'ingredients__id').iterator()
+        )
+        recipe_redis_handler.rebuild_index(
+            "Tag",
+            Recipe.tags.through.objects.values_list('tag__name', 'recipe_id', 'recipe__create_time').iterator()
+        )
+        recipe_redis_handler.rebuild_index(
+            "Ingredient",
+            Recipe.ingredients.through.objects.values_list('ingredient__name', 'recipe_id', 'recipe__create_time').iterator()
+        )
+    except Exception as e:
+        print(e)
+
+@shared_task
+def rebuild_suggest_index():
+    """Rebuild the redis autocomplete index of tags and ingredients from SQL."""
+    recipe_redis_handler = RedisHandler(redis_client1)
+    try:
+        for model in (Tag, Ingredient):
+            recipe_redis_handler.rebuild_suggestions(
+                model.__name__,
+                model.objects.annotate(popularity=F('views') + F('save_count')).values_list('name', 'popularity').iterator()
+            )
+    except Exception as e:
+        print(e)
+
+FEED_FANOUT_CHUNK = 200
+
+@shared_task
+def fan_out_recipe(recipe_id):
+    """Push new recipe to feed of followers of author in chunks, celebrity's recipe is read from author timeline."""
+    recipe = Recipe.objects.filter(id=recipe_id).values('user_id', 'create_time').first()
+    if not recipe:
+        return
+    recipe_redis_handler = RedisHandler(redis_client1)
+    score = recipe['create_time'].timestamp()
+    recipe_redis_handler.add_to_author_timeline(recipe['user_id'], recipe_id, score)
+    followers = UserFollowing.objects.filter(following_user_id=recipe['user_id']).order_by('id').values_list('user_id', flat=True)
+    follower_count = followers.count()
+    is_celebrity = follower_count >= FEED_CELEBRITY_FOLLOWERS
+    recipe_redis_handler.set_celebrity(recipe['user_id'], is_celebrity)
+    if is_celebrity:
+        return
+    for start in range(0, follower_count, FEED_FANOUT_CHUNK):
+        push_recipe_to_feeds.delay(recipe_id, score, list(followers[start:start + FEED_FANOUT_CHUNK]))
+
+@shared_task
+def push_recipe_to_feeds(recipe_id, score, user_ids):
+    """Push recipe to feeds of one chunk of followers."""
+    RedisHandler(redis_client1).push_to_feeds(user_ids, {recipe_id: score})
+
+@shared_task
+def rescale_trending():
+    """Rescale trending scores to now, drop the decayed recipes."""
+    try:
+        RedisHandler(redis_client1).rescale_trending()
+    except Exception as e:
+        print(e)
+
+@shared_task
+def flush_search_views():
+    """Add the buffered search views of tags and ingredients to SQL, one UPDATE for each table."""
+    recipe_redis_handler = RedisHandler(redis_client1)
+    for model, hkey_name in ((Tag, "Tag"), (Ingredient, "Ingredient")):
+        buffered = recipe_redis_handler.pop_hset(f"{hkey_name}_views")
+        increments = {name.decode('utf-8'): int(value) for name, value in buffered.items()}
+        if not increments:
+            continue
+        try:
+            model.objects.filter(name__in=increments).update(
+                views=F('views') + Case(
+                    *[When(name=name, then=Value(value)) for name, value in increments.items()],
+                    default=Value(0),
+                    output_field=IntegerField()
+                )
+            )
+            recipe_redis_handler.increase_popularity(hkey_name, increments)
+            recipe_redis_handler.bump_collection_version(hkey_name)
+        except Exception as e:
+            # Put the views back, so next flush will write them.
+            recipe_redis_handler.increase_search_views(hkey_name, increments)
+            print(e)
+
+# Rows of one INSERT when likes are flushed.
+LIKE_FLUSH_CHUNK = 1000
+
+@shared_task
+def flush_recipe_likes():
+    """
+    Write the pending like toggles of redis to SQL, one bulk INSERT and one DELETE.
+    Likes counter of recipe is written by consist_redis_and_sql_data.
+    """
+    recipe_redis_handler = RedisHandler(redis_client1)
+    changes = recipe_redis_handler.pop_hset(LIKE_PENDING_HASH)
+    if not changes:
+        return
+    liked, unliked = [], {}
+    for field, value in changes.items():
+        recipe_id, user_id = (int(part) for part in field.decode('utf-8').split(':'))
+        if int(value):
+            liked.append((recipe_id, user_id))
+        else:
+            unliked.setdefault(recipe_id, []).append(user_id)
+    try:
+        with transaction.atomic():
+            # Recipes or users deleted after the toggle have nothing to write.
+            recipe_ids = set(Recipe.objects.filter(id__in={recipe_id for recipe_id, _ in liked}).values_list('id', flat=True))
+            user_ids = set(get_user_model().objects.filter(id__in={user_id for _, user_id in liked}).values_list('id', flat=True))
+            Like.objects.bulk_create(
+                [
+                    Like(recipe_id=recipe_id, user_id=user_id) for recipe_id, user_id in liked
+                    if recipe_id in recipe_ids and user_id in user_ids
+                ],
+                batch_size=LIKE_FLUSH_CHUNK,
+                ignore_conflicts=True
+            )
+            if unliked:
+                Like.objects.filter(
+                    reduce(or_, [Q(recipe_id=recipe_id, user_id__in=users) for recipe_id, users in unliked.items()])
+                ).delete()
+    except Exception as e:
+        # Put the toggles back, so next flush will write them.
+        recipe_redis_handler.restore_pending_likes(changes)
+        print(e)
 
 @shared_task
 def create_notification(user_ids, message):
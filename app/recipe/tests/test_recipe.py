@@ -1,22 +1,65 @@
 """Test recipe api end point!"""
 
 from unittest.mock import patch, Mock
+from contextlib import contextmanager
 
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from core.models import *
 from recipe.serializers import RecipeSQLDetailSerializer
+from recipe.search import update_search_vector
+from recipe import cache_codec
+from recipe.cache_codec import CODECS
+from recipe.utils import RecipeCursorPagination
+from recipe.tasks import (
+    flush_search_views,
+    flush_recipe_likes,
+    consist_redis_and_sql_data,
+    rebuild_recipe_index,
+    rebuild_suggest_index,
+    fan_out_recipe,
+    push_recipe_to_feeds,
+    refresh_recipe_detail,
+)
+from recipe.redis_set import (
+    RedisHandler,
+    LocalCache,
+    local_cache,
+    TRENDING_KEY,
+    TRENDING_EPOCH_KEY,
+    TRENDING_HALF_LIFE,
+    FEED_CELEBRITY_SET,
+    LOCAL_INVALIDATE_CHANNEL,
+    LIKE_PENDING_HASH,
+    LIKE_SET_TIMEOUT,
+    INGREDIENT_IDS_HASH,
+    FACET_ALL_KEY,
+)
+from recipe.views import redis_client1
 from rest_framework.test import APIClient, force_authenticate
 from rest_framework import status
+import base64
+import gzip
 import json
+import time
+import zlib
 
 
 RECIPE_URL = reverse("recipe:recipe-list")
 RECIPE_COMMENT_URL = reverse("recipe:recipecomment-list")
 INGREDIENT_URL = reverse("recipe:ingredient-list")
+INGREDIENT_SUGGEST_URL = reverse("recipe:ingredient-suggest")
+TAG_SUGGEST_URL = reverse("recipe:tag-suggest")
 LIKE_RECIPE_URL = reverse("recipe:like-recipe")
 SAVE_ACTION_URL = reverse("recipe:save-action")
+PANTRY_URL = reverse("recipe:recipe-pantry")
+TRENDING_URL = reverse("recipe:recipe-trending")
+FEED_URL = reverse("recipe:recipe-feed")
+BATCH_URL = reverse("recipe:recipe-batch")
+INTERACTIONS_URL = reverse("recipe:recipe-interactions")
 def decode_content(content):
     """Decode response content!"""
     content_dict = json.loads(content.decode('utf-8'))
@@ -48,6 +91,33 @@ def create_user(**params):
     """Create user and return !"""
     return get_user_model().objects.create(**params)
 
+def create_full_recipe(user, index):
+    """Create recipe with tag, ingredient, photo and step, like the real one!"""
+    recipe = Recipe.objects.create(
+        user=user,
+        title=f'full recipe {index}',
+        cost_time='20',
+        description='Sample description'
+    )
+    recipe.tags.add(Tag.objects.create(name=f'tag {index}'))
+    recipe.ingredients.add(Ingredient.objects.create(name=f'ingredient {index}'))
+    RecipePhoto.objects.create(recipe=recipe, category='main')
+    RecipeStep.objects.create(recipe=recipe, step=1, description='step one')
+    RecipeComment.objects.create(user=user, recipe=recipe, comment='good', rating=5)
+    return recipe
+
+@contextmanager
+def assert_max_queries(test_case, max_queries):
+    """Fail the test when the block run more SQL queries than the budget!"""
+    with CaptureQueriesContext(connection) as context:
+        yield context
+    executed = len(context.captured_queries)
+    test_case.assertLessEqual(
+        executed,
+        max_queries,
+        f"{executed} queries over budget {max_queries}:\n" + "\n".join(q['sql'] for q in context.captured_queries)
+    )
+
 
 class PublicAgentAPITests(TestCase):
     """Test unauthenticated API request!!"""
@@ -88,6 +158,355 @@ class PublicAgentAPITests(TestCase):
         self.assertEqual(res_content['results'][0]['id'], recipe1.id)
         self.assertEqual(res_content['results'][1]['id'], recipe2.id)
 
+    def test_recipe_list_cursor_pagination(self):
+        """Test the recipe list with cursor pagination follow next link without count!"""
+        params = {
+                "password":"test1123123123",
+                "username":"testuser1"
+                }
+        user = create_user(**params)
+        recipe1 = create_recipe(user, title='cursor 1', views=5)
+        recipe2 = create_recipe(user, title='cursor 2', views=9)
+        recipe3 = create_recipe(user, title='cursor 3', views=5)
+        with patch.object(RecipeCursorPagination, 'page_size', 2):
+            res = self.client.get(RECIPE_URL, {'pagination': 'cursor', 'ordering': '-views'})
+            res_content = decode_content(res.content)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', res_content)
+            self.assertEqual([r['id'] for r in res_content['results']], [recipe2.id, recipe3.id])
+
+            res_next = self.client.get(res_content['next'])
+            res_next_content = decode_content(res_next.content)
+            self.assertEqual(res_next.status_code, status.HTTP_200_OK)
+            self.assertEqual([r['id'] for r in res_next_content['results']], [recipe1.id])
+            self.assertIsNone(res_next_content['next'])
+
+        res_invalid = self.client.get(RECIPE_URL, {'cursor': 'not-a-cursor'})
+        self.assertEqual(res_invalid.status_code, status.HTTP_400_BAD_REQUEST)
+        # Value of other type than the ordering field.
+        tampered = base64.urlsafe_b64encode(json.dumps(['-views', 'abc', recipe1.id]).encode('utf-8')).decode('ascii')
+        res_tampered = self.client.get(RECIPE_URL, {'pagination': 'cursor', 'ordering': '-views', 'cursor': tampered})
+        self.assertEqual(res_tampered.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_recipe_list_cache(self):
+        """Test the list page is served from cache and invalidated by recipe change!"""
+        user = create_user(username='cacheuser', email='cache@example.com')
+        recipe1 = create_recipe(user, title='cache 1')
+        dinner = Tag.objects.create(name='dinner')
+        recipe1.tags.add(dinner)
+
+        res = self.client.get(RECIPE_URL, {'tags': 'Dinner'})
+        self.assertEqual([r['id'] for r in decode_content(res.content)['results']], [recipe1.id])
+        # Views of tag are buffered in redis, so a cached page is no SQL at all.
+        with assert_max_queries(self, 0):
+            res_cached = self.client.get(RECIPE_URL, {'tags': 'dinner'})
+        self.assertEqual(decode_content(res_cached.content), decode_content(res.content))
+
+        recipe2 = create_recipe(user, title='cache 2')
+        recipe2.tags.add(dinner)
+        res_changed = self.client.get(RECIPE_URL, {'tags': 'dinner'})
+        self.assertEqual([r['id'] for r in decode_content(res_changed.content)['results']], [recipe1.id, recipe2.id])
+
+        recipe1.title = 'cache changed'
+        recipe1.save()
+        res_updated = self.client.get(RECIPE_URL, {'tags': 'dinner'})
+        self.assertEqual(decode_content(res_updated.content)['results'][0]['title'], 'cache changed')
+
+        recipe2.delete()
+        res_deleted = self.client.get(RECIPE_URL, {'tags': 'dinner'})
+        self.assertEqual([r['id'] for r in decode_content(res_deleted.content)['results']], [recipe1.id])
+
+    def test_recipe_list_cache_substring_filter(self):
+        """Test cached page of a substring filter is invalidated by new match, and links are cached relative!"""
+        user = create_user(username='chocuser', email='choc@example.com')
+        recipe1 = create_recipe(user, title='choc 1')
+        recipe1.tags.add(Tag.objects.create(name='choc chip'))
+        with patch('recipe.utils.CustomPagination.page_size', 1):
+            res = self.client.get(RECIPE_URL, {'tags': 'choc'})
+            self.assertEqual([r['id'] for r in decode_content(res.content)['results']], [recipe1.id])
+
+            recipe2 = create_recipe(user, title='choc 2')
+            recipe2.tags.add(Tag.objects.create(name='chocolate'))
+            res_changed = self.client.get(RECIPE_URL, {'tags': 'choc'})
+            content = decode_content(res_changed.content)
+            self.assertEqual(content['count'], 2)
+
+            res_cached = self.client.get(RECIPE_URL, {'tags': 'choc'}, HTTP_HOST='localhost')
+            self.assertTrue(decode_content(res_cached.content)['next'].startswith('http://localhost/'))
+            handler = RedisHandler(redis_client1)
+            cache_key = handler.list_cache_key({'tag': ['choc']}, {})
+            self.assertTrue(handler.get_list_page(cache_key)['meta']['next'].startswith('/'))
+
+    def test_recipe_list_etag(self):
+        """Test conditional GET of list get 304 until a recipe of page is changed!"""
+        user = create_user(username='etaguser', email='etag@example.com')
+        recipe = create_recipe(user, title='etag 1')
+        handler = RedisHandler(redis_client1)
+        handler.set_hkey(hkey_name='likes', recipe_id=recipe.id)
+        handler.set_hkey(hkey_name='views', recipe_id=recipe.id)
+
+        res = self.client.get(RECIPE_URL, {'user': 'etaguser'})
+        etag = res['ETag']
+        with assert_max_queries(self, 0):
+            res_not_modified = self.client.get(RECIPE_URL, {'user': 'etaguser'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res_not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(res_not_modified['ETag'], etag)
+
+        # Views are not part of ETag.
+        handler.increase_recipe_view(hkey_name='views', recipe_id=recipe.id)
+        res_viewed = self.client.get(RECIPE_URL, {'user': 'etaguser'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res_viewed.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        handler.increase_recipe_view(hkey_name='likes', recipe_id=recipe.id)
+        res_liked = self.client.get(RECIPE_URL, {'user': 'etaguser'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res_liked.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res_liked['ETag'], etag)
+
+        recipe.title = 'etag changed'
+        recipe.save()
+        res_changed = self.client.get(RECIPE_URL, {'user': 'etaguser'}, HTTP_IF_NONE_MATCH=res_liked['ETag'])
+        self.assertEqual(res_changed.status_code, status.HTTP_200_OK)
+        self.assertEqual(decode_content(res_changed.content)['results'][0]['title'], 'etag changed')
+
+    def test_search_views_flush_to_sql(self):
+        """Test the search views of tag and ingredient are buffered in redis and flushed in batch!"""
+        soup = Tag.objects.create(name='flushsoup')
+        salt = Ingredient.objects.create(name='flushsalt')
+        self.client.get(RECIPE_URL, {'tags': 'flushsoup'})
+        self.client.get(RECIPE_URL, {'tags': 'flushsoup', 'ingredients': 'flushsalt'})
+        soup.refresh_from_db()
+        self.assertEqual(soup.views, 1)
+        # Names of no tag are not buffered.
+        self.client.get(RECIPE_URL, {'tags': 'flushnosuchtag,' + 'x' * 100})
+        self.assertFalse(redis_client1.hexists('Tag_views', 'flushnosuchtag'))
+        self.assertFalse(redis_client1.hexists('Tag_views', 'x' * 100))
+
+        with assert_max_queries(self, 2):
+            flush_search_views()
+        soup.refresh_from_db()
+        salt.refresh_from_db()
+        self.assertEqual(soup.views, 3)
+        self.assertEqual(salt.views, 2)
+
+        flush_search_views()
+        soup.refresh_from_db()
+        self.assertEqual(soup.views, 3)
+
+    def test_recipe_list_match_tags(self):
+        """Test filter recipes with all or any of tags by the redis inverted index!"""
+        user = create_user(username='matchuser', email='match@example.com')
+        dinner = Tag.objects.create(name='Dinner')
+        quick = Tag.objects.create(name='quick')
+        recipe1 = create_recipe(user, title='match 1')
+        recipe1.tags.add(dinner, quick)
+        recipe2 = create_recipe(user, title='match 2')
+        recipe2.tags.add(dinner)
+        recipe3 = create_recipe(user, title='match 3')
+        recipe3.tags.add(quick)
+        rebuild_recipe_index()
+
+        res_all = self.client.get(RECIPE_URL, {'tags': 'dinner,quick', 'match': 'all'})
+        self.assertEqual(res_all.status_code, status.HTTP_200_OK)
+        self.assertEqual(decode_content(res_all.content)['count'], 1)
+        self.assertEqual([r['id'] for r in decode_content(res_all.content)['results']], [recipe1.id])
+
+        res_any = self.client.get(RECIPE_URL, {'tags': 'dinner,quick', 'match': 'any'})
+        self.assertEqual(
+            [r['id'] for r in decode_content(res_any.content)['results']],
+            [recipe1.id, recipe2.id, recipe3.id]
+        )
+
+        # Cursor pagination use the same filter in SQL.
+        res_cursor = self.client.get(RECIPE_URL, {'tags': 'dinner,quick', 'match': 'all', 'pagination': 'cursor'})
+        self.assertEqual([r['id'] for r in decode_content(res_cursor.content)['results']], [recipe1.id])
+
+    def test_recipe_index_follow_orm_relation(self):
+        """Test tags changed by ORM are kept in the index, and a missing index key fall back to SQL!"""
+        user = create_user(username='ormuser', email='orm@example.com')
+        brunch = Tag.objects.create(name='orm brunch')
+        recipe1 = create_recipe(user, title='orm 1')
+        recipe2 = create_recipe(user, title='orm 2')
+        recipe1.tags.add(brunch)
+        recipe2.tags.add(brunch)
+        handler = RedisHandler(redis_client1)
+        key = handler.index_key("Tag", 'orm brunch')
+        self.addCleanup(redis_client1.delete, key)
+        self.assertEqual(handler.match_recipe_ids([key], 'any', 0, -1), (2, [recipe1.id, recipe2.id]))
+
+        recipe2.tags.remove(brunch)
+        self.assertEqual(handler.match_recipe_ids([key], 'any', 0, -1), (1, [recipe1.id]))
+        self.assertEqual(json.loads(redis_client1.hget("Tag_names", recipe2.id)), [])
+
+        redis_client1.delete(key)
+        self.assertIsNone(handler.match_recipe_ids([key], 'any', 0, -1))
+        res = self.client.get(RECIPE_URL, {'tags': 'orm brunch', 'match': 'all'})
+        self.assertEqual([r['id'] for r in decode_content(res.content)['results']], [recipe1.id])
+
+    def test_recipe_list_facets(self):
+        """Test facets count tags and ingredients of all recipes match the filter!"""
+        user = create_user(username='facetuser', email='facet@example.com')
+        dinner = Tag.objects.create(name='facet dinner')
+        quick = Tag.objects.create(name='facet quick')
+        recipe1 = create_recipe(user, title='facet 1')
+        recipe1.tags.add(dinner, quick)
+        recipe2 = create_recipe(user, title='facet 2')
+        recipe2.tags.add(dinner)
+        recipe3 = create_recipe(user, title='facet 3')
+        recipe3.tags.add(quick)
+        rebuild_recipe_index()
+
+        res = self.client.get(RECIPE_URL, {'tags': 'facet dinner', 'facets': 'true'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        content = decode_content(res.content)
+        self.assertEqual(content['facets'], {
+            'tags': [{'name': 'facet dinner', 'count': 2}, {'name': 'facet quick', 'count': 1}],
+            'ingredients': [{'name': 'chocolate', 'count': 2}],
+        })
+        # Facets are cached with the page.
+        with assert_max_queries(self, 0):
+            res_cached = self.client.get(RECIPE_URL, {'tags': 'facet dinner', 'facets': 'true'})
+        self.assertEqual(decode_content(res_cached.content)['facets'], content['facets'])
+
+        res_plain = self.client.get(RECIPE_URL, {'tags': 'facet dinner'})
+        self.assertNotIn('facets', decode_content(res_plain.content))
+
+        # Facets of unfiltered list outlive the list version.
+        redis_client1.delete(FACET_ALL_KEY)
+        self.addCleanup(redis_client1.delete, FACET_ALL_KEY)
+        res_all = self.client.get(RECIPE_URL, {'facets': 'true'})
+        self.assertIn({'name': 'facet dinner', 'count': 2}, decode_content(res_all.content)['facets']['tags'])
+        RedisHandler(redis_client1).bump_list_version()
+        with patch('recipe.redis_set.RedisHandler.count_facets') as mock_count_facets:
+            res_all_cached = self.client.get(RECIPE_URL, {'facets': 'true'})
+        mock_count_facets.assert_not_called()
+        self.assertEqual(decode_content(res_all_cached.content)['facets'], decode_content(res_all.content)['facets'])
+
+    def test_recipe_list_facets_failure(self):
+        """Test list is served without facets when facets fail!"""
+        user = create_user(username='facetfail', email='facetfail@example.com')
+        create_recipe(user, title='facet fail')
+        with patch('recipe.redis_set.RedisHandler.get_facets', side_effect=ConnectionError('redis down')):
+            res = self.client.get(RECIPE_URL, {'user': 'facetfail', 'facets': 'true'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        content = decode_content(res.content)
+        self.assertNotIn('facets', content)
+        self.assertEqual([r['title'] for r in content['results']], ['facet fail'])
+        # The page without facets is not cached.
+        res_retry = self.client.get(RECIPE_URL, {'user': 'facetfail', 'facets': 'true'})
+        self.assertIn('facets', decode_content(res_retry.content))
+
+    def test_recipe_pantry_rank_by_missing(self):
+        """Test pantry rank recipes by missing ingredients with the ingredient ids in redis!"""
+        user = create_user(username='pantryuser', email='pantry@example.com')
+        egg = Ingredient.objects.create(name='pantry egg')
+        flour = Ingredient.objects.create(name='pantry flour')
+        milk = Ingredient.objects.create(name='pantry milk')
+        pancake = Recipe.objects.create(user=user, title='pancake', cost_time='20', description='a')
+        pancake.ingredients.add(egg, flour, milk)
+        noodle = Recipe.objects.create(user=user, title='noodle', cost_time='20', description='a')
+        noodle.ingredients.add(egg, flour)
+        milkshake = Recipe.objects.create(user=user, title='milkshake', cost_time='20', description='a')
+        milkshake.ingredients.add(milk)
+        rebuild_recipe_index()
+
+        res = self.client.get(PANTRY_URL, {'ingredients': 'Pantry Egg,pantry flour'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        content = decode_content(res.content)
+        self.assertEqual(content['count'], 2)
+        self.assertEqual(
+            [(r['id'], r['matched_count'], r['missing_count']) for r in content['results']],
+            [(noodle.id, 2, 0), (pancake.id, 2, 1)]
+        )
+
+        res_exact = self.client.get(PANTRY_URL, {'ingredients': 'pantry egg,pantry flour', 'max_missing': 0})
+        self.assertEqual([r['id'] for r in decode_content(res_exact.content)['results']], [noodle.id])
+
+        # Size follow the number of ingredients, not the biggest ingredient id.
+        self.assertEqual(len(redis_client1.hget(INGREDIENT_IDS_HASH, pancake.id)), 3 * 4)
+        # Recipe missing in redis is loaded from SQL and kept.
+        redis_client1.hdel(INGREDIENT_IDS_HASH, noodle.id)
+        res_reload = self.client.get(PANTRY_URL, {'ingredients': 'pantry egg,pantry flour', 'max_missing': 0})
+        self.assertEqual([r['id'] for r in decode_content(res_reload.content)['results']], [noodle.id])
+        self.assertTrue(redis_client1.hexists(INGREDIENT_IDS_HASH, noodle.id))
+
+        res_bad = self.client.get(PANTRY_URL)
+        self.assertEqual(res_bad.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_recipe_trending_decay(self):
+        """Test trending rank recent events over old events with more views!"""
+        user = create_user(username='trenduser', email='trend@example.com')
+        old_recipe = create_recipe(user, title='trending old')
+        new_recipe = create_recipe(user, title='trending new')
+        handler = RedisHandler(redis_client1)
+        handler.redis_client.delete(TRENDING_KEY, TRENDING_EPOCH_KEY)
+        now = 1700000000
+        with patch('recipe.redis_set.time.time') as mock_time:
+            mock_time.return_value = now - 3 * TRENDING_HALF_LIFE
+            handler.bump_trending(old_recipe.id, 10)
+            mock_time.return_value = now
+            handler.bump_trending(new_recipe.id, 2)
+            self.assertAlmostEqual(handler.redis_client.zscore(TRENDING_KEY, new_recipe.id), 16)
+
+            handler.rescale_trending()
+        self.assertAlmostEqual(handler.redis_client.zscore(TRENDING_KEY, old_recipe.id), 1.25)
+        self.assertAlmostEqual(handler.redis_client.zscore(TRENDING_KEY, new_recipe.id), 2)
+
+        res = self.client.get(TRENDING_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        content = decode_content(res.content)
+        self.assertEqual(content['count'], 2)
+        self.assertEqual([r['id'] for r in content['results']], [new_recipe.id, old_recipe.id])
+
+    def test_recipe_view_bump_trending(self):
+        """Test retrieve recipe add view to trending!"""
+        user = create_user(username='trendview', email='trendview@example.com')
+        recipe = create_recipe(user, title='trending view')
+        handler = RedisHandler(redis_client1)
+        handler.set_hkey(hkey_name='views', recipe_id=recipe.id)
+        handler.redis_client.delete(TRENDING_KEY, TRENDING_EPOCH_KEY)
+        with patch('recipe.redis_set.RedisHandler.set_recipe') as mock_set_recipe:
+            mock_set_recipe.return_value = None
+            res = self.client.get(detail_url(recipe.id))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertAlmostEqual(handler.redis_client.zscore(TRENDING_KEY, recipe.id), 1)
+
+    def test_redis_handler_batch(self):
+        """Test batch of handler send the queued commands in one round trip, nothing when block raise!"""
+        handler = RedisHandler(redis_client1)
+        handler.del_hkey('views', 990001, 990002)
+        handler.del_prev_hkey('views', 990001, 990002)
+        self.addCleanup(handler.del_hkey, 'views', 990001, 990002)
+        self.addCleanup(handler.del_prev_hkey, 'views', 990001, 990002)
+        with patch.object(redis_client1, 'execute_command', wraps=redis_client1.execute_command) as mock_execute_command:
+            with handler.batch() as batch:
+                batch.set_hkey(hkey_name='views', recipe_id=990001, initinal_value=5)
+                with batch.batch() as inner:
+                    inner.set_hkey(hkey_name='views', recipe_id=990001, initinal_value=7)
+                batch.get_hset('views')
+        mock_execute_command.assert_not_called()
+        self.assertEqual(batch.results[:4], [1, 1, 0, 0])
+        self.assertEqual(batch.results[4][b'990001'], b'5')
+
+        with self.assertRaises(RuntimeError):
+            with handler.batch() as batch:
+                batch.set_hkey(hkey_name='views', recipe_id=990002)
+                raise RuntimeError
+        self.assertIsNone(handler.get_hkey('views', 990002))
+
+    def test_redis_handler_script_registered_once(self):
+        """Test lua script is registered once and run in batch too!"""
+        handler = RedisHandler(redis_client1)
+        handler.set_hkey(hkey_name='views', recipe_id=990003, initinal_value=1)
+        self.addCleanup(handler.del_hkey, 'views', 990003)
+        handler.increase_recipe_view('views', 990003)
+        with patch.object(type(redis_client1), 'register_script') as mock_register_script:
+            handler.increase_recipe_view('views', 990003)
+            with handler.batch() as batch:
+                batch.increase_recipe_view('views', 990003)
+        mock_register_script.assert_not_called()
+        self.assertEqual(batch.results, [4])
+        self.assertEqual(handler.get_hkey('views', 990003), 4)
+
     def test_recipe_retrieve_public(self):
         """Test the recipe retrieve api could be access without login in!"""
         with patch('recipe.redis_set.RedisHandler.increase_recipe_view') as mock_increase_recipe_view,\
@@ -176,6 +595,73 @@ class PublicAgentAPITests(TestCase):
         res_content = decode_content(res.content)
         self.assertEqual(len(res_content['results']), 3)
 
+    def test_ingredients_list_etag(self):
+        """Test conditional GET of ingredients get 304 until ingredients are changed!"""
+        Ingredient.objects.create(name='chocolate')
+        res = self.client.get(INGREDIENT_URL)
+        etag = res['ETag']
+        with assert_max_queries(self, 0):
+            res_not_modified = self.client.get(INGREDIENT_URL, HTTP_IF_NONE_MATCH=f'"other", {etag}')
+        self.assertEqual(res_not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Ingredient.objects.create(name='banana')
+        res_changed = self.client.get(INGREDIENT_URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res_changed.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(decode_content(res_changed.content)['results']), 2)
+
+    def test_tag_suggest_by_prefix(self):
+        """Test autocomplete tags by prefix, the most popular first!"""
+        Tag.objects.create(name='Zqdinner', views=5)
+        Tag.objects.create(name='zqdim sum', views=1, save_count=1)
+        Tag.objects.create(name='zqdessert', views=10)
+
+        res = self.client.get(TAG_SUGGEST_URL, {'prefix': 'ZQDI'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(decode_content(res.content), [
+            {'name': 'Zqdinner', 'popularity': 5},
+            {'name': 'zqdim sum', 'popularity': 2},
+        ])
+        res_limit = self.client.get(TAG_SUGGEST_URL, {'prefix': 'zq', 'limit': 1})
+        self.assertEqual([tag['name'] for tag in decode_content(res_limit.content)], ['zqdessert'])
+
+        Tag.objects.filter(name='zqdessert').delete()
+        res_deleted = self.client.get(TAG_SUGGEST_URL, {'prefix': 'zq', 'limit': 1})
+        self.assertEqual([tag['name'] for tag in decode_content(res_deleted.content)], ['Zqdinner'])
+
+        res_bad = self.client.get(TAG_SUGGEST_URL)
+        self.assertEqual(res_bad.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_tag_suggest_short_prefix_rank_all_names(self):
+        """Test short prefix rank every name by popularity, not only the first ones in lexicographic order!"""
+        handler = RedisHandler(redis_client1)
+        entries = [(f'zx{index:03d}', index % 7) for index in range(30)] + [('zxzz top', 50)]
+        with patch('recipe.redis_set.SUGGEST_TOP_SIZE', 5):
+            handler.rebuild_suggestions('Tag', entries)
+            self.assertEqual(handler.suggest('Tag', 'ZX', 2), [('zxzz top', 50), ('zx006', 6)])
+            handler.increase_popularity('Tag', {'zx000': 100, 'unknown': 1})
+            self.assertEqual(handler.suggest('Tag', 'z', 2), [('zx000', 100), ('zxzz top', 50)])
+            self.assertEqual(handler.redis_client.zcard('Tag_suggest_top_z'), 5)
+            self.assertIsNone(handler.redis_client.zscore('Tag_popularity', 'unknown'))
+            handler.remove_suggestion('Tag', 'zx000')
+            self.assertEqual(handler.suggest('Tag', 'zx0', 1), [('zx006', 6)])
+            # Longer prefixes are ranked from the lexicographic index.
+            self.assertEqual(handler.suggest('Tag', 'zxzz', 5), [('zxzz top', 50)])
+        rebuild_suggest_index()
+
+    def test_ingredient_suggest_follow_search_views(self):
+        """Test flushed search views raise the ingredient in autocomplete!"""
+        Ingredient.objects.create(name='zqbutter', views=3)
+        Ingredient.objects.create(name='zqbun', views=2)
+        # Same name twice in one request is one view.
+        self.client.get(RECIPE_URL, {'ingredients': 'zqbun,zqbun'})
+        self.client.get(RECIPE_URL, {'ingredients': 'zqbun'})
+        flush_search_views()
+        res = self.client.get(INGREDIENT_SUGGEST_URL, {'prefix': 'zqbu'})
+        self.assertEqual(decode_content(res.content), [
+            {'name': 'zqbun', 'popularity': 4},
+            {'name': 'zqbutter', 'popularity': 3},
+        ])
+
 
 class PrivateAgentAPITests(TestCase):
     """Test the unauthenticated API request!!"""
@@ -294,6 +780,8 @@ class PrivateAgentAPITests(TestCase):
             res_content = decode_content(res.content)
             self.assertEqual(res_content['id'], recipe.id)
             self.assertEqual(res_content['title'], update_param['title'])
+            self.assertEqual(mock_set_recipe.call_args.kwargs['recipe_id'], recipe.id)
+            self.assertEqual({call.kwargs['recipe_id'] for call in mock_update_hkey.call_args_list}, {recipe.id})
 
     def test_delete_recipe(self):
         """Test delete recipe with authenticated!"""
@@ -340,6 +828,31 @@ class PrivateAgentAPITests(TestCase):
             self.assertEqual(res_retrieve_recipe.status_code, status.HTTP_200_OK)
             self.assertEqual(res_content2['top_five_comments'][0]['id'], res_content1['id'])
 
+    def test_comment_stats_follow_comment_change(self):
+        """Test comment count and average rating stored on recipe follow create, update and delete of comment!"""
+        recipe = create_recipe(user=self.user)
+        with patch('recipe.redis_set.RedisHandler.update_recipe_in_cache') as mock_update_recipe_in_cache:
+            mock_update_recipe_in_cache.return_value = None
+            res_1 = self.client.post(RECIPE_COMMENT_URL, {'recipe': recipe.id, 'comment': 'good', 'rating': 5})
+            res_2 = self.client.post(RECIPE_COMMENT_URL, {'recipe': recipe.id, 'comment': 'bad', 'rating': 2})
+            self.assertEqual(res_2.status_code, status.HTTP_201_CREATED)
+            recipe.refresh_from_db()
+            self.assertEqual(recipe.comment_count, 2)
+            self.assertEqual(str(recipe.average_rating), '3.50')
+
+            res_update = self.client.patch(detail_comment_rul(res_2.data['id']), {'recipe': recipe.id, 'rating': 4})
+            self.assertEqual(res_update.status_code, status.HTTP_200_OK)
+            recipe.refresh_from_db()
+            self.assertEqual(recipe.rating_sum, 9)
+            self.assertEqual(str(recipe.average_rating), '4.50')
+
+            self.client.delete(detail_comment_rul(res_1.data['id']))
+            self.client.delete(detail_comment_rul(res_2.data['id']))
+            recipe.refresh_from_db()
+            self.assertEqual(recipe.comment_count, 0)
+            self.assertEqual(recipe.rating_sum, 0)
+            self.assertIsNone(recipe.average_rating)
+
     def test_update_comment(self):
         """Test PUT recipe comment!"""
         recipe_params = {
@@ -441,6 +954,98 @@ class PrivateAgentAPITests(TestCase):
             exist = Ingredient.objects.filter(name=payload['ingredients'][0])
             self.assertTrue(exist)
 
+    def test_recipe_feed_fan_out(self):
+        """Test feed get recipes of followed users, pushed on write or merged from celebrity on read!"""
+        handler = RedisHandler(redis_client1)
+        handler.redis_client.delete(f'Feed_{self.user.id}', FEED_CELEBRITY_SET)
+        author = create_user(username='feedauthor', email='feedauthor@example.com')
+        celebrity = create_user(username='feedcelebrity', email='feedcelebrity@example.com')
+        other = create_user(username='feedother', email='feedother@example.com')
+        UserFollowing.objects.create(user_id=self.user, following_user_id=author)
+        UserFollowing.objects.create(user_id=self.user, following_user_id=celebrity)
+        UserFollowing.objects.create(user_id=other, following_user_id=celebrity)
+
+        with patch('recipe.tasks.FEED_CELEBRITY_FOLLOWERS', 2), \
+            patch('recipe.signals.fan_out_recipe.delay', side_effect=fan_out_recipe), \
+            patch('recipe.tasks.push_recipe_to_feeds.delay', side_effect=push_recipe_to_feeds):
+            with self.captureOnCommitCallbacks(execute=True):
+                author_recipe = create_recipe(author, title='feed author')
+            with self.captureOnCommitCallbacks(execute=True):
+                celebrity_recipe = create_recipe(celebrity, title='feed celebrity')
+        self.assertIsNone(handler.redis_client.zscore(f'Feed_{self.user.id}', celebrity_recipe.id))
+        self.assertIsNotNone(handler.redis_client.zscore(f'Feed_{self.user.id}', author_recipe.id))
+        self.assertIsNone(handler.redis_client.zscore(f'Feed_{other.id}', author_recipe.id))
+
+        with patch('recipe.utils.RecipeCursorPagination.page_size', 1):
+            res = self.client.get(FEED_URL)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            content = decode_content(res.content)
+            self.assertEqual([r['id'] for r in content['results']], [celebrity_recipe.id])
+            res_next = self.client.get(content['next'])
+            content_next = decode_content(res_next.content)
+            self.assertEqual([r['id'] for r in content_next['results']], [author_recipe.id])
+            self.assertIsNone(content_next['next'])
+
+        UserFollowing.objects.filter(user_id=self.user, following_user_id=author).delete()
+        res_unfollow = self.client.get(FEED_URL)
+        self.assertEqual([r['id'] for r in decode_content(res_unfollow.content)['results']], [celebrity_recipe.id])
+
+    def test_recipe_create_when_broker_down(self):
+        """Test recipe is created with its relations even when feed fan out can not reach the broker!"""
+        payload = {
+            'title':'broker down',
+            'cost_time':'20',
+            'description':'asdkioasjdf',
+            'tags':['broker tag'],
+        }
+        with patch('recipe.signals.fan_out_recipe.delay', side_effect=ConnectionError('broker down')) as mock_delay, \
+            self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(RECIPE_URL, payload)
+        mock_delay.assert_called_once()
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        recipe = Recipe.objects.get(title='broker down')
+        self.addCleanup(RedisHandler(redis_client1).delete_recipe_in_cache, recipe.id)
+        self.assertEqual(list(recipe.tags.values_list('name', flat=True)), ['broker tag'])
+
+    def test_recipe_feed_same_create_time(self):
+        """Test feed page boundary between recipes of same create time skip nothing!"""
+        handler = RedisHandler(redis_client1)
+        author = create_user(username='feedtie', email='feedtie@example.com')
+        recipes = [create_recipe(author, title=f'feed tie {index}') for index in range(4)]
+        handler.redis_client.delete(f'Feed_{self.user.id}')
+        self.addCleanup(handler.redis_client.delete, f'Feed_{self.user.id}')
+        handler.redis_client.zadd(f'Feed_{self.user.id}', {recipes[0].id: 100, recipes[1].id: 200, recipes[2].id: 200, recipes[3].id: 200})
+
+        ids, url = [], FEED_URL
+        with patch('recipe.utils.RecipeCursorPagination.page_size', 2):
+            while url:
+                content = decode_content(self.client.get(url).content)
+                ids.extend(r['id'] for r in content['results'])
+                url = content['next']
+        self.assertEqual(ids, [recipes[3].id, recipes[2].id, recipes[1].id, recipes[0].id])
+
+        for cursor in ('not-a-cursor', base64.urlsafe_b64encode(b'200.0:abc').decode('ascii')):
+            res_bad = self.client.get(FEED_URL, {'cursor': cursor})
+            self.assertEqual(res_bad.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_recipe_update_pantry_bits(self):
+        """Test recipe created with ingredients can be found by pantry without rebuild!"""
+        payload = {
+            'title':'test_for_pantry',
+            'cost_time':'20',
+            'description':'asdkioasjdf',
+            'ingredients':['pantry rice', 'pantry bean']
+        }
+        with patch('recipe.redis_set.RedisHandler.set_recipe') as mock_set_recipe, \
+            patch('recipe.redis_set.RedisHandler.set_hkey') as mock_set_hkey:
+            mock_set_recipe.return_value = None
+            mock_set_hkey.return_value = None
+            res = self.client.post(RECIPE_URL, payload)
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        res_pantry = self.client.get(PANTRY_URL, {'ingredients': 'pantry rice'})
+        results = decode_content(res_pantry.content)['results']
+        self.assertEqual([(r['title'], r['missing_count']) for r in results], [('test_for_pantry', 1)])
+
     def test_create_recipe_with_exist_ingredient(self):
         """Test create recipe with exist ingredient!"""
         Ingredient.objects.create(name='steak')
@@ -592,6 +1197,24 @@ class PrivateAgentAPITests(TestCase):
                 self.assertIn(tag, recipe.tags.all())
                 self.assertNotIn(pre_tag, recipe.tags.all())
 
+    def test_update_recipe_tags_change_index(self):
+        """Test the inverted index follow the tags of recipe when update!"""
+        recipe = create_recipe(user=self.user)
+        recipe.tags.add(Tag.objects.create(name='lunch'))
+        rebuild_recipe_index()
+        url = detail_url(recipe.id)
+        with patch('recipe.redis_set.RedisHandler.set_recipe') as mock_set_recipe, \
+            patch('recipe.redis_set.RedisHandler.update_hkey') as mock_update_hkey:
+                mock_set_recipe.return_value = None
+                mock_update_hkey.return_value = None
+                res = self.client.patch(url, {'tags': ['brunch']})
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        res_old = self.client.get(RECIPE_URL, {'tags': 'lunch', 'match': 'all'})
+        self.assertEqual(decode_content(res_old.content)['results'], [])
+        res_new = self.client.get(RECIPE_URL, {'tags': 'brunch', 'match': 'all'})
+        self.assertEqual([r['id'] for r in decode_content(res_new.content)['results']], [recipe.id])
+
     def test_clear_recipe_tags(self):
         """Test clear recipe tags!"""
         tag = Tag.objects.create(name='India')
@@ -610,42 +1233,145 @@ class PrivateAgentAPITests(TestCase):
                 recipe.refresh_from_db()
                 self.assertNotIn(tag, recipe.tags.all())
 
+    def test_search_recipe_by_tag_name(self):
+        """Test full text search find recipe created with tag and rank title match first!"""
+        payload = {
+            'title':'curry rice',
+            'cost_time':'40',
+            'description':'spicy and warm',
+            'tags':['dinner']
+        }
+        other_recipe = create_recipe(user=self.user, title='dinner salad')
+        unmatched_recipe = create_recipe(user=self.user, title='pancake')
+        with patch('recipe.redis_set.RedisHandler.set_recipe') as mock_set_recipe, \
+            patch('recipe.redis_set.RedisHandler.set_hkey') as mock_set_hkey:
+            mock_set_recipe.return_value = None
+            mock_set_hkey.return_value = None
+            res_create = self.client.post(RECIPE_URL, payload)
+            self.assertEqual(res_create.status_code, status.HTTP_201_CREATED)
+        update_search_vector(other_recipe)
+        update_search_vector(unmatched_recipe)
+        res = self.client.get(RECIPE_URL, {'q': 'dinner'})
+        res_content = decode_content(res.content)
+        result_id = [recipe['id'] for recipe in res_content['results']]
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(result_id, [other_recipe.id, res_create.data['id']])
+        self.assertNotIn(unmatched_recipe.id, result_id)
+
+    def clean_likes(self, recipe_id):
+        """Drop like set, likes counter and pending likes of recipe in redis, now and after test."""
+        handler = RedisHandler(redis_client1)
+        for clean in (handler.delete_recipe_in_cache, lambda recipe_id: handler.del_hkey('likes', recipe_id),
+                      lambda recipe_id: handler.del_prev_hkey('likes', recipe_id),
+                      lambda recipe_id: redis_client1.delete(LIKE_PENDING_HASH)):
+            clean(recipe_id)
+            self.addCleanup(clean, recipe_id)
+
     def test_like_recipe(self):
         """Test user like recipe api!"""
         recipe = create_recipe(user=self.user)
+        self.clean_likes(recipe.id)
         prev_recipe_like = recipe.likes
         payload = {
             'recipe_id':f'{recipe.id}'
         }
-        with patch('recipe.redis_set.RedisHandler.increase_recipe_view') as mock_increase_recipe_view:
-            mock_increase_recipe_view.return_value = True
-            res = self.client.post(LIKE_RECIPE_URL, payload)
-            recipe.refresh_from_db()
-            res_content = decode_content(res.content)
-            self.assertEqual(res.status_code, status.HTTP_200_OK)
-            self.assertEqual(recipe.likes, prev_recipe_like + 1)
-            self.assertEqual(res_content['message'], 'Like action successed!')
-            exist = Like.objects.filter(recipe=recipe, user=self.user)
-            self.assertTrue(exist)
+        res = self.client.post(LIKE_RECIPE_URL, payload)
+        res_content = decode_content(res.content)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res_content['message'], 'Like action successed!')
+        self.assertEqual(RedisHandler(redis_client1).get_hkey('likes', recipe.id), prev_recipe_like + 1)
+        # Like row and likes column are written by the flush tasks.
+        flush_recipe_likes()
+        consist_redis_and_sql_data()
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.likes, prev_recipe_like + 1)
+        exist = Like.objects.filter(recipe=recipe, user=self.user)
+        self.assertTrue(exist)
 
     def test_revoke_like_recipe(self):
         """Test user revoke like recipe api!!"""
         recipe = create_recipe(user=self.user, likes=1)
+        self.clean_likes(recipe.id)
         Like.objects.create(user=self.user, recipe=recipe)
         prev_recipe_like = recipe.likes
         payload = {
             'recipe_id':f'{recipe.id}'
         }
-        with patch('recipe.redis_set.RedisHandler.increase_recipe_view') as mock_increase_recipe_view:
-            mock_increase_recipe_view.return_value = True
-            res = self.client.post(LIKE_RECIPE_URL, payload)
-            recipe.refresh_from_db()
-            res_content = decode_content(res.content)
-            self.assertEqual(res.status_code, status.HTTP_200_OK)
-            self.assertEqual(recipe.likes, prev_recipe_like - 1)
-            self.assertEqual(res_content['message'], "Like action was revoke!")
-            exist = Like.objects.filter(recipe=recipe, user=self.user)
-            self.assertFalse(exist)
+        res = self.client.post(LIKE_RECIPE_URL, payload)
+        res_content = decode_content(res.content)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res_content['message'], "Like action was revoke!")
+        flush_recipe_likes()
+        consist_redis_and_sql_data()
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.likes, prev_recipe_like - 1)
+        exist = Like.objects.filter(recipe=recipe, user=self.user)
+        self.assertFalse(exist)
+
+    def test_like_toggle_in_redis(self):
+        """Test likes are flipped in redis without SQL after loaded, and only the last toggle is written!"""
+        recipe = create_recipe(user=self.user)
+        self.clean_likes(recipe.id)
+        payload = {'recipe_id': recipe.id}
+        self.client.post(LIKE_RECIPE_URL, payload)
+        with CaptureQueriesContext(connection) as queries:
+            res_revoke = self.client.post(LIKE_RECIPE_URL, payload)
+            res_like = self.client.post(LIKE_RECIPE_URL, payload)
+        self.assertEqual(decode_content(res_revoke.content)['message'], "Like action was revoke!")
+        self.assertEqual(decode_content(res_like.content)['message'], 'Like action successed!')
+        self.assertFalse([query for query in queries.captured_queries if 'recipe' in query['sql'].lower()])
+        self.assertEqual(RedisHandler(redis_client1).get_hkey('likes', recipe.id), 1)
+        self.assertFalse(Like.objects.filter(recipe=recipe).exists())
+        flush_recipe_likes()
+        self.assertEqual(Like.objects.filter(recipe=recipe, user=self.user).count(), 1)
+        res = self.client.post(LIKE_RECIPE_URL, {'recipe_id': 999999})
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_like_reload_apply_pending(self):
+        """Test like set reloaded from SQL keep the toggles not flushed yet, and expire when nobody toggle!"""
+        recipe = create_recipe(user=self.user)
+        other = create_user(username='likeother', email='likeother@example.com')
+        self.clean_likes(recipe.id)
+        handler = RedisHandler(redis_client1)
+        Like.objects.create(user=self.user, recipe=recipe)
+        self.client.post(LIKE_RECIPE_URL, {'recipe_id': recipe.id})
+        self.assertEqual(handler.get_liked([recipe.id], self.user.id), {recipe.id: False})
+        ttl = redis_client1.ttl(f'Recipe_liked_{recipe.id}')
+        self.assertTrue(0 < ttl <= LIKE_SET_TIMEOUT)
+
+        # Like set expired before the unlike is flushed, reload from SQL must not like again.
+        redis_client1.delete(f'Recipe_liked_{recipe.id}')
+        self.client.force_authenticate(other)
+        self.client.post(LIKE_RECIPE_URL, {'recipe_id': recipe.id})
+        self.assertEqual(handler.get_liked([recipe.id], self.user.id), {recipe.id: False})
+        self.assertEqual(handler.get_liked([recipe.id], other.id), {recipe.id: True})
+
+        handler.delete_recipe_in_cache(recipe.id)
+        self.assertFalse(redis_client1.exists(f'Recipe_liked_{recipe.id}'))
+
+    def test_recipe_interactions(self):
+        """Test like and save state of user on many recipes, likes not flushed to SQL yet are included!"""
+        recipes = [create_recipe(user=self.user) for _ in range(3)]
+        for recipe in recipes:
+            self.clean_likes(recipe.id)
+        Like.objects.create(user=self.user, recipe=recipes[0])
+        self.client.post(LIKE_RECIPE_URL, {'recipe_id': recipes[1].id})
+        Save.objects.create(user=self.user, recipe=recipes[2])
+        ids = [recipe.id for recipe in recipes]
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(INTERACTIONS_URL, {'ids': ",".join(str(recipe_id) for recipe_id in ids)})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(decode_content(res.content)['results'], [
+            {'id': ids[0], 'liked': True, 'saved': False},
+            {'id': ids[1], 'liked': True, 'saved': False},
+            {'id': ids[2], 'liked': False, 'saved': True},
+        ])
+        interaction_queries = [
+            query for query in queries.captured_queries if 'core_like' in query['sql'] or 'core_save' in query['sql']
+        ]
+        self.assertEqual(len(interaction_queries), 2)
+        res_bad = self.client.get(INTERACTIONS_URL, {'ids': ''})
+        self.assertEqual(res_bad.status_code, status.HTTP_400_BAD_REQUEST)
 
     def test_save_recipe(self):
         """Test user save recipe action !!!"""
@@ -748,4 +1474,395 @@ class PrivateAgentAPITests(TestCase):
             self.assertEqual(res.status_code, status.HTTP_200_OK)
             self.assertEqual(res_content['message'], 'User unsaved the tag !')
             exist = Save.objects.filter(user=self.user, tag=tag)
-            self.assertFalse(exist)
\ No newline at end of file
+            self.assertFalse(exist)
+
+
+class RecipeQueryBudgetTests(TestCase):
+    """Test the recipe endpoints stay in their SQL query budget!"""
+    # count + recipe with user + tags + ingredients + photos + steps
+    LIST_BUDGET = 6
+    # recipe with user + tags + ingredients + photos + steps + top five comments
+    DETAIL_BUDGET = 6
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(email='budget@example.com', username='budget')
+
+    def test_recipe_list_query_budget(self):
+        """Test the query number of list not grow with the number of recipes!"""
+        for index in range(2):
+            create_full_recipe(self.user, index)
+        with assert_max_queries(self, self.LIST_BUDGET) as small_page:
+            res = self.client.get(RECIPE_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        for index in range(2, 12):
+            create_full_recipe(self.user, index)
+        with assert_max_queries(self, self.LIST_BUDGET) as full_page:
+            res = self.client.get(RECIPE_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(decode_content(res.content)['results']), 12)
+        self.assertEqual(len(small_page.captured_queries), len(full_page.captured_queries))
+
+    def test_recipe_cursor_list_query_budget(self):
+        """Test the cursor list has no count query!"""
+        for index in range(5):
+            create_full_recipe(self.user, index)
+        with assert_max_queries(self, self.LIST_BUDGET - 1):
+            res = self.client.get(RECIPE_URL, {'pagination': 'cursor'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_recipe_search_query_budget(self):
+        """Test the full text search list stay in budget!"""
+        for index in range(5):
+            recipe = create_full_recipe(self.user, index)
+            update_search_vector(recipe)
+        with assert_max_queries(self, self.LIST_BUDGET):
+            res = self.client.get(RECIPE_URL, {'q': 'full'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(decode_content(res.content)['results']), 5)
+
+    def test_recipe_list_sparse_fields_query_budget(self):
+        """Test list with ?fields= and ?expand= only load the asked relations!"""
+        for index in range(5):
+            create_full_recipe(self.user, index)
+        params = {'fields': 'id,title', 'expand': 'likes,main_photo'}
+        # count + recipe columns + photos
+        with assert_max_queries(self, 3):
+            res = self.client.get(RECIPE_URL, params)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        results = decode_content(res.content)['results']
+        self.assertEqual(len(results), 5)
+        self.assertEqual(set(results[0]), {'id', 'title', 'likes', 'main_photo'})
+        self.assertEqual(results[0]['main_photo']['category'], 'main')
+
+        # Page ids are cached, expand load the page without count.
+        with assert_max_queries(self, 2):
+            res_cached = self.client.get(RECIPE_URL, params)
+        self.assertEqual(decode_content(res_cached.content)['results'], results)
+
+        res_fields = self.client.get(RECIPE_URL, {'fields': 'id,tags'})
+        self.assertEqual(set(decode_content(res_fields.content)['results'][0]), {'id', 'tags'})
+
+    def test_recipe_retrieve_sparse_fields(self):
+        """Test retrieve with ?fields= skip the other fields!"""
+        recipe = create_full_recipe(self.user, 0)
+        redis_client1.delete(f'Recipe_payload_{recipe.id}')
+        with patch('recipe.redis_set.RedisHandler.increase_recipe_view') as mock_increase_recipe_view:
+            mock_increase_recipe_view.return_value = None
+            res = self.client.get(detail_url(recipe.id), {'fields': 'id,title'})
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(decode_content(res.content), {'id': recipe.id, 'title': recipe.title})
+            res_cached = self.client.get(detail_url(recipe.id), {'fields': 'id,title'})
+            self.assertEqual(decode_content(res_cached.content)['recipe'], {'id': recipe.id, 'title': recipe.title})
+
+    def test_recipe_retrieve_etag(self):
+        """Test conditional GET of recipe get 304 without SQL, until recipe is changed!"""
+        recipe = create_full_recipe(self.user, 0)
+        handler = RedisHandler(redis_client1)
+        handler.delete_recipe_in_cache(recipe.id)
+        self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        handler.del_hkey('views', recipe.id)
+        handler.set_hkey(hkey_name='views', recipe_id=recipe.id)
+        res = self.client.get(detail_url(recipe.id))
+        etag = res['ETag']
+        with assert_max_queries(self, 0):
+            res_not_modified = self.client.get(detail_url(recipe.id), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res_not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(handler.get_hkey('views', recipe.id), 1)
+        # Body has live views, ETag is weak and compared weakly.
+        self.assertTrue(etag.startswith('W/"'))
+        res_strong = self.client.get(detail_url(recipe.id), HTTP_IF_NONE_MATCH=etag[2:])
+        self.assertEqual(res_strong.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        res_any = self.client.get(detail_url(recipe.id), HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(res_any.status_code, status.HTTP_304_NOT_MODIFIED)
+        res_any_missing = self.client.get(detail_url(recipe.id + 1000), HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(res_any_missing.status_code, status.HTTP_404_NOT_FOUND)
+
+        res_fields = self.client.get(detail_url(recipe.id), {'fields': 'id'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res_fields.status_code, status.HTTP_200_OK)
+
+        recipe.title = 'changed'
+        recipe.save()
+        res_changed = self.client.get(detail_url(recipe.id), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res_changed.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res_changed['ETag'], etag)
+
+    def test_recipe_retrieve_cached_payload(self):
+        """Test cached detail is served as bytes, gzip when accepted, with live counters!"""
+        recipe = create_full_recipe(self.user, 0)
+        handler = RedisHandler(redis_client1)
+        handler.delete_recipe_in_cache(recipe.id)
+        self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        for name in ('views', 'likes', 'save_count'):
+            handler.del_hkey(name, recipe.id)
+            handler.set_hkey(hkey_name=name, recipe_id=recipe.id)
+        handler.redis_client.hset('Recipe_likes', recipe.id, 7)
+        res = self.client.get(detail_url(recipe.id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        with assert_max_queries(self, 0), patch.object(
+            redis_client1, 'execute_command', wraps=redis_client1.execute_command
+        ) as mock_execute_command:
+            res_plain = self.client.get(detail_url(recipe.id))
+        # A view is one script call, static detail is not written.
+        self.assertEqual([call.args[0] for call in mock_execute_command.call_args_list], ['EVALSHA'])
+        self.assertFalse(res_plain.has_header('Content-Encoding'))
+        content = decode_content(res_plain.content)['recipe']
+        self.assertEqual(content['title'], recipe.title)
+        self.assertEqual(content['likes'], 7)
+        self.assertEqual(content['views'], 2)
+
+        res_gzip = self.client.get(detail_url(recipe.id), HTTP_ACCEPT_ENCODING='br, gzip')
+        self.assertEqual(res_gzip['Content-Encoding'], 'gzip')
+        content_gzip = json.loads(gzip.decompress(res_gzip.content))['recipe']
+        self.assertEqual(content_gzip, {**content, 'views': 3})
+
+    def test_recipe_retrieve_single_flight(self):
+        """Test request miss the detail wait for the one holding the lock, instead of loading SQL!"""
+        recipe = create_full_recipe(self.user, 0)
+        data = RecipeSQLDetailSerializer(recipe).data
+        handler = RedisHandler(redis_client1)
+        handler.delete_recipe_in_cache(recipe.id)
+        self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        lock = f"Recipe_detail_{recipe.id}"
+        token = handler.acquire_lock(lock)
+        self.addCleanup(handler.release_lock, lock, token)
+        self.assertIsNone(handler.acquire_lock(lock))
+
+        with patch('recipe.redis_set.time.sleep', side_effect=lambda _: handler.set_recipe(recipe.id, data)):
+            with assert_max_queries(self, 0):
+                res = self.client.get(detail_url(recipe.id))
+        self.assertEqual(decode_content(res.content)['recipe']['title'], recipe.title)
+        # ETag of waiter is from the version stored in payload, same as the next request.
+        self.assertEqual(res['ETag'], self.client.get(detail_url(recipe.id))['ETag'])
+
+        # Lock released without payload, waiter load SQL by itself.
+        handler.delete_recipe_in_cache(recipe.id)
+        with patch('recipe.redis_set.time.sleep', side_effect=lambda _: handler.release_lock(lock, token)):
+            res_released = self.client.get(detail_url(recipe.id))
+        self.assertEqual(decode_content(res_released.content)['title'], recipe.title)
+        self.assertIsNotNone(handler.get_payload(recipe.id))
+
+    def test_recipe_retrieve_refresh_early(self):
+        """Test payload near expiry is refreshed by only one celery task!"""
+        recipe = create_full_recipe(self.user, 0)
+        handler = RedisHandler(redis_client1)
+        handler.set_recipe(recipe.id, RecipeSQLDetailSerializer(recipe).data, delta=0.1)
+        self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        self.addCleanup(redis_client1.delete, f"Lock_Recipe_refresh_{recipe.id}")
+        payload = handler.get_payload(recipe.id)
+        self.assertFalse(handler.should_refresh_early(payload))
+        self.assertTrue(handler.should_refresh_early({**payload, 'expiry': time.time()}))
+
+        redis_client1.hset(f'Recipe_payload_{recipe.id}', 'expiry', time.time() - 1)
+        with patch('recipe.views.refresh_recipe_detail.delay') as mock_delay:
+            self.client.get(detail_url(recipe.id))
+            self.client.get(detail_url(recipe.id))
+        mock_delay.assert_called_once()
+        self.assertEqual(mock_delay.call_args.args[0], recipe.id)
+
+        refresh_recipe_detail(recipe.id, mock_delay.call_args.args[1])
+        self.assertFalse(handler.should_refresh_early(handler.get_payload(recipe.id)))
+        self.assertIsNotNone(handler.acquire_lock(f"Recipe_refresh_{recipe.id}"))
+
+    def test_recipe_cache_codecs(self):
+        """Test every codec read back the cached list data, and values of old and new codec live together!"""
+        recipe = create_full_recipe(self.user, 0)
+        data = RecipeSQLDetailSerializer(recipe).data
+        handler = RedisHandler(redis_client1)
+        self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        for name, codec in CODECS.items():
+            self.assertEqual(cache_codec.decode(codec.encode(data)), json.loads(json.dumps(data)))
+        # Value written before codecs is plain json.
+        redis_client1.set(f'Recipe_list_item_{recipe.id}', json.dumps(data))
+        compressed = RedisHandler(redis_client1, codec='zlib-json')
+        self.assertEqual(compressed.get_list_items([recipe.id])[recipe.id]['title'], recipe.title)
+        compressed.set_list_items([data])
+        raw = redis_client1.get(f'Recipe_list_item_{recipe.id}')
+        self.assertEqual(raw[:1], CODECS['zlib-json'].tag)
+        self.assertLess(len(raw), len(json.dumps(data)))
+        self.assertEqual(handler.get_list_items([recipe.id])[recipe.id]['title'], recipe.title)
+        self.assertEqual(RedisHandler(redis_client1, codec='unknown').codec.name, 'json')
+        redis_client1.set(f'Recipe_list_item_{recipe.id}', b'\x7fbad')
+        self.assertEqual(handler.get_list_items([recipe.id]), {})
+
+    def test_recipe_cache_codec_corrupt_value(self):
+        """Test corrupt value of any codec is a ValueError, so reader skip it like a miss!"""
+        corrupt = [CODECS['zlib-json'].tag + b'not zlib', CODECS['zlib-json'].tag + zlib.compress(b'{broken')]
+        if 'msgpack' in CODECS:
+            corrupt.append(CODECS['msgpack'].tag + b'\xc1')
+        if 'zstd-json' in CODECS:
+            corrupt.append(CODECS['zstd-json'].tag + b'not zstd')
+        for raw in corrupt:
+            with self.assertRaises(ValueError):
+                cache_codec.decode(raw)
+        with self.assertRaises(TypeError):
+            cache_codec.Codec()
+
+    def test_recipe_detail_only_in_payload(self):
+        """Test detail is cached once as payload, batch and get_recipe read it with live counters!"""
+        recipe = create_full_recipe(self.user, 0)
+        data = RecipeSQLDetailSerializer(recipe).data
+        handler = RedisHandler(redis_client1)
+        handler.delete_recipe_in_cache(recipe.id)
+        self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        handler.set_recipe(recipe.id, data)
+        self.assertFalse(redis_client1.exists(f'Recipe_detail_{recipe.id}'))
+        self.assertEqual(handler.get_recipe(recipe.id)['title'], recipe.title)
+        handler.redis_client.hset('Recipe_likes', recipe.id, 9)
+        self.addCleanup(handler.del_hkey, 'likes', recipe.id)
+        cached = handler.get_recipes([recipe.id])[recipe.id]
+        self.assertEqual(cached['likes'], 9)
+        self.assertEqual(cached['steps'], json.loads(json.dumps(data['steps'])))
+
+    def test_local_cache_caps(self):
+        """Test local cache drop the least recently used over entries or bytes, and the expired!"""
+        cache = LocalCache(max_entries=2, max_bytes=10, timeout=30)
+        cache.set(('payload', 1), 'a', 4)
+        cache.set(('payload', 2), 'b', 4)
+        cache.get(('payload', 1))
+        cache.set(('payload', 3), 'c', 4)
+        self.assertIsNone(cache.get(('payload', 2)))
+        self.assertEqual(cache.get(('payload', 1)), 'a')
+        cache.set(('detail', 4), 'd', 6)
+        self.assertEqual(cache.size, 10)
+        self.assertIsNone(cache.get(('payload', 3)))
+        cache.set(('detail', 5), 'too big', 11)
+        self.assertIsNone(cache.get(('detail', 5)))
+        cache.invalidate([1])
+        self.assertIsNone(cache.get(('payload', 1)))
+        with patch('recipe.redis_set.time.monotonic', return_value=time.monotonic() + 31):
+            self.assertIsNone(cache.get(('detail', 4)))
+        self.assertEqual(cache.size, 0)
+
+    def test_recipe_retrieve_local_cache(self):
+        """Test hot detail is served from local cache, dropped when other worker publish the change!"""
+        # Local cache is off by default.
+        self.assertFalse(local_cache.enabled)
+        for name, value in (('max_entries', 500), ('max_bytes', 16 * 1024 * 1024), ('timeout', 30)):
+            patcher = patch.object(local_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(local_cache.clear)
+        recipe = create_full_recipe(self.user, 0)
+        handler = RedisHandler(redis_client1)
+        handler.set_recipe(recipe.id, RecipeSQLDetailSerializer(recipe).data)
+        self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        res_first = self.client.get(detail_url(recipe.id))
+        payload_stale = local_cache.get(('payload', recipe.id, False))
+        self.assertIsNotNone(payload_stale)
+        recipe_title = recipe.title
+
+        # Payload bytes are not read from redis, only the counters.
+        redis_client1.hset(f'Recipe_payload_{recipe.id}', 'json', b'broken')
+        res = self.client.get(detail_url(recipe.id))
+        self.assertEqual(decode_content(res.content)['recipe']['title'], recipe.title)
+        self.assertEqual(res['ETag'], res_first['ETag'])
+
+        # ETag of stale local payload has its own version, so it differ from the ETag of the fresh payload.
+        recipe.title = 'local fresh'
+        recipe.save()
+        handler.set_recipe(recipe.id, RecipeSQLDetailSerializer(recipe).data)
+        local_cache.set(('payload', recipe.id, False), payload_stale, len(payload_stale['body']))
+        res_stale = self.client.get(detail_url(recipe.id))
+        self.assertEqual(decode_content(res_stale.content)['recipe']['title'], recipe_title)
+        local_cache.clear()
+        res_fresh = self.client.get(detail_url(recipe.id), HTTP_IF_NONE_MATCH=res_stale['ETag'])
+        self.assertEqual(res_fresh.status_code, status.HTTP_200_OK)
+        self.assertEqual(decode_content(res_fresh.content)['recipe']['title'], 'local fresh')
+
+        redis_client1.publish(LOCAL_INVALIDATE_CHANNEL, json.dumps([recipe.id]))
+        for _ in range(100):
+            if local_cache.get(('payload', recipe.id, False)) is None:
+                break
+            time.sleep(0.02)
+        self.assertIsNone(local_cache.get(('payload', recipe.id, False)))
+
+    def test_recipe_retrieve_missing_cached(self):
+        """Test 404 of recipe is answered from redis until the id is created!"""
+        handler = RedisHandler(redis_client1)
+        recipe_id = Recipe.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        missing_id = recipe_id + 1
+        self.addCleanup(handler.clear_missing, missing_id, missing_id + 1)
+        handler.delete_recipe_in_cache(missing_id)
+        res = self.client.get(detail_url(missing_id))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        with assert_max_queries(self, 0):
+            res_cached = self.client.get(detail_url(missing_id))
+        self.assertEqual(res_cached.status_code, status.HTTP_404_NOT_FOUND)
+
+        with assert_max_queries(self, 0):
+            res_batch = self.client.get(BATCH_URL, {'ids': str(missing_id)})
+        self.assertEqual(decode_content(res_batch.content)['missing'], [missing_id])
+        self.client.get(BATCH_URL, {'ids': str(missing_id + 1)})
+        self.assertEqual(handler.get_missing([missing_id, missing_id + 1]), {missing_id, missing_id + 1})
+
+        recipe = Recipe.objects.create(id=missing_id, user=self.user, title='created later', cost_time='20', description='later')
+        self.addCleanup(handler.delete_recipe_in_cache, recipe.id)
+        res_created = self.client.get(detail_url(recipe.id))
+        self.assertEqual(res_created.status_code, status.HTTP_200_OK)
+
+    def test_recipe_retrieve_query_budget(self):
+        """Test retrieve recipe without cache stay in budget!"""
+        recipe = create_full_recipe(self.user, 0)
+        for _ in range(6):
+            RecipeComment.objects.create(user=self.user, recipe=recipe, comment='more', rating=4)
+        with patch('recipe.redis_set.RedisHandler.get_recipe') as mock_get_recipe, \
+            patch('recipe.redis_set.RedisHandler.view_recipe') as mock_view_recipe, \
+            patch('recipe.redis_set.RedisHandler.set_recipe') as mock_set_recipe, \
+            patch('recipe.redis_set.RedisHandler.increase_recipe_view') as mock_increase_recipe_view:
+            mock_get_recipe.return_value = None
+            mock_view_recipe.return_value = (None, {}, 0, False)
+            mock_set_recipe.return_value = None
+            mock_increase_recipe_view.return_value = None
+            with assert_max_queries(self, self.DETAIL_BUDGET):
+                res = self.client.get(detail_url(recipe.id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(decode_content(res.content)['top_five_comments']), 5)
+
+    def test_recipe_batch_query_budget(self):
+        """Test batch get cached recipes in one MGET and load all misses in constant queries!"""
+        recipes = [create_full_recipe(self.user, index) for index in range(3)]
+        for recipe in recipes:
+            for _ in range(6):
+                RecipeComment.objects.create(user=self.user, recipe=recipe, comment='more', rating=4)
+        handler = RedisHandler(redis_client1)
+        detail_keys = [f'Recipe_payload_{recipe.id}' for recipe in recipes]
+        handler.redis_client.delete(*detail_keys)
+        self.addCleanup(handler.redis_client.delete, *detail_keys)
+        handler.set_recipe(recipe_id=recipes[0].id, data={'id': recipes[0].id, 'title': 'cached'})
+        handler.redis_client.hset('Recipe_likes', recipes[2].id, 7)
+        self.addCleanup(handler.del_hkey, 'likes', recipes[2].id)
+        ids = [recipes[2].id, recipes[0].id, 999999, recipes[1].id]
+
+        with assert_max_queries(self, self.DETAIL_BUDGET):
+            res = self.client.get(BATCH_URL, {'ids': ",".join(str(recipe_id) for recipe_id in ids)})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        content = decode_content(res.content)
+        self.assertEqual([r['id'] for r in content['results']], [recipes[2].id, recipes[0].id, recipes[1].id])
+        self.assertEqual(content['results'][1]['title'], 'cached')
+        self.assertEqual(len(content['results'][0]['top_five_comments']), 5)
+        self.assertEqual(content['results'][0]['likes'], 7)
+        self.assertEqual(content['missing'], [999999])
+
+        with assert_max_queries(self, 0):
+            res_cached = self.client.get(BATCH_URL, {'ids': f'{recipes[1].id},{recipes[2].id}', 'fields': 'id,title'})
+        self.assertEqual(decode_content(res_cached.content)['results'], [
+            {'id': recipes[1].id, 'title': recipes[1].title},
+            {'id': recipes[2].id, 'title': recipes[2].title},
+        ])
+
+        res_bad = self.client.get(BATCH_URL, {'ids': 'a,b'})
+        self.assertEqual(res_bad.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_comment_list_query_budget(self):
+        """Test comment list load user and recipe with join!"""
+        recipe = create_full_recipe(self.user, 0)
+        for _ in range(5):
+            RecipeComment.objects.create(user=self.user, recipe=recipe, comment='more', rating=4)
+        # count + comments with user and recipe
+        with assert_max_queries(self, 2):
+            res = self.client.get(RECIPE_COMMENT_URL, {'recipe_id': recipe.id})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
@@ -1,6 +1,10 @@
 import boto3
+import base64
 import datetime
+import hashlib
+import json
 import django_redis
+from collections import OrderedDict
 
 from asgiref.sync import async_to_sync
 
@@ -13,12 +17,16 @@ from botocore.signers import CloudFrontSigner
 
 from django.views.decorators.csrf import csrf_protect
 from django.conf import settings
-from django.db.models import F
+from django.db.models import F, Q, Case, When, Value, DecimalField, ExpressionWrapper
+from django.db.models.functions import Cast
+from django.utils.dateparse import parse_datetime
 
 from rest_framework.response import Response
 from rest_framework import serializers, status
 from rest_framework.viewsets import ModelViewSet
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import PageNumberPagination, BasePagination
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 
 from core import models
 from .redis_set import RedisHandler
@@ -73,11 +81,13 @@ def saved_action(user, obj):
         if created:
             obj.save_count =F('save_count') + 1
             obj.save(update_fields=['save_count'])
+            recipe_redis_handler.increase_popularity("Tag", {obj.name: 1})
             return Response({'message':'User save the tag!'}, status=status.HTTP_200_OK)
         elif save:
             obj.save_count =F('save_count') - 1
             obj.save(update_fields=['save_count'])
             save.delete()
+            recipe_redis_handler.increase_popularity("Tag", {obj.name: -1})
             return Response({'message':'User unsaved the tag !'}, status=status.HTTP_200_OK)
         else:
             return Response({'error': 'Unknow error'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -86,17 +96,73 @@ def saved_action(user, obj):
         if created:
             obj.save_count =F('save_count') + 1
             obj.save(update_fields=['save_count'])
+            recipe_redis_handler.increase_popularity("Ingredient", {obj.name: 1})
             return Response({'message':'User save the ingredient!'}, status=status.HTTP_200_OK)
         elif save:
             obj.save_count =F('save_count') - 1
             obj.save(update_fields=['save_count'])
             save.delete()
+            recipe_redis_handler.increase_popularity("Ingredient", {obj.name: -1})
             return Response({'message':'User unsaved the ingredient !'}, status=status.HTTP_200_OK)
         else:
             return Response({'error': 'Unknow error'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     else:
         return Response({'error': 'No valid object found'}, status=status.HTTP_400_BAD_REQUEST)
 
+def make_etag(*parts):
+    """
+    Weak ETag from the versions and params decide the response body.
+    Weak because live counters (views) in body change without the versions.
+    """
+    return 'W/"%s"' % hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+def etag_matches(request, etag, exists=True):
+    """
+    Check If-None-Match of request with weak comparison.
+
+    :param exists: The resource exists, "*" match nothing when it is False.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return exists
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    return opaque in [tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip() for tag in if_none_match.split(",")]
+
+def not_modified(etag):
+    """304 response without body."""
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+def accepts_gzip(request):
+    """Check Accept-Encoding of request allow gzip."""
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(" ", "") not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+def change_recipe_rating(recipe_id, count_delta, rating_delta):
+    """
+    Apply a comment change to the stored comment stats of recipe.
+    All three fields are computed from the row in one UPDATE, so concurrent comments never lose a change.
+
+    :param recipe_id: The ID of the recipe. Must be an integer.
+    :param count_delta: 1 for new comment, -1 for deleted comment, 0 for rating changed.
+    :param rating_delta: The change of rating sum.
+    """
+    new_count = F('comment_count') + count_delta
+    new_sum = Cast(F('rating_sum') + rating_delta, DecimalField(max_digits=12, decimal_places=2))
+    models.Recipe.objects.filter(id=recipe_id).update(
+        comment_count=F('comment_count') + count_delta,
+        rating_sum=F('rating_sum') + rating_delta,
+        average_rating=Case(
+            When(comment_count__lte=-count_delta, then=Value(None)),
+            default=ExpressionWrapper(new_sum / new_count, output_field=DecimalField(max_digits=3, decimal_places=2)),
+            output_field=DecimalField(max_digits=3, decimal_places=2)
+        )
+    )
+
 class UnsafeMethodCSRFMixin(ModelViewSet):
     """Amixin that applies CSRF protection to unsafe HTTP methods (POST, PATCH, PUT, DELETE....)"""
 
@@ -118,7 +184,139 @@ class CustomSlugRelatedField(serializers.SlugRelatedField):
                 return data
             raise e
 
+class DynamicFieldsMixin:
+    """
+    Serializer mixin for sparse fieldsets.
+    Projection in context, ex: {'fields': ['id', 'title'], 'expand': ['likes']},
+    keep only the fields asked and add the fields of Meta.expandable_fields asked in expand.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        projection = self.context.get('projection')
+        if not projection:
+            return
+        expandable_fields = getattr(self.Meta, 'expandable_fields', {})
+        expand = [name for name in projection.get('expand', []) if name in expandable_fields]
+        for name in expand:
+            if name not in self.fields:
+                self.fields[name] = expandable_fields[name]()
+        if projection.get('fields'):
+            for name in set(self.fields) - set(projection['fields']) - set(expand):
+                self.fields.pop(name)
+
+    @staticmethod
+    def project(data, fields):
+        """Keep only the fields of already serialized data, ex: recipe from cache."""
+        if not fields:
+            return data
+        return {key: value for key, value in data.items() if key in fields}
+
+
 class CustomPagination(PageNumberPagination):
     """Customerized the page numer."""
     page_size = 30
 
+
+class RecipeCursorPagination(BasePagination):
+    """
+    Keyset pagination for recipe list.
+    The opaque cursor keep (ordering value, id) of the last recipe in page,
+    next page is filtered by WHERE (value, id) > cursor instead of OFFSET,
+    so page N cost the same as page 1 and there is no COUNT(*) query.
+    """
+    page_size = 30
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    # ordering name: (field, descending)
+    orderings = {
+        'create_time': ('create_time', False),
+        '-create_time': ('create_time', True),
+        '-views': ('views', True),
+        '-likes': ('likes', True),
+        '-save_count': ('save_count', True),
+    }
+    default_ordering = 'create_time'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """Return one page of recipe after the cursor."""
+        self.request = request
+        self.ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        if self.ordering not in self.orderings:
+            self.ordering = self.default_ordering
+        field, descending = self.orderings[self.ordering]
+
+        if descending:
+            queryset = queryset.order_by(f'-{field}', '-id')
+        else:
+            queryset = queryset.order_by(field, 'id')
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            value, last_id = self.decode_cursor(encoded, field)
+            lookup = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': last_id})
+            )
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def encode_cursor(self, instance):
+        """Make the opaque cursor from the last recipe of page."""
+        field, _ = self.orderings[self.ordering]
+        value = getattr(instance, field)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        raw = json.dumps([self.ordering, value, instance.id]).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    def decode_cursor(self, encoded, field):
+        """
+        Read the cursor, cursor of other ordering is invalid.
+        Value is cast to the type of field here, so a tampered cursor never reach SQL.
+        """
+        try:
+            ordering, value, last_id = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            if ordering != self.ordering:
+                raise ValueError(ordering)
+            if field == 'create_time':
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError(value)
+            elif isinstance(value, (int, str)) and not isinstance(value, bool):
+                value = int(value)
+            else:
+                raise ValueError(value)
+            return value, int(last_id)
+        except (TypeError, ValueError, UnicodeError):
+            raise ParseError(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+        return remove_query_param(url, 'page')
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                    'format': 'uri',
+                },
+                'results': schema,
+            },
+        }
@@ -7,7 +7,7 @@ from rest_framework import (
         filters
 )
 from rest_framework.response import Response
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.permissions import IsAuthenticated
 
 from drf_spectacular.utils import (
@@ -18,26 +18,64 @@ from drf_spectacular.utils import (
         OpenApiTypes
 )
 from django.views.decorators.csrf import csrf_protect
+from django.http import HttpResponse
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.db.models import Q, F, Count, Avg
+from django.db.models import Q
+from django.db import transaction
 from functools import reduce
 from operator import or_
+import base64
+import time
+from urllib.parse import urlsplit, urlunsplit
 
 from core import models
 from core import permissions as Customize_permission
 from recipe import serializers
-from .utils import UnsafeMethodCSRFMixin, saved_action, CustomPagination
+from .utils import (
+        UnsafeMethodCSRFMixin,
+        saved_action,
+        change_recipe_rating,
+        make_etag,
+        etag_matches,
+        not_modified,
+        accepts_gzip,
+        CustomPagination,
+        RecipeCursorPagination
+)
+from .search import search_recipes
+from .tasks import refresh_recipe_detail
 
 from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 import django_redis
-from .redis_set import RedisHandler
+from .redis_set import RedisHandler, LIST_CACHE_TIMEOUT, FACET_ALL_KEY, FACET_ALL_TIMEOUT
 redis_client1 = django_redis.get_redis_connection("default")
 
+SUGGEST_MAX_LIMIT = 50
+BATCH_MAX_IDS = 100
+
 
 @extend_schema_view(
     list=extend_schema(
         parameters=[
+            OpenApiParameter(
+                "q",
+                OpenApiTypes.STR,
+                description="Full text search over title, description, tag and ingredient names, result ordered by rank. Other filters are ignored when q is given.",
+            ),
+            OpenApiParameter(
+                "pagination",
+                OpenApiTypes.STR,
+                enum=["page", "cursor"],
+                description="Use cursor to get keyset pagination without count, follow the next link to get next page.",
+            ),
+            OpenApiParameter(
+                "ordering",
+                OpenApiTypes.STR,
+                enum=list(RecipeCursorPagination.orderings),
+                description="Ordering of cursor pagination, default is create_time.",
+            ),
             OpenApiParameter(
                 "tags",
                 OpenApiTypes.STR,
@@ -48,6 +86,28 @@ redis_client1 = django_redis.get_redis_connection("default")
                 OpenApiTypes.STR,
                 description="Comma seprated list of ingredient name to filter.",
             ),
+            OpenApiParameter(
+                "fields",
+                OpenApiTypes.STR,
+                description="Comma separated list of fields to return. ex: id,title,main_photo,likes",
+            ),
+            OpenApiParameter(
+                "expand",
+                OpenApiTypes.STR,
+                enum=["likes", "main_photo"],
+                description="Comma separated list of fields not returned by default.",
+            ),
+            OpenApiParameter(
+                "facets",
+                OpenApiTypes.BOOL,
+                description="Also return the recipe count of top tags and ingredients under the current filter.",
+            ),
+            OpenApiParameter(
+                "match",
+                OpenApiTypes.STR,
+                enum=["all", "any"],
+                description="Filter tags and ingredients by whole name (case insensitive), all: recipe has every name, any: recipe has one of names.",
+            ),
         ],
         responses={
             200:serializers.RecipeSerialzier(many=True),
@@ -114,6 +174,13 @@ redis_client1 = django_redis.get_redis_connection("default")
         ]
     ),
     retrieve=extend_schema(
+        parameters=[
+            OpenApiParameter(
+                "fields",
+                OpenApiTypes.STR,
+                description="Comma separated list of fields to return. ex: id,title,top_five_comments",
+            ),
+        ],
         responses={
             200:serializers.RecipeSQLDetailSerializer,
             400:serializers.ResponseSerializer,
@@ -276,15 +343,26 @@ redis_client1 = django_redis.get_redis_connection("default")
 class RecipeViewSet(UnsafeMethodCSRFMixin, viewsets.ModelViewSet):
     """Views for manage recipe APIs."""
     serializer_class = serializers.RecipeSQLDetailSerializer
-    queryset = models.Recipe.objects.all().order_by("create_time")
+    queryset = models.Recipe.objects.all().defer("search_vector").order_by("create_time")
     permission_classes = [permissions.IsAuthenticated]
     filter_backend = [filters.OrderingFilter]
     ordering_fields = ['create_time', 'name']
     ordering = ['create_time']
     recipe_redis_handler = RedisHandler(redis_client1)
+    # list cache: kind of version counter and query param of filter
+    list_filter_params = {'tag': 'tags', 'ingredient': 'ingredients', 'user': 'user'}
+    list_page_params = ['pagination', 'page', 'cursor', 'ordering', 'q', 'match', 'facets']
+    # facets: params decide the matched recipes, page params are not.
+    facet_params = ['q', 'match']
+    # pagination links in meta of cached page
+    list_link_keys = ('next', 'previous')
+    # match mode: kind of redis inverted index and query param of filter
+    index_filter_params = {'Tag': 'tags', 'Ingredient': 'ingredients'}
+    # sparse fieldsets: relation prefetched for serializer field
+    prefetch_fields = {'tags': 'tags', 'ingredients': 'ingredients', 'photos': 'photos', 'steps': 'steps', 'main_photo': 'photos'}
 
     def get_permissions(self):
-        if self.action in ['list','retrieve']:
+        if self.action in ['list','retrieve', 'pantry', 'trending', 'batch']:
             permission_classes = [permissions.AllowAny]
         elif self.action in ['update', 'partial_update', 'destroy']:
             permission_classes = [Customize_permission.IsAdminOrRecipeOwmer]
@@ -294,20 +372,60 @@ class RecipeViewSet(UnsafeMethodCSRFMixin, viewsets.ModelViewSet):
 
     def get_serializer_class(self):
         """Return serializer class for request!"""
-        if self.action == 'list':
+        if self.action in ['list', 'pantry', 'trending', 'feed']:
             return serializers.RecipeSerialzier
         return self.serializer_class
 
+    def get_projection(self):
+        """Fields and expand asked by ?fields= and ?expand=, None for full data or write request."""
+        if self.request.method != 'GET':
+            return None
+        fields = [name for name in self.request.query_params.get('fields', '').split(",") if name]
+        expand = [name for name in self.request.query_params.get('expand', '').split(",") if name]
+        if not fields and not expand:
+            return None
+        return {'fields': fields, 'expand': expand}
+
+    def get_serializer_context(self):
+        """Pass projection to DynamicFieldsMixin of serializer."""
+        context = super().get_serializer_context()
+        projection = self.get_projection()
+        if projection:
+            context['projection'] = projection
+        return context
+
+    def with_relations(self, queryset, projection=None):
+        """
+        Load user, tags, ingredients, photos and steps of all recipes in constant number of queries.
+        With projection of fields, only the asked columns and relations are loaded.
+        """
+        if not projection or not projection['fields']:
+            return queryset.select_related('user').prefetch_related('tags', 'ingredients', 'photos', 'steps')
+        names = set(projection['fields']) | set(projection['expand'])
+        concrete_fields = {field.name for field in models.Recipe._meta.concrete_fields}
+        # Ordering fields are kept for pagination.
+        ordering_fields = {field for field, descending in RecipeCursorPagination.orderings.values()}
+        queryset = queryset.only(*(({'id'} | ordering_fields | names) & concrete_fields))
+        if 'user' in names:
+            queryset = queryset.select_related('user')
+        prefetch = {self.prefetch_fields[name] for name in names if name in self.prefetch_fields}
+        return queryset.prefetch_related(*sorted(prefetch))
+
     def get_queryset(self):
         """Retrun query for filter!"""
-        queryset = self.queryset.annotate(
-        comment_count=Count('recipe_comment'),
-        average_rating=Avg('recipe_comment__rating')
-        )
+        queryset = self.with_relations(self.queryset, self.get_projection())
+        search_text = self.request.query_params.get('q')
+        if search_text:
+            return search_recipes(queryset, search_text)
+
         search_ingertients = self.request.query_params.get('ingredients')
         search_tags = self.request.query_params.get('tags')
         search_user = self.request.query_params.get('user')
 
+        match = self.request.query_params.get('match')
+        if match in ('all', 'any'):
+            return self.match_queryset(queryset, match)
+
         reqeust_filters = Q()
 
         if search_ingertients :
@@ -326,6 +444,106 @@ class RecipeViewSet(UnsafeMethodCSRFMixin, viewsets.ModelViewSet):
 
         return queryset.filter(reqeust_filters).distinct()
 
+    def get_match_names(self):
+        """Exact names of tags and ingredients to filter in match mode, by kind of index."""
+        names = {}
+        for kind, param in self.index_filter_params.items():
+            value = self.request.query_params.get(param)
+            if value:
+                names[kind] = [name for name in value.split(",") if name]
+        return names
+
+    def match_queryset(self, queryset, match):
+        """SQL version of match mode, used for cursor pagination and filter by user."""
+        lookups = {'Tag': 'tags__name__iexact', 'Ingredient': 'ingredients__name__iexact'}
+        search_user = self.request.query_params.get('user')
+        if search_user:
+            queryset = queryset.filter(reduce(or_, [Q(user__username__icontains=user) for user in search_user.split(",")]))
+        conditions = [
+            Q(id__in=models.Recipe.objects.filter(**{lookups[kind]: name}).values('id'))
+            for kind, names in self.get_match_names().items() for name in names
+        ]
+        if not conditions:
+            return queryset
+        if match == 'all':
+            return queryset.filter(*conditions)
+        return queryset.filter(reduce(or_, conditions))
+
+    def get_page_number(self, request):
+        """Page number of page mode, None if invalid."""
+        try:
+            page_number = int(request.query_params.get('page', 1))
+        except ValueError:
+            return None
+        return page_number if page_number >= 1 else None
+
+    def page_response(self, request, page_number, count, results):
+        """Response in the format of CustomPagination, for pages not paginated from queryset."""
+        url = request.build_absolute_uri()
+        next_url = replace_query_param(url, 'page', page_number + 1) if page_number * CustomPagination.page_size < count else None
+        previous_url = None
+        if page_number == 2:
+            previous_url = remove_query_param(url, 'page')
+        elif page_number > 2:
+            previous_url = replace_query_param(url, 'page', page_number - 1)
+        return Response({
+            'count': count,
+            'next': next_url,
+            'previous': previous_url,
+            'results': results,
+        }, status=status.HTTP_200_OK)
+
+    def list_data(self, request, ids):
+        """
+        List data of recipes, from cached recipe list data.
+        Recipe data missing in cache is loaded in one query, deleted recipe is skipped.
+        Cached data is full, ?fields= pick from it, ?expand= load the recipes from SQL.
+
+        :return: Dict of recipe id and data.
+        """
+        projection = self.get_projection()
+        if projection and projection['expand']:
+            recipes = list(self.with_relations(self.queryset, projection).filter(id__in=ids))
+            return dict(zip([recipe.id for recipe in recipes], self.get_serializer(recipes, many=True).data))
+        items = self.recipe_redis_handler.get_list_items(ids)
+        missing_ids = [recipe_id for recipe_id in ids if recipe_id not in items]
+        if missing_ids:
+            recipes = self.with_relations(self.queryset).filter(id__in=missing_ids)
+            missing_items = serializers.RecipeSerialzier(recipes, many=True, context={'request': request}).data
+            self.recipe_redis_handler.set_list_items(missing_items)
+            items.update({item['id']: item for item in missing_items})
+        fields = projection['fields'] if projection else None
+        return {recipe_id: serializers.RecipeSerialzier.project(item, fields) for recipe_id, item in items.items()}
+
+    def indexed_list(self, request):
+        """
+        Match mode of list from the redis inverted index, only the recipes of page are loaded.
+        Return None when the request can not be answered by index.
+        """
+        match = request.query_params.get('match')
+        if match not in ('all', 'any') or self.pagination_class is not CustomPagination:
+            return None
+        if request.query_params.get('q') or request.query_params.get('user'):
+            return None
+        names = self.get_match_names()
+        page_number = self.get_page_number(request)
+        if not names or page_number is None:
+            return None
+        page_size = CustomPagination.page_size
+        keys = [self.recipe_redis_handler.index_key(kind, name) for kind, kind_names in names.items() for name in kind_names]
+        try:
+            matched = self.recipe_redis_handler.match_recipe_ids(
+                keys, match, (page_number - 1) * page_size, page_number * page_size - 1
+            )
+            if matched is None:
+                return None
+            count, ids = matched
+            data = self.list_data(request, ids)
+        except Exception as e:
+            print(e)
+            return None
+        return self.page_response(request, page_number, count, [data[recipe_id] for recipe_id in ids if recipe_id in data])
+
     def to_representation(self, instance):
         """Transform to leagal format"""
         ret = super().to_representation(instance)
@@ -338,28 +556,396 @@ class RecipeViewSet(UnsafeMethodCSRFMixin, viewsets.ModelViewSet):
                     comment['crated_time'] = comment['crated_time'].isoformat()
         return ret
 
+    def get_list_cache_key(self, request):
+        """Cache key of list page, from the normalized filters and the page params."""
+        filters = {
+            kind: request.query_params.get(param).split(",")
+            for kind, param in self.list_filter_params.items()
+            if request.query_params.get(param)
+        }
+        page_params = {param: request.query_params.get(param) for param in self.list_page_params}
+        return self.recipe_redis_handler.list_cache_key(filters, page_params)
+
+    def get_facets(self, request):
+        """
+        Recipe count of tags and ingredients for all recipes match the current filter.
+        Ids come from one query without join of relations, names from the forward index in redis.
+        Facets are cached by filter and list versions, so every page of filter share them.
+        Facets of unfiltered list are cached for FACET_ALL_TIMEOUT whatever the list version.
+        """
+        filters = {
+            kind: request.query_params.get(param).split(",")
+            for kind, param in self.list_filter_params.items()
+            if request.query_params.get(param)
+        }
+        facet_params = {param: request.query_params.get(param) for param in self.facet_params}
+        if filters or any(facet_params.values()):
+            cache_key = self.recipe_redis_handler.list_cache_key(filters, facet_params, prefix='Recipe_facets')
+            timeout = LIST_CACHE_TIMEOUT
+        else:
+            cache_key, timeout = FACET_ALL_KEY, FACET_ALL_TIMEOUT
+        facets = self.recipe_redis_handler.get_facets(cache_key)
+        if facets is None:
+            queryset = self.filter_queryset(self.get_queryset()).prefetch_related(None).select_related(None)
+            recipe_ids = list(queryset.order_by().values_list('id', flat=True))
+            facets = self.recipe_redis_handler.count_facets(recipe_ids)
+            self.recipe_redis_handler.set_facets(cache_key, facets, timeout=timeout)
+        return facets
+
+    def list_etag(self, request, ids):
+        """
+        ETag of list page, from the page cache key (list versions), the full path and the versions of page recipes.
+        Views of recipe are not part of it.
+        """
+        return make_etag(self.page_cache_key, request.get_full_path(), ids, self.recipe_redis_handler.get_recipe_versions(ids))
+
+    @staticmethod
+    def relative_link(url):
+        """Path and query of pagination link, the same cached page is served to every host."""
+        if not url:
+            return url
+        parts = urlsplit(url)
+        return urlunsplit(('', '', parts.path, parts.query, ''))
+
+    def cached_list(self, request):
+        """
+        Build list response from cached page ids and cached recipe list data.
+        Return None when page is not cached.
+        """
+        try:
+            self.page_cache_key = self.get_list_cache_key(request)
+            page = self.recipe_redis_handler.get_list_page(self.page_cache_key)
+            if page is None:
+                return None
+            ids = page['ids']
+            etag = self.list_etag(request, ids)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            data = self.list_data(request, ids)
+            results = [data[recipe_id] for recipe_id in ids if recipe_id in data]
+            # Links are cached relative, host of this request make them absolute.
+            meta = {
+                key: request.build_absolute_uri(value) if key in self.list_link_keys and value else value
+                for key, value in page['meta'].items()
+            }
+            return Response({**meta, 'results': results}, status=status.HTTP_200_OK, headers={'ETag': etag})
+        except Exception as e:
+            print(e)
+            self.page_cache_key = None
+            return None
+
+    def cache_list(self, request, response):
+        """Cache the ids and pagination meta of list page, and the list data of every recipe."""
+        if response.status_code != status.HTTP_200_OK or not getattr(self, 'page_cache_key', None):
+            return
+        try:
+            results = response.data['results']
+            meta = {
+                key: self.relative_link(value) if key in self.list_link_keys else value
+                for key, value in response.data.items() if key != 'results'
+            }
+            # Data of projection is partial, only the page ids are shared with full list.
+            if self.get_projection() is None:
+                self.recipe_redis_handler.set_list_items(results)
+            ids = [item['id'] for item in results]
+            self.recipe_redis_handler.set_list_page(self.page_cache_key, ids, meta)
+            response['ETag'] = self.list_etag(request, ids)
+        except Exception as e:
+            print(e)
+
     def list(self, request, *args, **kwargs):
         """list of recipe!"""
-        self.pagination_class = CustomPagination
-        response = super().list(request, *args, **kwargs)
+        if request.query_params.get('pagination') == 'cursor' or 'cursor' in request.query_params:
+            self.pagination_class = RecipeCursorPagination
+        else:
+            self.pagination_class = CustomPagination
+        response = self.cached_list(request)
+        if response is None:
+            response = self.indexed_list(request) or super().list(request, *args, **kwargs)
+            # Facets are in meta of cached page.
+            if request.query_params.get('facets') in ('true', '1') and response.status_code == status.HTTP_200_OK:
+                try:
+                    response.data['facets'] = self.get_facets(request)
+                    self.cache_list(request, response)
+                except Exception as e:
+                    # List without facets, not cached so the next request try facets again.
+                    print(e)
+            else:
+                self.cache_list(request, response)
         try:
             search_tags = request.query_params.get('tags')
             search_ingredients = request.query_params.get('ingredients')
             search_user = request.query_params.get('user')
 
-            if search_tags:
-                tags = search_tags.split(",")
-                models.Tag.objects.filter(name__in=tags).update(views=F('views') + 1)
+            # Views are buffered in redis, task flush_search_views write them to SQL.
+            with self.recipe_redis_handler.batch() as batch:
+                if search_tags:
+                    tags = search_tags.split(",")
+                    batch.increase_search_views("Tag", tags)
 
-            if search_ingredients:
-                ingredients = search_ingredients.split(",")
-                models.Ingredient.objects.filter(name__in=ingredients).update(views=F('views') + 1)
+                if search_ingredients:
+                    ingredients = search_ingredients.split(",")
+                    batch.increase_search_views("Ingredient", ingredients)
             return response
         except ValidationError as e:
             return Response({'error':f'{e}',"detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                "ingredients",
+                OpenApiTypes.STR,
+                required=True,
+                description="Comma separated list of ingredient names in pantry.",
+            ),
+            OpenApiParameter(
+                "max_missing",
+                OpenApiTypes.INT,
+                description="Only return recipes missing at most this number of ingredients.",
+            ),
+            OpenApiParameter("page", OpenApiTypes.INT),
+        ],
+        responses={
+            200:serializers.RecipeSerialzier(many=True),
+            400:serializers.ResponseSerializer,
+            500:serializers.ResponseSerializer
+        },
+    )
+    @action(detail=False, methods=['get'])
+    def pantry(self, request):
+        """
+        What can I cook with the pantry!
+        Recipes using any pantry ingredient, ranked by missing ingredients then matched ingredients.
+        Every candidate is scored by intersection of its ingredient ids in redis with the pantry.
+        """
+        try:
+            names = [name.strip() for name in request.query_params.get('ingredients', '').split(",") if name.strip()]
+            max_missing = request.query_params.get('max_missing')
+            max_missing = int(max_missing) if max_missing else None
+            page_number = self.get_page_number(request)
+            if not names or page_number is None:
+                return Response({"error":"Loss ingredients","detail":"Please provide ingredients of pantry!"}, status=status.HTTP_400_BAD_REQUEST)
+
+            pantry_ids = set(models.Ingredient.objects.filter(
+                reduce(or_, [Q(name__iexact=name) for name in names])
+            ).values_list('id', flat=True))
+            candidate_ids = self.recipe_redis_handler.union_recipe_ids(
+                [self.recipe_redis_handler.index_key("Ingredient", name) for name in names]
+            )
+            if candidate_ids is None:
+                # Index key is missing, candidates from SQL.
+                candidate_ids = list(models.Recipe.ingredients.through.objects.filter(
+                    ingredient_id__in=pantry_ids
+                ).values_list('recipe_id', flat=True).distinct())
+            recipe_ingredients = self.recipe_redis_handler.get_ingredient_ids(candidate_ids)
+            unloaded = [recipe_id for recipe_id in candidate_ids if recipe_id not in recipe_ingredients]
+            if unloaded:
+                # Ingredient ids not in redis yet, load them in one query and keep them.
+                loaded = {recipe_id: [] for recipe_id in unloaded}
+                for recipe_id, ingredient_id in models.Recipe.ingredients.through.objects.filter(
+                    recipe_id__in=unloaded
+                ).values_list('recipe_id', 'ingredient_id'):
+                    loaded[recipe_id].append(ingredient_id)
+                self.recipe_redis_handler.set_many_ingredient_ids(loaded)
+                recipe_ingredients.update({recipe_id: frozenset(ids) for recipe_id, ids in loaded.items()})
+            ranked = []
+            for recipe_id, ingredient_ids in recipe_ingredients.items():
+                matched = len(ingredient_ids & pantry_ids)
+                missing = len(ingredient_ids) - matched
+                if matched and (max_missing is None or missing <= max_missing):
+                    ranked.append((missing, -matched, recipe_id))
+            ranked.sort()
+
+            page_size = CustomPagination.page_size
+            page = ranked[(page_number - 1) * page_size:page_number * page_size]
+            data = self.list_data(request, [recipe_id for _, _, recipe_id in page])
+            results = [
+                {**data[recipe_id], 'matched_count': -negative_matched, 'missing_count': missing}
+                for missing, negative_matched, recipe_id in page if recipe_id in data
+            ]
+            return self.page_response(request, page_number, len(ranked), results)
+        except ValueError as e:
+            return Response({'error':f'{e}',"detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                "ids",
+                OpenApiTypes.STR,
+                required=True,
+                description=f"Comma separated list of recipe ids, at most {BATCH_MAX_IDS}.",
+            ),
+            OpenApiParameter(
+                "fields",
+                OpenApiTypes.STR,
+                description="Comma separated list of fields to return.",
+            ),
+        ],
+        responses={
+            200:serializers.RecipeSQLDetailSerializer(many=True),
+            400:serializers.ResponseSerializer,
+            500:serializers.ResponseSerializer
+        },
+    )
+    @action(detail=False, methods=['get'])
+    def batch(self, request):
+        """
+        Detail of many recipes in request order, recipe not exist is in missing.
+        Cached payloads in one pipeline, misses in one prefetched query, written back in one pipeline.
+        Views are not counted, like list.
+        """
+        try:
+            ids = list(dict.fromkeys(int(recipe_id) for recipe_id in request.query_params.get('ids', '').split(",") if recipe_id))
+            if not ids or len(ids) > BATCH_MAX_IDS:
+                return Response(
+                    {"error":"Invalid ids","detail":f"Please provide 1 to {BATCH_MAX_IDS} recipe ids!"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            recipes, counters = self.recipe_redis_handler.get_recipes_with_counters(ids)
+            missing_ids = [recipe_id for recipe_id in ids if recipe_id not in recipes]
+            # Recipes known to not exist skip SQL.
+            known_missing = self.recipe_redis_handler.get_missing(missing_ids)
+            missing_ids = [recipe_id for recipe_id in missing_ids if recipe_id not in known_missing]
+            if missing_ids:
+                instances = self.with_relations(self.queryset).prefetch_related(
+                    serializers.top_five_comments_prefetch()
+                ).filter(id__in=missing_ids)
+                loaded = serializers.RecipeSQLDetailSerializer(instances, many=True).data
+                with self.recipe_redis_handler.batch() as batch:
+                    batch.set_recipes(loaded)
+                    batch.set_missing(*(set(missing_ids) - {item['id'] for item in loaded}))
+                # Counters in SQL lag behind redis until they are flushed, hits carry the live ones.
+                recipes.update({
+                    item['id']: {**item, **self.recipe_redis_handler.live_counters(item, counters[item['id']])}
+                    for item in loaded
+                })
+            projection = self.get_projection()
+            fields = projection['fields'] if projection else None
+            return Response({
+                'results': [serializers.RecipeSQLDetailSerializer.project(recipes[recipe_id], fields) for recipe_id in ids if recipe_id in recipes],
+                'missing': [recipe_id for recipe_id in ids if recipe_id not in recipes],
+            }, status=status.HTTP_200_OK)
+        except ValueError as e:
+            return Response({'error':f'{e}',"detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                "ids",
+                OpenApiTypes.STR,
+                required=True,
+                description=f"Comma separated list of recipe ids, at most {BATCH_MAX_IDS}.",
+            ),
+        ],
+        responses={
+            200:serializers.InteractionSerializer(many=True),
+            400:serializers.ResponseSerializer,
+            403:serializers.ResponseSerializer,
+            500:serializers.ResponseSerializer
+        },
+    )
+    @action(detail=False, methods=['get'])
+    def interactions(self, request):
+        """
+        Like and save state of user on a page of recipes, for the buttons of list.
+        Likes from redis like sets in one pipeline, the rest and saves in one query each.
+        """
+        try:
+            ids = list(dict.fromkeys(int(recipe_id) for recipe_id in request.query_params.get('ids', '').split(",") if recipe_id))
+            if not ids or len(ids) > BATCH_MAX_IDS:
+                return Response(
+                    {"error":"Invalid ids","detail":f"Please provide 1 to {BATCH_MAX_IDS} recipe ids!"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            user = request.user
+            liked = self.recipe_redis_handler.get_liked(ids, user.id)
+            unloaded = [recipe_id for recipe_id in ids if recipe_id not in liked]
+            if unloaded:
+                liked_ids = set(models.Like.objects.filter(user=user, recipe_id__in=unloaded).values_list('recipe_id', flat=True))
+                liked.update({recipe_id: recipe_id in liked_ids for recipe_id in unloaded})
+            saved_ids = set(models.Save.objects.filter(user=user, recipe_id__in=ids).values_list('recipe_id', flat=True))
+            return Response({
+                'results': [
+                    {'id': recipe_id, 'liked': liked[recipe_id], 'saved': recipe_id in saved_ids} for recipe_id in ids
+                ]
+            }, status=status.HTTP_200_OK)
+        except ValueError as e:
+            return Response({'error':f'{e}',"detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @extend_schema(
+        parameters=[OpenApiParameter("page", OpenApiTypes.INT)],
+        responses={
+            200:serializers.RecipeSerialzier(many=True),
+            400:serializers.ResponseSerializer,
+            500:serializers.ResponseSerializer
+        },
+    )
+    @action(detail=False, methods=['get'])
+    def trending(self, request):
+        """Recipes hot now, by views, likes and saves decayed with time."""
+        try:
+            page_number = self.get_page_number(request)
+            if page_number is None:
+                return Response({"error":"Invalid page","detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
+            page_size = CustomPagination.page_size
+            count, ids = self.recipe_redis_handler.get_trending((page_number - 1) * page_size, page_number * page_size - 1)
+            data = self.list_data(request, ids)
+            return self.page_response(request, page_number, count, [data[recipe_id] for recipe_id in ids if recipe_id in data])
+        except Exception as e:
+            return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @extend_schema(
+        parameters=[OpenApiParameter("cursor", OpenApiTypes.STR, description="Follow the next link to get next page.")],
+        responses={
+            200:serializers.RecipeSerialzier(many=True),
+            400:serializers.ResponseSerializer,
+            403:serializers.ResponseSerializer,
+            500:serializers.ResponseSerializer
+        },
+    )
+    @action(detail=False, methods=['get'])
+    def feed(self, request):
+        """
+        Home feed, the newest recipes of followed users.
+        Feed is pushed on write, recipes of celebrities are merged on read.
+        """
+        try:
+            cursor = request.query_params.get('cursor')
+            position = None
+            if cursor:
+                try:
+                    # "score:id" of the last recipe, old cursors are the score only.
+                    score, _, recipe_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').partition(':')
+                    position = (float(score), int(recipe_id) if recipe_id else None)
+                except (TypeError, ValueError, UnicodeError):
+                    return Response({"error":"Invalid cursor","detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
+            followed_ids = list(models.UserFollowing.objects.filter(user_id=request.user).values_list('following_user_id', flat=True))
+            celebrity_ids = self.recipe_redis_handler.filter_celebrities(followed_ids)
+            page_size = RecipeCursorPagination.page_size
+            entries = self.recipe_redis_handler.get_feed(request.user.id, celebrity_ids, position, page_size + 1)
+            page = entries[:page_size]
+            next_url = None
+            if len(entries) > page_size:
+                last_id, last_score = page[-1]
+                next_cursor = base64.urlsafe_b64encode(f"{last_score!r}:{last_id}".encode('ascii')).decode('ascii')
+                next_url = replace_query_param(request.build_absolute_uri(), 'cursor', next_cursor)
+            ids = [recipe_id for recipe_id, _ in page]
+            data = self.list_data(request, ids)
+            return Response({
+                'next': next_url,
+                'results': [data[recipe_id] for recipe_id in ids if recipe_id in data],
+            }, status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
     def create(self, request, *args, **kwargs):
         """Create recipe object."""
         try:
@@ -369,42 +955,101 @@ class RecipeViewSet(UnsafeMethodCSRFMixin, viewsets.ModelViewSet):
                 recipe_id = response.data.get('id', None)
                 if recipe_id is not None:
                 # Get recipe id of instance.
-                    self.recipe_redis_handler.set_recipe(recipe_id=recipe_id,data=response.data)
-                    self.recipe_redis_handler.set_hkey(hkey_name='views',recipe_id=int(recipe_id))
-                    self.recipe_redis_handler.set_hkey(hkey_name='likes',recipe_id=int(recipe_id))
-                    self.recipe_redis_handler.set_hkey(hkey_name='save_count',recipe_id=int(recipe_id))
+                    with self.recipe_redis_handler.batch() as batch:
+                        batch.set_recipe(recipe_id=recipe_id,data=response.data)
+                        batch.set_hkey(hkey_name='views',recipe_id=int(recipe_id))
+                        batch.set_hkey(hkey_name='likes',recipe_id=int(recipe_id))
+                        batch.set_hkey(hkey_name='save_count',recipe_id=int(recipe_id))
                     return response
         except ValidationError as e:
             return Response({'error': str(e),"detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e :
             return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def payload_response(self, payload, counters, etag, use_gzip):
+        """Serve cached detail payload as bytes, only the live counters are rendered per request."""
+        response = HttpResponse(
+            self.recipe_redis_handler.splice_payload(payload, counters, gzip=use_gzip),
+            content_type='application/json'
+        )
+        response['ETag'] = etag
+        response['Vary'] = 'Accept-Encoding'
+        if use_gzip:
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+    def rebuild_detail(self, recipe_id, counters, fields, etag, version):
+        """Load detail from SQL, cache it with the time spent for early refresh and the version read before it."""
+        start = time.perf_counter()
+        recipe_instance = self.with_relations(self.queryset).filter(id=recipe_id).first()
+        if not recipe_instance:
+            self.recipe_redis_handler.set_missing(recipe_id)
+            return Response({"error":"Loss recipe id","detail":"Please provide recipe id!"}, status=status.HTTP_404_NOT_FOUND)
+        recipe = serializers.RecipeSQLDetailSerializer(recipe_instance)
+        self.recipe_redis_handler.set_recipe(recipe_id=recipe_id, data=recipe.data, delta=time.perf_counter() - start, version=version)
+        data = {**recipe.data, **self.recipe_redis_handler.live_counters(recipe.data, counters)}
+        return Response(serializers.RecipeSQLDetailSerializer.project(data, fields), status.HTTP_200_OK, headers={'ETag': etag})
+
+    def refresh_early(self, recipe_id):
+        """Rebuild detail by celery before it expire, only one task for a recipe at once."""
+        lock = f"Recipe_refresh_{recipe_id}"
+        token = self.recipe_redis_handler.acquire_lock(lock)
+        if token is None:
+            return
+        try:
+            refresh_recipe_detail.delay(recipe_id, token)
+        except Exception as e:
+            print(e)
+            self.recipe_redis_handler.release_lock(lock, token)
+
     def retrieve(self, request, *args, **kwargs):
         """Retrieve recipe object detail"""
         try:
             recipe_id = kwargs.get('pk')
             if not recipe_id:
                 return Response({"error":"Loss recipe id","detail":"Please provide recipe id!"}, status=status.HTTP_400_BAD_REQUEST)
-            cache_data = self.recipe_redis_handler.get_recipe(recipe_id=int(recipe_id))
-            if cache_data:
-                self.recipe_redis_handler.increase_recipe_view(hkey_name="views",recipe_id=recipe_id)
-                cache_data["views"] = cache_data.get("views", 0) + 1
-                self.recipe_redis_handler.set_recipe(recipe_id=recipe_id, data=cache_data)
-                return Response({'recipe': cache_data}, status.HTTP_200_OK)
-            # If data is not in Redis, fetch it from SQL
-            recipe_instance = self.queryset.filter(id=recipe_id).first()
-            if not recipe_instance:
+            recipe_id = int(recipe_id)
+            # Conditional GET is answered from the version in redis, no SQL and no view counted.
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match:
+                payload_version, version = self.recipe_redis_handler.get_detail_versions(recipe_id)
+                etag = make_etag('Recipe', recipe_id, payload_version, version, request.get_full_path())
+                # "*" match only a recipe known to exist, by its version here or by its cached payload below.
+                if etag_matches(request, etag, exists=version > 0):
+                    return not_modified(etag)
+            # Detail is cached in full, ?fields= pick from it.
+            projection = self.get_projection()
+            fields = projection['fields'] if projection else None
+            use_payload = projection is None and request.accepted_renderer.format == 'json'
+            use_gzip = use_payload and accepts_gzip(request)
+            # One round trip count the view and read cached detail, live counters and version.
+            payload, counters, version, missing = self.recipe_redis_handler.view_recipe(recipe_id, gzip=use_gzip)
+            if missing:
                 return Response({"error":"Loss recipe id","detail":"Please provide recipe id!"}, status=status.HTTP_404_NOT_FOUND)
-            average_rating_result = recipe_instance.recipe_comment.aggregate(average_rating=Avg('rating'))
-            comment_count_result = recipe_instance.recipe_comment.aggregate(comment_count=Count('id'))
-            average_rating = average_rating_result.get("average_rating")
-            comment_count = comment_count_result.get("comment_count")
-            setattr(recipe_instance, 'average_rating', average_rating)
-            setattr(recipe_instance, 'comment_count', comment_count)
-            recipe = serializers.RecipeSQLDetailSerializer(recipe_instance)
-            self.recipe_redis_handler.set_recipe(recipe_id=recipe_id, data=recipe.data)
-            self.recipe_redis_handler.increase_recipe_view(hkey_name="views",recipe_id=(recipe_id))
-            return Response(recipe.data, status.HTTP_200_OK)
+            # Body is built from the payload version, likes and saves only bump the live version.
+            etag = make_etag('Recipe', recipe_id, version, version, request.get_full_path())
+            if payload is None:
+                # Single flight: one request rebuild the detail, the others wait for it.
+                lock = f"Recipe_detail_{recipe_id}"
+                token = self.recipe_redis_handler.acquire_lock(lock)
+                if token is None:
+                    payload = self.recipe_redis_handler.wait_for_payload(recipe_id, lock, gzip=use_gzip)
+                if payload is None:
+                    try:
+                        return self.rebuild_detail(recipe_id, counters, fields, etag, version)
+                    finally:
+                        if token:
+                            self.recipe_redis_handler.release_lock(lock, token)
+            elif self.recipe_redis_handler.should_refresh_early(payload):
+                self.refresh_early(recipe_id)
+            # A stale payload (local cache) keep the version it is built from, its ETag differ from the fresh one.
+            etag = make_etag('Recipe', recipe_id, payload.get('version'), version, request.get_full_path())
+            if if_none_match and etag_matches(request, etag):
+                return not_modified(etag)
+            if use_payload:
+                return self.payload_response(payload, counters, etag, use_gzip)
+            cache_data = self.recipe_redis_handler.payload_data(payload, counters)
+            return Response({'recipe': serializers.RecipeSQLDetailSerializer.project(cache_data, fields)}, status.HTTP_200_OK, headers={'ETag': etag})
         except ValidationError as e :
             return Response({'error': str(e),"detail":"Please check again!"}, status=status.HTTP_400_INTERNAL_SERVER_ERROR)
         except Exception as e :
@@ -417,15 +1062,16 @@ class RecipeViewSet(UnsafeMethodCSRFMixin, viewsets.ModelViewSet):
             recipe =  response.data
             if recipe:
                 recipe_id = response.data.get('id', None)
-                if recipe_id is not None:
-                # Get recipe id of instance.
-                    self.recipe_redis_handler.set_recipe(recipe_id=recipe_id,data=recipe)
-                views_value = int(recipe.get("views"))
-                likes_value = int(recipe.get("likes"))
-                save_count_value = int(recipe.get("save_count"))
-                self.recipe_redis_handler.update_hkey(hkey_name="views",recipe_id=recipe_id, value=views_value)
-                self.recipe_redis_handler.update_hkey(hkey_name="likes",recipe_id=recipe_id, value=likes_value)
-                self.recipe_redis_handler.update_hkey(hkey_name="save_count",recipe_id=recipe_id, value=save_count_value)
+                with self.recipe_redis_handler.batch() as batch:
+                    if recipe_id is not None:
+                    # Get recipe id of instance.
+                        batch.set_recipe(recipe_id=recipe_id,data=recipe)
+                    views_value = int(recipe.get("views"))
+                    likes_value = int(recipe.get("likes"))
+                    save_count_value = int(recipe.get("save_count"))
+                    batch.update_hkey(hkey_name="views",recipe_id=recipe_id, value=views_value)
+                    batch.update_hkey(hkey_name="likes",recipe_id=recipe_id, value=likes_value)
+                    batch.update_hkey(hkey_name="save_count",recipe_id=recipe_id, value=save_count_value)
                 return response
         except ValidationError as e :
             return Response({'error': str(e),"detail":"Please check again!"}, status=status.HTTP_400_INTERNAL_SERVER_ERROR)
@@ -439,16 +1085,17 @@ class RecipeViewSet(UnsafeMethodCSRFMixin, viewsets.ModelViewSet):
         try:
             recipe =  response.data
             if recipe:
-                recipe_id = response.get('id', None)
-                if recipe_id is not None:
-                # Get recipe id of instance.
-                    self.recipe_redis_handler.set_recipe(recipe_id=recipe_id,data=recipe)
-                views_value = int(recipe.get("views"))
-                likes_value = int(recipe.get("likes"))
-                save_count_value = int(recipe.get("save_count"))
-                self.recipe_redis_handler.update_hkey(hkey_name="views",recipe_id=recipe_id, value=views_value)
-                self.recipe_redis_handler.update_hkey(hkey_name="likes",recipe_id=recipe_id, value=likes_value)
-                self.recipe_redis_handler.update_hkey(hkey_name="save_count",recipe_id=recipe_id, value=save_count_value)
+                recipe_id = response.data.get('id', None)
+                with self.recipe_redis_handler.batch() as batch:
+                    if recipe_id is not None:
+                    # Get recipe id of instance.
+                        batch.set_recipe(recipe_id=recipe_id,data=recipe)
+                    views_value = int(recipe.get("views"))
+                    likes_value = int(recipe.get("likes"))
+                    save_count_value = int(recipe.get("save_count"))
+                    batch.update_hkey(hkey_name="views",recipe_id=recipe_id, value=views_value)
+                    batch.update_hkey(hkey_name="likes",recipe_id=recipe_id, value=likes_value)
+                    batch.update_hkey(hkey_name="save_count",recipe_id=recipe_id, value=save_count_value)
                 return response
         except ValidationError as e :
             return Response({'error': str(e),"detail":"Please check again!"}, status=status.HTTP_400_INTERNAL_SERVER_ERROR)
@@ -463,12 +1110,10 @@ class RecipeViewSet(UnsafeMethodCSRFMixin, viewsets.ModelViewSet):
             instance = self.get_object()
             recipe_id = instance.id
             super().destroy(self, request, *args, **kwargs)
-            self.recipe_redis_handler.del_hkey(hkey_name="views", recipe_id=recipe_id)
-            self.recipe_redis_handler.del_hkey(hkey_name="likes", recipe_id=recipe_id)
-            self.recipe_redis_handler.del_hkey(hkey_name="save_count", recipe_id=recipe_id)
-            self.recipe_redis_handler.del_prev_hkey(hkey_name="views", recipe_id=recipe_id)
-            self.recipe_redis_handler.del_prev_hkey(hkey_name="likes", recipe_id=recipe_id)
-            self.recipe_redis_handler.del_prev_hkey(hkey_name="save_count", recipe_id=recipe_id)
+            with self.recipe_redis_handler.batch() as batch:
+                for hkey_name in ("views", "likes", "save_count"):
+                    batch.del_hkey(hkey_name, recipe_id)
+                    batch.del_prev_hkey(hkey_name, recipe_id)
             return Response("No_content,Redirect to list page", status=status.HTTP_204_NO_CONTENT)
         except ValidationError as e :
             return Response({'error': str(e),"detail":"Please check again!"}, status=status.HTTP_400_INTERNAL_SERVER_ERROR)
@@ -715,7 +1360,7 @@ class RecipeCommentViewSet(
                         ):
     """Viewset for recipe comment!"""
     serializer_class = serializers.RecipeCommentSerializer
-    queryset = models.RecipeComment.objects.all().order_by("-created_time")
+    queryset = models.RecipeComment.objects.select_related('user', 'recipe').order_by("-created_time")
     permission_classes = [permissions.IsAuthenticated]
     recipe_redis_handler = RedisHandler(redis_client1)
 
@@ -733,13 +1378,27 @@ class RecipeCommentViewSet(
         try:
             recipe_id = request.query_params.get('recipe_id')
             if recipe_id is not None:
-                self.queryset = self.queryset.filter(recipe=recipe_id).prefetch_related('user', 'recipe')
+                self.queryset = self.queryset.filter(recipe=recipe_id)
             return super().list(request, *args, **kwargs)
         except ValidationError as e:
             return Response({'error': str(e),"detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error':f'{e}  '}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def perform_create(self, serializer):
+        """Save comment and add it to comment stats of recipe in same transaction."""
+        with transaction.atomic():
+            super().perform_create(serializer)
+            comment = serializer.instance
+            change_recipe_rating(comment.recipe_id, 1, int(comment.rating))
+
+    def perform_destroy(self, instance):
+        """Delete comment and remove it from comment stats of recipe in same transaction."""
+        with transaction.atomic():
+            recipe_id, rating = instance.recipe_id, int(instance.rating)
+            super().perform_destroy(instance)
+            change_recipe_rating(recipe_id, -1, -rating)
+
     def create(self, request, *args, **kwargs):
         """Base create method and update the recipe with new comment in cache!"""
         try:
@@ -766,7 +1425,16 @@ class RecipeCommentViewSet(
 
     def perform_update(self, serializer):
         """Base on UpdateModelMixin and update the recipe with new comment in cache! """
-        super().perform_update(serializer)
+        prev_recipe_id, prev_rating = serializer.instance.recipe_id, int(serializer.instance.rating)
+        with transaction.atomic():
+            super().perform_update(serializer)
+            comment = serializer.instance
+            if comment.recipe_id == prev_recipe_id:
+                change_recipe_rating(comment.recipe_id, 0, int(comment.rating) - prev_rating)
+            else:
+                # Comment move to other recipe.
+                change_recipe_rating(prev_recipe_id, -1, -prev_rating)
+                change_recipe_rating(comment.recipe_id, 1, int(comment.rating))
         try:
             instance = serializer.instance
             # Ensure that the recipe instance exists before trying to access its id
@@ -799,6 +1467,7 @@ class BaseRecipeAttrViewSet(
     """Base view set for recipe attributes."""
 
     permission_classes = [permissions.AllowAny]
+    recipe_redis_handler = RedisHandler(redis_client1)
 
     def get_permissions(self):
         if self.action in ['destroy','update', 'create']:
@@ -811,6 +1480,51 @@ class BaseRecipeAttrViewSet(
         queryset = self.queryset
         return queryset.all().order_by("-views").distinct()
 
+    def list(self, request, *args, **kwargs):
+        """List with ETag from the collection version, changed by every write and flush of views."""
+        etag = make_etag(self.queryset.model.__name__, self.recipe_redis_handler.get_collection_version(self.queryset.model.__name__), request.get_full_path())
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response = super().list(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
+
+    def perform_update(self, serializer):
+        """Remove the old name from autocomplete when renamed, signal add the new one."""
+        old_name = serializer.instance.name
+        instance = serializer.save()
+        if instance.name != old_name:
+            try:
+                self.recipe_redis_handler.remove_suggestion(self.queryset.model.__name__, old_name)
+            except Exception as e:
+                print(e)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("prefix", OpenApiTypes.STR, required=True, description="Prefix of name, case insensitive."),
+            OpenApiParameter("limit", OpenApiTypes.INT, description=f"Number of suggestions, default 10, max {SUGGEST_MAX_LIMIT}."),
+        ],
+        responses={
+            200:serializers.SuggestionSerializer(many=True),
+            400:serializers.ResponseSerializer,
+            500:serializers.ResponseSerializer
+        },
+    )
+    @action(detail=False, methods=['get'])
+    def suggest(self, request):
+        """Autocomplete names by prefix, the most popular (views + save_count) first."""
+        try:
+            prefix = request.query_params.get('prefix', '').strip()
+            limit = min(int(request.query_params.get('limit', 10)), SUGGEST_MAX_LIMIT)
+            if not prefix or limit < 1:
+                return Response({"error":"Loss prefix","detail":"Please provide prefix!"}, status=status.HTTP_400_BAD_REQUEST)
+            suggestions = self.recipe_redis_handler.suggest(self.queryset.model.__name__, prefix, limit)
+            return Response([{'name': name, 'popularity': popularity} for name, popularity in suggestions], status=status.HTTP_200_OK)
+        except ValueError as e:
+            return Response({'error':f'{e}',"detail":"Please check again!"}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 class TagViewSet(BaseRecipeAttrViewSet):
     """Views of tag API include list update destroy!"""
     serializer_class = serializers.TagSerialzier
@@ -894,28 +1608,30 @@ class IngredientViewSet(BaseRecipeAttrViewSet):
 @csrf_protect
 @permission_classes([IsAuthenticated])
 def like_button(request):
-    """Action that user like the recipe!"""
+    """
+    Action that user like the recipe!
+    Like is flipped in redis by one script call, flush_recipe_likes write it to SQL in bulk.
+    """
     recipe_id = request.data.get("recipe_id")
     recipe_redis_handler = RedisHandler(redis_client1)
     try:
-        recipe = models.Recipe.objects.filter(id=recipe_id).first()
-        if not recipe:
+        try:
+            recipe_id = int(recipe_id)
+        except (TypeError, ValueError):
             return Response({"error":"There is no recipe with this id"}, status=status.HTTP_404_NOT_FOUND)
-        user = request.user
-        like,created = models.Like.objects.get_or_create(user=user ,recipe=recipe)
-        if created:
-            recipe.likes=F('likes') + 1
-            recipe.save(update_fields=['likes'])
-            recipe.refresh_from_db()
-            recipe_redis_handler.increase_recipe_view(hkey_name="likes", recipe_id=recipe_id)
+        toggled = recipe_redis_handler.toggle_like(recipe_id, request.user.id)
+        if toggled is None:
+            # Like set of recipe is not in redis yet, load it from SQL once.
+            recipe = models.Recipe.objects.filter(id=recipe_id).values('likes').first()
+            if not recipe:
+                return Response({"error":"There is no recipe with this id"}, status=status.HTTP_404_NOT_FOUND)
+            user_ids = models.Like.objects.filter(recipe_id=recipe_id).values_list('user_id', flat=True)
+            recipe_redis_handler.load_likes(recipe_id, recipe['likes'], list(user_ids))
+            toggled = recipe_redis_handler.toggle_like(recipe_id, request.user.id)
+        liked, _ = toggled
+        if liked:
             return Response({"message":"Like action successed!"}, status=status.HTTP_200_OK)
-        else:
-            like.delete()
-            recipe.likes=F('likes') - 1
-            recipe.save(update_fields=['likes'])
-            recipe_redis_handler.increase_recipe_view(hkey_name="likes", recipe_id=recipe_id, increment_value=-1)
-            recipe.refresh_from_db()
-            return Response({"message":"Like action was revoke!"}, status=status.HTTP_200_OK)
+        return Response({"message":"Like action was revoke!"}, status=status.HTTP_200_OK)
     except Exception as e :
         return Response({'error':f'{e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 